@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+#
+#  Foldable Electronic Chess Board Project
+#
+#  This is the engine analysis part:
+#    * the UCI info handler, that streams depth/score/pv to web clients;
+#    * the background analyzer, that keeps the engine searching the human's
+#      position using only a slice of the CPU time, and a single thread, so
+#      that the sensors and the web server always have a core;
+#
+#  Copyright 2016 - Laurentiu Palcu <lpalcu@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+
+import chess
+from EcbTimeSource import MonotonicTime
+import chess.uci
+from threading import Lock
+
+
+class AnalysisHandler(chess.uci.InfoHandler):
+    def __init__(self, emit_cb=None, max_rate=2, time_source=None):
+        super(AnalysisHandler, self).__init__()
+
+        self.time_source = time_source or MonotonicTime()
+
+        self.emit_cb = emit_cb
+        self.min_interval = 1.0 / max_rate
+        self.last_emit = None
+
+        # side to move in the searched position, scores are sent from
+        # white's point of view
+        self.turn = chess.WHITE
+
+    def post_info(self):
+        super(AnalysisHandler, self).post_info()
+
+        if self.emit_cb is None or 1 not in self.info.get('pv', {}):
+            return
+
+        now = self.time_source.now()
+        if self.last_emit is not None and \
+                now - self.last_emit < self.min_interval:
+            return
+
+        self.last_emit = now
+
+        analysis = {
+            'depth': self.info.get('depth'),
+            'nps': self.info.get('nps'),
+            'pv': [move.uci() for move in self.info['pv'][1]],
+        }
+
+        score = self.info.get('score', {}).get(1)
+        if score is not None:
+            sign = [-1, 1][self.turn == chess.WHITE]
+            if score.cp is not None:
+                analysis['cp'] = sign * score.cp
+            if score.mate is not None:
+                analysis['mate'] = sign * score.mate
+
+        self.emit_cb(analysis)
+
+
+class Analyzer(object):
+    # engine threads while analyzing
+    THREADS = 1
+
+    def __init__(self, slice_ms=200, cpu_budget=0.5, time_source=None):
+        self.time_source = time_source or MonotonicTime()
+
+        self.slice_ms = slice_ms
+        self.pause = slice_ms * (1 - cpu_budget) / cpu_budget / 1000.0
+
+        self.lock = Lock()
+        self.engine = None
+        self.board = None
+        self.info_handler = None
+        self.command = None
+        self.timer = None
+        self.generation = 0
+
+        # engine threads to restore when the analysis stops
+        self.threads = None
+
+    def _slice_finished(self, generation, command):
+        with self.lock:
+            if generation != self.generation:
+                return
+
+            self.command = None
+
+            # leave the CPU to the rest of the system for a while
+            self.timer = self.time_source.timer(self.pause,
+                                                self._slice_start,
+                                                [generation])
+            self.timer.start()
+
+    def _slice_start(self, generation):
+        def slice_finished(command):
+            self._slice_finished(generation, command)
+
+        with self.lock:
+            if generation != self.generation:
+                return
+
+            self.timer = None
+            engine = self.engine
+            board = self.board
+
+            if self.info_handler is not None:
+                self.info_handler.turn = board.turn
+
+            engine.position(board)
+            self.command = engine.go(movetime=self.slice_ms,
+                                     async_callback=slice_finished)
+
+    def running(self):
+        return self.engine is not None
+
+    # 'threads' is the engine's threads setting, restored by stop()
+    def start(self, engine, board, info_handler=None, threads=None):
+        self.stop()
+
+        if threads is not None and threads != self.THREADS:
+            engine.setoption({'threads': self.THREADS})
+        else:
+            threads = None
+
+        with self.lock:
+            self.engine = engine
+            self.board = board.copy()
+            self.info_handler = info_handler
+            self.threads = threads
+            generation = self.generation
+
+        print("starting background analysis")
+        self._slice_start(generation)
+
+    def stop(self):
+        with self.lock:
+            self.generation += 1
+
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            engine = self.engine
+            searching = self.command is not None
+            threads = self.threads
+
+            self.command = None
+            self.engine = None
+            self.board = None
+            self.threads = None
+
+        # the engine callback takes the lock, so stop it with the lock released
+        if searching:
+            engine.stop()
+
+        # the engine's own searches use all its threads
+        if threads is not None:
+            engine.setoption({'threads': threads})
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+#
+#  Foldable Electronic Chess Board Project
+#
+#  These are the bitboard helpers: a set of squares is a 64 bit integer,
+#  a1 = bit 0 ... h8 = bit 63, the same layout as python-chess' SquareSet and
+#  Board.occupied. The sensor map rows, one byte per rank, a = bit 0, are the
+#  bytes of the bitboard, so comparing the board with the sensors is a XOR.
+#
+#  Copyright 2016 - Laurentiu Palcu <lpalcu@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+SQUARE_NAMES = ["%s%d" % (column, rank + 1)
+                for rank in range(0, 8) for column in "abcdefgh"]
+
+_SQUARES = dict([(name, sq) for sq, name in enumerate(SQUARE_NAMES)])
+
+BB_EMPTY = 0
+BB_ALL = (1 << 64) - 1
+
+BB_RANKS = [0xff << (8 * rank) for rank in range(0, 8)]
+
+# the squares of the chessmen in the initial position, and the ones empty
+BB_START = BB_RANKS[0] | BB_RANKS[1] | BB_RANKS[6] | BB_RANKS[7]
+BB_MIDDLE = BB_ALL & ~BB_START
+
+
+def square(name):
+    return _SQUARES[name]
+
+
+def popcount(bb):
+    return bin(bb).count('1')
+
+
+# the square indexes, a1 first
+def scan(bb):
+    while bb:
+        low = bb & -bb
+        yield low.bit_length() - 1
+        bb ^= low
+
+
+def to_squares(bb):
+    return [SQUARE_NAMES[sq] for sq in scan(bb)]
+
+
+def from_squares(names):
+    bb = BB_EMPTY
+    for name in names:
+        bb |= 1 << _SQUARES[name]
+
+    return bb
+
+
+# 'rows' holds one byte per rank, rank 1 first, like the sensor map
+def from_rows(rows):
+    bb = BB_EMPTY
+    for rank, row in enumerate(rows):
+        bb |= (row & 0xff) << (8 * rank)
+
+    return bb
+
+
+def to_rows(bb):
+    return [(bb >> (8 * rank)) & 0xff for rank in range(0, 8)]
+
+
+# the occupied squares of a FEN's piece placement; raises ValueError if it's
+# malformed, or not a string
+def from_fen(fen):
+    if not isinstance(fen, string_types):
+        raise ValueError("bad FEN: %r" % (fen,))
+
+    ranks = fen.split(' ')[0].split('/')
+    if len(ranks) != 8:
+        raise ValueError("bad FEN: %s" % fen)
+
+    bb = BB_EMPTY
+    for i, pieces in enumerate(ranks):
+        rank = 7 - i
+        column = 0
+
+        for c in pieces:
+            if c in '12345678':
+                column += int(c)
+            elif c in 'pnbrqkPNBRQK' and column < 8:
+                bb |= 1 << (8 * rank + column)
+                column += 1
+            else:
+                raise ValueError("bad FEN: %s" % fen)
+
+        if column != 8:
+            raise ValueError("bad FEN: %s" % fen)
+
+    return bb
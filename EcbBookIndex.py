@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+#
+#  Foldable Electronic Chess Board Project
+#
+#  This is the opening book index: a Polyglot book precompiled into a hash
+#  table keyed by the position's zobrist hash, memory mapped, so that a book
+#  lookup is one or two probes instead of a binary search of the book.
+#
+#  The book moves of a position are split in weight bands, relative to its
+#  heaviest move: the lower levels play the light moves, the higher ones the
+#  heavy moves. Every band keeps its moves with their cumulative weights, so
+#  that a weighted random choice is a bisection.
+#
+#  The index is built with: EcbBookIndex.py <book.bin> [<index>]; the index
+#  is <book.bin>.idx by default.
+#
+#  Copyright 2016 - Laurentiu Palcu <lpalcu@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+
+import chess
+import chess.polyglot
+import mmap
+import os
+import struct
+import sys
+
+# zobrist hash, move, weight, learn; big endian
+POLYGLOT_ENTRY = struct.Struct('>QHHI')
+
+# weight bands, as shares of the heaviest move's weight; a band holds the
+# weights above its lower share, or from it for the first band, up to its
+# upper share
+BANDS = [(0, 0.33), (0.33, 0.66), (0.66, 1)]
+
+# Polyglot castling moves are king takes rook
+_CASTLING = {
+    (chess.E1, chess.H1): chess.G1,
+    (chess.E1, chess.A1): chess.C1,
+    (chess.E8, chess.H8): chess.G8,
+    (chess.E8, chess.A8): chess.C8,
+}
+
+
+def decode_move(board, code):
+    from_square = (code >> 6) & 0x3f
+    to_square = code & 0x3f
+    promotion = (code >> 12) & 0x7
+
+    if board.piece_type_at(from_square) == chess.KING:
+        to_square = _CASTLING.get((from_square, to_square), to_square)
+
+    return chess.Move(from_square, to_square, promotion + 1 if promotion else
+                      None)
+
+
+# [(move, weight)] -> per band, [(move, cumulative weight)]
+def band_candidates(moves):
+    max_weight = max([weight for move, weight in moves] + [0])
+    bands = []
+
+    for min_share, max_share in BANDS:
+        candidates = []
+        total = 0
+
+        for move, weight in moves:
+            if not weight or weight > max_share * max_weight:
+                continue
+
+            if min_share and weight <= min_share * max_weight:
+                continue
+
+            total += weight
+            candidates.append((move, total))
+
+        bands.append(candidates)
+
+    return bands
+
+
+class BookIndex(object):
+    MAGIC = b'ECBBOOK1'
+
+    # magic, slots, moves
+    HEADER = struct.Struct('<8sII')
+    # zobrist hash, first move, moves of every band
+    SLOT = struct.Struct('<QI3Bx')
+    # Polyglot move, cumulative weight
+    MOVE = struct.Struct('<HI')
+
+    # at most this share of the slots is used
+    MAX_LOAD = 0.5
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.slots, self.moves = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC:
+            self.close()
+            raise ValueError("%s: not a book index" % path)
+
+        self.moves_offs = self.HEADER.size + self.slots * self.SLOT.size
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    @staticmethod
+    def index_path(book_path):
+        return book_path + '.idx'
+
+    # whether the book has an index, built after the book's last change
+    @classmethod
+    def fresh(cls, book_path):
+        try:
+            return os.path.getmtime(cls.index_path(book_path)) >= \
+                os.path.getmtime(book_path)
+        except OSError:
+            return False
+
+    def _find(self, key):
+        slot = key & (self.slots - 1)
+
+        while True:
+            rec = self.SLOT.unpack_from(self.map, self.HEADER.size +
+                                        slot * self.SLOT.size)
+            if rec[0] == key:
+                return rec
+            if not rec[0]:
+                return None
+
+            slot = (slot + 1) & (self.slots - 1)
+
+    # the moves of 'band', with their cumulative weights
+    def candidates(self, board, band):
+        rec = self._find(chess.polyglot.zobrist_hash(board))
+        if rec is None:
+            return []
+
+        first = rec[1] + sum(rec[2:2 + band])
+        candidates = []
+        for i in range(first, first + rec[2 + band]):
+            code, cumulative = self.MOVE.unpack_from(
+                self.map, self.moves_offs + i * self.MOVE.size)
+            candidates.append((decode_move(board, code), cumulative))
+
+        return candidates
+
+    @classmethod
+    def _positions(cls, book):
+        size = len(book) - len(book) % POLYGLOT_ENTRY.size
+        key = None
+        moves = []
+
+        # the entries are sorted by key
+        for offs in range(0, size, POLYGLOT_ENTRY.size):
+            entry_key, code, weight, learn = \
+                POLYGLOT_ENTRY.unpack_from(book, offs)
+
+            if entry_key != key and moves:
+                yield key, moves
+                moves = []
+
+            key = entry_key
+            moves.append((code, weight))
+
+        if moves:
+            yield key, moves
+
+    @classmethod
+    def build(cls, book_path, index_path=None):
+        if index_path is None:
+            index_path = cls.index_path(book_path)
+
+        with open(book_path, 'rb') as f:
+            book = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            positions = sum([1 for position in cls._positions(book)])
+
+            slots = 1
+            while slots * cls.MAX_LOAD < positions:
+                slots <<= 1
+
+            table = bytearray(slots * cls.SLOT.size)
+            moves = bytearray()
+            moves_no = 0
+
+            for key, entries in cls._positions(book):
+                bands = band_candidates(entries)
+
+                slot = key & (slots - 1)
+                while struct.unpack_from('<Q', table,
+                                         slot * cls.SLOT.size)[0]:
+                    slot = (slot + 1) & (slots - 1)
+
+                cls.SLOT.pack_into(table, slot * cls.SLOT.size, key,
+                                   moves_no,
+                                   *[min(len(band), 0xff) for band in bands])
+
+                for band in bands:
+                    for code, cumulative in band[:0xff]:
+                        moves += cls.MOVE.pack(code, cumulative)
+                        moves_no += 1
+        finally:
+            book.close()
+
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, slots, moves_no))
+            f.write(table)
+            f.write(moves)
+
+        os.rename(tmp_path, index_path)
+
+        return positions, moves_no
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: %s <book.bin> [<index>]" % sys.argv[0])
+        sys.exit(1)
+
+    positions, moves = BookIndex.build(sys.argv[1],
+                                       sys.argv[2] if len(sys.argv) > 2
+                                       else None)
+    print("book index: %d positions, %d moves" % (positions, moves))
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+#
+#  Foldable Electronic Chess Board Project
+#
+#  This is the configuration. Every setting has a dotted name, like
+#  'engine.threads', and a default; its value comes from the first layer
+#  that has it:
+#    * runtime: set through set(), e.g. by the /config endpoint;
+#    * environment: ECB_<NAME>, dots replaced by underscores, upper case,
+#      e.g. ECB_ENGINE_THREADS; JSON values, or plain strings;
+#    * file: a JSON object with one member per section, e.g.
+#      {"engine": {"threads": 1}};
+#    * the defaults.
+#
+#  A value must be of the default's kind: an int for an int, a number for a
+#  float, and so on. A setting may also have a check, a function telling
+#  whether a value is acceptable, e.g. in_range(1, 8).
+#
+#  The file is checked for changes every few seconds. Settings bound to an
+#  attribute, with bind(), are hot: they're applied as soon as they change,
+#  and only they can be changed at runtime. The others are read at startup.
+#
+#  Copyright 2016 - Laurentiu Palcu <lpalcu@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+
+import collections
+import json
+import os
+from threading import RLock, Thread
+import time
+
+try:
+    string_types = basestring
+    integer_types = (int, long)
+except NameError:
+    string_types = str
+    integer_types = (int,)
+
+
+# a check of the values between 'low' and 'high'
+def in_range(low, high):
+    return lambda value: low <= value <= high
+
+
+class Config(object):
+    # layers, highest priority first
+    LAYERS = ['runtime', 'environment', 'file', 'default']
+
+    ENV_PREFIX = 'ECB_'
+
+    RELOAD_PERIOD = 5
+
+    # 'defaults' holds (name, default) or (name, default, check)
+    def __init__(self, defaults, path=None, environ=os.environ):
+        self.lock = RLock()
+        self.path = path
+        self.file_mtime = None
+
+        self.defaults = collections.OrderedDict(
+            [(setting[0], setting[1]) for setting in defaults])
+        self.checks = dict([(setting[0], setting[2]) for setting in defaults
+                            if len(setting) > 2])
+        self.layers = dict([(layer, {}) for layer in self.LAYERS])
+        self.layers['default'] = self.defaults
+
+        # name: [(obj, attribute)]
+        self.bindings = {}
+
+        self.thread = None
+
+        self._env_load(environ)
+        self._file_load()
+
+    # a value of the same kind as the default, passing the setting's check,
+    # or None
+    def _check(self, name, value):
+        default = self.defaults[name]
+
+        if isinstance(default, bool):
+            kinds = (bool,)
+        elif isinstance(default, integer_types):
+            kinds = integer_types
+        elif isinstance(default, float):
+            kinds = integer_types + (float,)
+        elif isinstance(default, (list, tuple)):
+            kinds = (list, tuple)
+        elif isinstance(default, string_types):
+            kinds = string_types
+        else:
+            kinds = (type(default),)
+
+        check = self.checks.get(name, lambda value: True)
+
+        if isinstance(value, kinds) and \
+                isinstance(value, bool) == isinstance(default, bool) and \
+                check(value):
+            return value
+
+        print("config: %s: invalid value %r, the default is %r" %
+              (name, value, default))
+
+        return None
+
+    def _env_name(self, name):
+        return self.ENV_PREFIX + name.replace('.', '_').upper()
+
+    def _env_load(self, environ):
+        for name, default in self.defaults.items():
+            raw = environ.get(self._env_name(name))
+            if raw is None:
+                continue
+
+            try:
+                value = json.loads(raw)
+            except ValueError:
+                value = raw
+
+            value = self._check(name, value)
+            if value is not None:
+                self.layers['environment'][name] = value
+
+    def _file_read(self):
+        with open(self.path) as f:
+            sections = json.load(f)
+
+        values = {}
+        for section, settings in sections.items():
+            if not isinstance(settings, dict):
+                print("config: %s: not a section" % section)
+                continue
+
+            for key, value in settings.items():
+                name = section + '.' + key
+                if name not in self.defaults:
+                    print("config: %s: unknown setting" % name)
+                    continue
+
+                value = self._check(name, value)
+                if value is not None:
+                    values[name] = value
+
+        return values
+
+    # returns whether the file changed
+    def _file_load(self):
+        if self.path is None:
+            return False
+
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+
+        if mtime == self.file_mtime:
+            return False
+
+        values = {}
+        if mtime is not None:
+            try:
+                values = self._file_read()
+            except (IOError, ValueError) as e:
+                # keep the last good values
+                print("config: %s: %s" % (self.path, e))
+                return False
+
+        self.file_mtime = mtime
+
+        with self.lock:
+            self.layers['file'] = values
+
+        return True
+
+    def get(self, name):
+        with self.lock:
+            for layer in self.LAYERS:
+                if name in self.layers[layer]:
+                    return self.layers[layer][name]
+
+        raise KeyError(name)
+
+    def source(self, name):
+        with self.lock:
+            for layer in self.LAYERS:
+                if name in self.layers[layer]:
+                    return layer
+
+    def hot(self, name):
+        return name in self.bindings
+
+    # sets 'obj.attribute' to the setting, now and whenever it changes
+    def bind(self, name, obj, attribute):
+        with self.lock:
+            self.bindings.setdefault(name, []).append((obj, attribute))
+            setattr(obj, attribute, self.get(name))
+
+    def _apply(self, names):
+        with self.lock:
+            for name in names:
+                value = self.get(name)
+                for obj, attribute in self.bindings.get(name, []):
+                    if getattr(obj, attribute) != value:
+                        print("config: %s = %r" % (name, value))
+                        setattr(obj, attribute, value)
+
+    # sets a hot setting; raises KeyError or ValueError for the others
+    def set(self, name, value):
+        if name not in self.defaults:
+            raise KeyError(name)
+        if not self.hot(name):
+            raise ValueError("%s can't be changed at runtime" % name)
+
+        value = self._check(name, value)
+        if value is None:
+            raise ValueError("bad value for %s" % name)
+
+        with self.lock:
+            self.layers['runtime'][name] = value
+            self._apply([name])
+
+    # the values and their layers
+    def dump(self):
+        with self.lock:
+            return collections.OrderedDict(
+                [(name, {'value': self.get(name), 'source': self.source(name),
+                         'hot': self.hot(name)})
+                 for name in self.defaults])
+
+    def reload(self):
+        with self.lock:
+            if self._file_load():
+                self._apply(list(self.bindings.keys()))
+
+    def _run(self):
+        while True:
+            time.sleep(self.RELOAD_PERIOD)
+            self.reload()
+
+    def start(self):
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
@@ -22,18 +22,77 @@
 #
 
 import mraa
-from threading import Timer
+import time
+from threading import Lock, RLock
+from EcbI2cBus import I2cBus
+from EcbLeds import LedCompositor, LedLayer
+from EcbSensorHealth import SensorHealth
+from EcbTimeSource import MonotonicTime
+import EcbMetrics
+
+I2C_TRANSACTIONS = EcbMetrics.counter(
+    'ecb_i2c_transactions_total', 'I2C transactions.', ['controller'])
+I2C_ERRORS = EcbMetrics.counter(
+    'ecb_i2c_errors_total', 'Failed I2C transaction attempts.',
+    ['controller'])
+I2C_OFFLINE = EcbMetrics.counter(
+    'ecb_i2c_controller_offline_total',
+    'Times a controller went offline, after its retries failed.',
+    ['controller'])
+I2C_RECOVERIES = EcbMetrics.counter(
+    'ecb_i2c_controller_recoveries_total',
+    'Times a controller was reinitialized and came back online.',
+    ['controller'])
+I2C_CONTROLLER_UP = EcbMetrics.gauge(
+    'ecb_i2c_controller_up', 'Whether the controller is online.',
+    ['controller'])
+
+
+class ControllerError(Exception):
+    pass
 
 
 def isr_cb(parent_obj):
-    parent_obj._isr_handler()
+    try:
+        parent_obj._isr_handler()
+    except ControllerError:
+        # the controller went offline, it's being recovered
+        pass
 
 
+# The controllers' transactions go through the bus owner ('bus'). Reads wait
+# for their result, writes are queued.
+#
+# A failed transaction is retried a few times. If it still fails, the
+# controller goes offline: its reads raise ControllerError, its writes are
+# dropped, and it's reinitialized, with a growing delay, until it answers
+# again. 'health_cb(ctrl, online)' is called, on the bus thread, when that
+# happens, to restore the controller's state.
 class Controller(mraa.I2c):
-    def __init__(self, i2c_addr, int_pin, cb=None):
-        super(Controller, self).__init__(6)
+    PRIO_IRQ = I2cBus.PRIO_IRQ
+    PRIO_NORMAL = I2cBus.PRIO_NORMAL
+    PRIO_LEDS = I2cBus.PRIO_LEDS
+
+    # retries of a failed transaction; the delay doubles after each one
+    RETRIES = 3
+    RETRY_DELAY = 0.0005
+
+    # delay before the first reinitialization attempt, doubling after each
+    # failed attempt, up to the max
+    REINIT_DELAY = 0.01
+    REINIT_MAX_DELAY = 2.0
+
+    def __init__(self, i2c_addr, int_pin, cb=None, i2c_bus=6, bus=None):
+        super(Controller, self).__init__(i2c_bus)
 
         self.cb = cb
+        self.bus = bus or I2cBus(MonotonicTime())
+        self.metrics_labels = ("0x%02x" % i2c_addr,)
+
+        self.health_cb = None
+        self.online = True
+        self.recovering = False
+        I2C_CONTROLLER_UP.set(1, self.metrics_labels)
 
         self.address(i2c_addr)
         self.frequency(0)
@@ -42,7 +101,11 @@ class Controller(mraa.I2c):
         self.int_pin.dir(mraa.DIR_IN)
         self.int_pin.isr(mraa.EDGE_FALLING, isr_cb, self)
 
-        self._ctrlr_init()
+        # a missing controller doesn't stop the board, it's recovered later
+        try:
+            self._ctrlr_init()
+        except ControllerError:
+            pass
 
     def _ctrlr_init(self):
         pass
@@ -50,15 +113,109 @@ class Controller(mraa.I2c):
     def _isr_handler(self):
         pass
 
-    def reg_bit_set(self, reg, bit):
-        old_val = self.readReg(reg)
-        new_val = old_val | bit
-        self.writeReg(reg, new_val)
+    # the offline/recovery state is only changed by the transactions, which
+    # all run on the bus thread
+    def _transaction(self, op, *args):
+        if not self.online and not self.recovering:
+            raise ControllerError("i2c: controller %s is offline" %
+                                  self.metrics_labels[0])
+
+        delay = self.RETRY_DELAY
+        for attempt in range(0, self.RETRIES + 1):
+            try:
+                result = op(self, *args)
+            except Exception as e:
+                I2C_ERRORS.inc(self.metrics_labels)
+                error = e
+            else:
+                I2C_TRANSACTIONS.inc(self.metrics_labels)
+                return result
+
+            if attempt < self.RETRIES:
+                time.sleep(delay)
+                delay *= 2
+
+        self._failed(error)
 
-    def reg_bit_clear(self, reg, bit):
-        old_val = self.readReg(reg)
-        new_val = old_val & ~bit
-        self.writeReg(reg, new_val)
+        raise ControllerError("i2c: controller %s: %s" %
+                              (self.metrics_labels[0], error))
+
+    def _failed(self, error):
+        if not self.online:
+            return
+
+        print("i2c: controller %s offline: %s" %
+              (self.metrics_labels[0], error))
+
+        self.online = False
+        I2C_OFFLINE.inc(self.metrics_labels)
+        I2C_CONTROLLER_UP.set(0, self.metrics_labels)
+
+        if self.health_cb is not None:
+            self.health_cb(self, False)
+
+        self._schedule_recovery(self.REINIT_DELAY)
+
+    def _schedule_recovery(self, delay):
+        timer = self.bus.time_source.timer(
+            delay, self.bus.submit,
+            [self.PRIO_NORMAL, self, self._recover, delay])
+        timer.start()
+
+    def _recover(self, delay):
+        self.recovering = True
+        try:
+            self._ctrlr_init()
+        except ControllerError:
+            self._schedule_recovery(min(delay * 2, self.REINIT_MAX_DELAY))
+            return
+        finally:
+            self.recovering = False
+
+        print("i2c: controller %s back online" % self.metrics_labels[0])
+
+        self.online = True
+        I2C_RECOVERIES.inc(self.metrics_labels)
+        I2C_CONTROLLER_UP.set(1, self.metrics_labels)
+
+        if self.health_cb is not None:
+            self.health_cb(self, True)
+
+    def _write_now(self, data):
+        return self._transaction(mraa.I2c.write, data)
+
+    def readReg(self, reg, priority=PRIO_NORMAL):
+        return self.bus.call(priority, self, self._transaction,
+                             mraa.I2c.readReg, reg)
+
+    def readBytesReg(self, reg, length, priority=PRIO_NORMAL):
+        return self.bus.call(priority, self, self._transaction,
+                             mraa.I2c.readBytesReg, reg, length)
+
+    # the writes to an offline controller are dropped, its state is restored
+    # once it's back
+    def writeReg(self, reg, data, priority=PRIO_NORMAL):
+        if self.online or self.recovering:
+            self.bus.write(priority, self, self._write_now, reg, [data])
+
+    def write(self, data, priority=PRIO_NORMAL):
+        if self.online or self.recovering:
+            self.bus.write(priority, self, self._write_now, data[0],
+                           data[1:])
+
+    def _reg_update(self, reg, set_mask, clear_mask):
+        old_val = self._transaction(mraa.I2c.readReg, reg)
+        new_val = (old_val | set_mask) & ~clear_mask
+        self._transaction(mraa.I2c.writeReg, reg, new_val)
+
+    # read-modify-write, in one bus job
+    def reg_bit_set(self, reg, bit, priority=PRIO_NORMAL):
+        if self.online:
+            self.bus.submit(priority, self, self._reg_update, reg, bit, 0)
+
+    def reg_bit_clear(self, reg, bit, priority=PRIO_NORMAL):
+        if self.online:
+            self.bus.submit(priority, self, self._reg_update, reg, 0, bit)
 
 
 class HbController(Controller):
@@ -89,20 +246,22 @@ class HbController(Controller):
         self.writeReg(self.REGS['command'], 0)
 
         # switch off all leds
-        self.write(bytearray([self.REGS['led_row_0'], 0, 0, 0, 0]))
+        self.write(bytearray([self.REGS['led_row_0'], 0, 0, 0, 0]),
+                   self.PRIO_LEDS)
 
         # read sensor rows status, just to ack them
-        self.readBytesReg(self.REGS['sensor_row_0'], 4)
+        self.readBytesReg(self.REGS['sensor_row_0'], 4, self.PRIO_IRQ)
 
         # clear the interrupt, if any
-        status_val = self.readReg(self.REGS['status'])
-        self.writeReg(self.REGS['status'], status_val)
+        status_val = self.readReg(self.REGS['status'], self.PRIO_IRQ)
+        self.writeReg(self.REGS['status'], status_val, self.PRIO_IRQ)
 
         self.sensor_map = [0, 0, 0, 0]
         self.led_map = [0, 0, 0, 0]
 
     def leds_switch(self, led_map):
-        self.write(bytearray([self.REGS['led_row_0']] + led_map))
+        self.write(bytearray([self.REGS['led_row_0']] + led_map),
+                   self.PRIO_LEDS)
 
     def sensor_scan_switch(self, on):
         reg_change = [self.reg_bit_clear, self.reg_bit_set][on]
@@ -127,16 +286,16 @@ class HbController(Controller):
 
     # returns a bytearray
     def sensors_read(self):
-        sr = self.readBytesReg(self.REGS['sensor_row_0'], 4)
+        sr = self.readBytesReg(self.REGS['sensor_row_0'], 4, self.PRIO_IRQ)
         return [sr[0], sr[1], sr[2], sr[3]]
 
     # returns a bytearray
     def leds_read(self):
-        return self.readBytesReg(self.REGS['leds_row_0'], 4)
+        return self.readBytesReg(self.REGS['led_row_0'], 4, self.PRIO_LEDS)
 
     def _isr_handler(self):
-        status = self.readReg(self.REGS['status'])
-        self.writeReg(self.REGS['status'], status)
+        status = self.readReg(self.REGS['status'], self.PRIO_IRQ)
+        self.writeReg(self.REGS['status'], status, self.PRIO_IRQ)
 
         if status:
             self.cb((status & self.STATUS_SENSORS_CHANGED) != 0,
@@ -151,29 +310,101 @@ class CmdController(Controller):
 
     def _ctrlr_init(self):
         # switch off all command panel leds
-        self.writeReg(self.REGS['leds'], 0)
+        self.writeReg(self.REGS['leds'], 0, self.PRIO_LEDS)
 
         # reset button states
-        btns_state = self.readReg(self.REGS['buttons'])
-        self.writeReg(self.REGS['buttons'], btns_state)
+        btns_state = self.readReg(self.REGS['buttons'], self.PRIO_IRQ)
+        self.writeReg(self.REGS['buttons'], btns_state, self.PRIO_IRQ)
 
     def _isr_handler(self):
-        btns = self.readReg(self.REGS['buttons'])
-        self.writeReg(self.REGS['buttons'], btns)
+        btns = self.readReg(self.REGS['buttons'], self.PRIO_IRQ)
+        self.writeReg(self.REGS['buttons'], btns, self.PRIO_IRQ)
 
         self.cb(btns)
 
+    def leds_write(self, led_mask):
+        self.writeReg(self.REGS['leds'], led_mask, self.PRIO_LEDS)
+
     def leds_switch(self, led_mask, on):
         reg_cmd = [self.reg_bit_clear, self.reg_bit_set][on]
 
-        reg_cmd(self.REGS['leds'], led_mask)
+        reg_cmd(self.REGS['leds'], led_mask, self.PRIO_LEDS)
 
     def leds_toggle(self, led_mask):
-        leds = self.readReg(self.REGS['leds'])
+        leds = self.readReg(self.REGS['leds'], self.PRIO_LEDS)
 
         leds ^= led_mask
 
-        self.writeReg(self.REGS['leds'], leds)
+        self.writeReg(self.REGS['leds'], leds, self.PRIO_LEDS)
+
+
+# Host side model of a half board clock. It follows the commands sent to the
+# clock controller, so that the remaining time is known without reading it over
+# I2C, and it's corrected with the hardware clock from time to time.
+class SoftClock(object):
+    # read the hardware clock, when stopping it, at most this often
+    SYNC_PERIOD = 30
+
+    # the hardware clock shows whole seconds: tolerate this much more, in
+    # milliseconds, before correcting the model
+    MAX_DRIFT_MS = 250
+
+    def __init__(self, time_source):
+        self.time_source = time_source
+        self.remaining_ms = 0
+        self.started_at = None
+        self.synced_at = None
+
+    def set(self, min, sec):
+        now = self.time_source.now()
+
+        self.remaining_ms = (min * 60 + sec) * 1000
+        if self.started_at is not None:
+            self.started_at = now
+
+        self.synced_at = now
+
+    def start(self):
+        if self.started_at is None:
+            self.started_at = self.time_source.now()
+
+    def stop(self):
+        self.remaining_ms = self.remaining()
+        self.started_at = None
+
+    def expired(self):
+        self.remaining_ms = 0
+        self.started_at = None
+
+    def running(self):
+        return self.started_at is not None
+
+    def remaining(self):
+        remaining = self.remaining_ms
+
+        if self.started_at is not None:
+            remaining -= int((self.time_source.now() - self.started_at) * 1000)
+
+        return max(remaining, 0)
+
+    def needs_sync(self):
+        return self.synced_at is None or \
+            self.time_source.now() - self.synced_at >= self.SYNC_PERIOD
+
+    def sync(self, clock):
+        now = self.time_source.now()
+        hw_ms = (clock['min'] * 60 + clock['sec']) * 1000
+
+        remaining = self.remaining()
+        if remaining < hw_ms - self.MAX_DRIFT_MS or \
+                remaining >= hw_ms + 1000 + self.MAX_DRIFT_MS:
+            print("clock drift: %d ms" % (remaining - hw_ms))
+
+            self.remaining_ms = hw_ms + 500
+            if self.started_at is not None:
+                self.started_at = now
+
+        self.synced_at = now
 
 
 class EcbDriver(object):
@@ -202,37 +433,74 @@ class EcbDriver(object):
     CMD_LED_WIFI_ON = 1 << 6
     CMD_LED_BT_ON = 1 << 7
 
-    def __init__(self):
+    # priorities of the LED layers used by the LEDs API
+    LED_PRIORITY_STATIC = 0
+    LED_PRIORITY_BLINK = 10
+
+    # half period of leds_blink(), in seconds
+    LED_BLINK_TIMEOUT = 0.5
+
+    # time for the sensors to settle once scanning started, in seconds
+    SENSORS_SETTLE = 1
+
+    # (i2c address, interrupt pin) of the top half, bottom half and command
+    # panel controllers
+    DEFAULT_ADDRESSES = {
+        'top': (0x11, 31),
+        'bot': (0x12, 32),
+        'cmd': (0x13, 33)
+    }
+
+    def __init__(self, addresses=DEFAULT_ADDRESSES, i2c_bus=6,
+                 time_source=None):
+        self.time_source = time_source or MonotonicTime()
+
         self.sensors_changed_cb = None
         self.clock_expired_cb = None
         self.btn_pressed_cb = None
 
-        self.led_map = [0, 0, 0, 0, 0, 0, 0, 0]
         self.sensor_map = [0, 0, 0, 0, 0, 0, 0, 0]
 
         self.sensors_started = False
 
-        self.blink_onoff_map = [0, 0, 0, 0, 0, 0, 0, 0]
-        self.blink_offon_map = [0, 0, 0, 0, 0, 0, 0, 0]
-        self.blink_state = 0
-        self.blink_interval = None
+        self.sensor_health = SensorHealth(self.time_source)
+
+        # squares waiting for their debounce window: (timer, state before)
+        self.debounce_lock = Lock()
+        self.debounce_pending = {}
+
+        self.soft_clocks = [SoftClock(self.time_source),
+                            SoftClock(self.time_source)]
 
-        self.top = HbController(0x11, 31, self._top_int_cb)
-        self.bot = HbController(0x12, 32, self._bot_int_cb)
-        self.cmd = CmdController(0x13, 33, self._cmd_int_cb)
+        # expiry timers of the software clocks of the offline half boards
+        self.soft_clock_lock = RLock()
+        self.soft_clock_timers = [None, None]
 
-    def _set_interval(self, timer_function, timeout):
-        def interval_wrapper():
-            timer_function()
-            self._set_interval(timer_function, timeout)
+        # all controllers share the I2C bus
+        self.bus = I2cBus(self.time_source)
 
-        self.blink_interval = Timer(timeout, interval_wrapper)
-        self.blink_interval.start()
+        self.top = HbController(addresses['top'][0], addresses['top'][1],
+                                self._top_int_cb, i2c_bus, self.bus)
+        self.bot = HbController(addresses['bot'][0], addresses['bot'][1],
+                                self._bot_int_cb, i2c_bus, self.bus)
+        self.cmd = CmdController(addresses['cmd'][0], addresses['cmd'][1],
+                                 self._cmd_int_cb, i2c_bus, self.bus)
 
-    def _clear_interval(self):
-        if self.blink_interval is not None:
-            self.blink_interval.cancel()
-            self.blink_interval = None
+        # leds_on()/leds_off() use the static layer, leds_blink() the blink
+        # layers, which cover it
+        self.leds = LedCompositor(self.time_source, self._leds_write)
+        self.led_static = self.leds.layer(self.LED_PRIORITY_STATIC)
+        self.led_blink = self.leds.layer(self.LED_PRIORITY_BLINK)
+        self.led_blink_inverse = self.leds.layer(self.LED_PRIORITY_BLINK)
+
+        # the command panel LEDs are one row, written in one transaction
+        self.cmd_leds = LedCompositor(self.time_source, self._cmd_leds_write,
+                                      1, 1)
+        self.cmd_led_static = self.cmd_leds.layer(self.LED_PRIORITY_STATIC)
+        self.cmd_led_blink = self.cmd_leds.layer(self.LED_PRIORITY_BLINK)
+
+        for ctrl in [self.top, self.bot, self.cmd]:
+            ctrl.health_cb = self._ctrl_health_changed
 
     def _handle_sensor_changes(self, ctrl):
         def rows_to_squares(rows_list, ctrl):
@@ -257,11 +525,51 @@ class EcbDriver(object):
             changed_sensor_map[row] = old_sensor_map[row] ^ buf[row]
             self.sensor_map[row + row_offs] = buf[row]
 
-        if self.sensors_changed_cb is not None:
-            self.sensors_changed_cb(rows_to_squares(changed_sensor_map, ctrl))
+        self._sensors_changed(rows_to_squares(changed_sensor_map, ctrl))
+
+    def _sensor_state(self, square):
+        row = int(square[1]) - 1
+        col = self.SENSOR_COLUMNS.index(square[0])
+
+        return (self.sensor_map[row] >> col) & 1
+
+    # squares with a debounce window are reported only if they're still
+    # changed when the window ends
+    def _sensors_changed(self, squares):
+        self.sensor_health.toggled(squares)
+
+        changed = []
+        with self.debounce_lock:
+            for sq in squares:
+                if sq in self.debounce_pending:
+                    continue
+
+                window = self.sensor_health.debounce(sq)
+                if not window:
+                    changed.append(sq)
+                    continue
+
+                timer = self.time_source.timer(window, self._debounce_expired,
+                                               [sq])
+                self.debounce_pending[sq] = (timer,
+                                             self._sensor_state(sq) ^ 1)
+                timer.start()
+
+        if changed and self.sensors_changed_cb is not None:
+            self.sensors_changed_cb(changed)
+
+    def _debounce_expired(self, square):
+        with self.debounce_lock:
+            timer, state_before = self.debounce_pending.pop(square)
+            changed = self._sensor_state(square) != state_before
+
+        if changed and self.sensors_changed_cb is not None:
+            self.sensors_changed_cb([square])
 
     def _top_int_cb(self, sensors_changed, clock_expired):
         if clock_expired:
+            self.soft_clocks[self.CLOCK_TOP].expired()
+
             if self.clock_expired_cb is not None:
                 self.clock_expired_cb(self.CLOCK_TOP)
         else:
@@ -269,119 +577,151 @@ class EcbDriver(object):
 
     def _bot_int_cb(self, sensors_changed, clock_expired):
         if clock_expired:
+            self.soft_clocks[self.CLOCK_BOTTOM].expired()
+
             if self.clock_expired_cb is not None:
                 self.clock_expired_cb(self.CLOCK_BOTTOM)
         else:
             self._handle_sensor_changes(self.bot)
 
-    def _cmd_int_cb(self, btns):
-        if self.btns_pressed_cb is not None:
-            self.btns_pressed_cb(btns)
-
-    def _squares_to_map(self, squares_list):
-        rows_map = [0, 0, 0, 0, 0, 0, 0, 0]
+    # Without a half board, the board keeps going: its sensors keep their last
+    # state and its clock is the software clock. When it's back, its state is
+    # restored and the moves made meanwhile are reported.
+    def _ctrl_health_changed(self, ctrl, online):
+        if ctrl == self.cmd:
+            if online:
+                self.cmd_leds.refresh()
+            return
 
-        for sq in squares_list:
-            c = self.LED_COLUMNS.index(sq[0])
-            r = int(sq[1]) - 1
+        clock_id = [self.CLOCK_BOTTOM, self.CLOCK_TOP][ctrl == self.top]
 
-            rows_map[r] |= 1 << c
+        # the software clock stands in for the hardware one
+        self._soft_clock_watch(clock_id)
 
-        return rows_map
+        if not online:
+            return
 
-    def _leds_switch(self, new_led_map):
-        self.led_map = new_led_map
+        self.leds.refresh()
 
-        self.bot.leds_switch(new_led_map[0:4])
-        self.top.leds_switch(new_led_map[4:8])
+        soft_clock = self.soft_clocks[clock_id]
+        remaining_s = soft_clock.remaining() // 1000
+        ctrl.clock_set(remaining_s // 60, remaining_s % 60)
+        if soft_clock.running():
+            ctrl.clock_switch(1)
 
-    def _leds_on(self, on_led_map):
-        new_led_map = self.led_map
+        # the moves made meanwhile are reported once the sensors settle
+        if self.sensors_started:
+            ctrl.sensor_scan_switch(1)
+            self.time_source.timer(self.SENSORS_SETTLE, self._sensors_rescan,
+                                   [ctrl]).start()
 
-        for row in range(len(on_led_map)):
-            new_led_map[row] |= on_led_map[row]
+    def _sensors_rescan(self, ctrl):
+        if not ctrl.online or not self.sensors_started:
+            return
 
-        self._leds_switch(new_led_map)
+        try:
+            self._handle_sensor_changes(ctrl)
+        except ControllerError:
+            # offline again, rescanned when it's back
+            pass
 
-    def _leds_off(self, off_led_map):
-        new_led_map = self.led_map
+    # While a half board is offline, its clock expiry is signaled by its
+    # software clock. Called whenever the clock or the controller changes.
+    def _soft_clock_watch(self, clock_id):
+        ctrl = [self.top, self.bot][clock_id]
+        soft_clock = self.soft_clocks[clock_id]
 
-        for row in range(len(off_led_map)):
-            new_led_map[row] &= ~off_led_map[row]
+        with self.soft_clock_lock:
+            if self.soft_clock_timers[clock_id] is not None:
+                self.soft_clock_timers[clock_id].cancel()
+                self.soft_clock_timers[clock_id] = None
 
-        self._leds_switch(new_led_map)
+            if ctrl.online or not soft_clock.running():
+                return
 
-    def _leds_blink(self):
-        new_map = self.led_map
+            timer = self.time_source.timer(
+                soft_clock.remaining() / 1000.0, self._soft_clock_expired,
+                [clock_id])
+            self.soft_clock_timers[clock_id] = timer
+            timer.start()
 
-        for row in range(0, 8):
-            if self.blink_state:
-                new_map[row] |= self.blink_onoff_map[row]
-                new_map[row] &= ~self.blink_offon_map[row]
-            else:
-                new_map[row] &= ~self.blink_onoff_map[row]
-                new_map[row] |= self.blink_offon_map[row]
+    def _soft_clock_expired(self, clock_id):
+        ctrl = [self.top, self.bot][clock_id]
+        soft_clock = self.soft_clocks[clock_id]
 
-        self.blink_state ^= 1
-        self._leds_switch(new_map)
+        with self.soft_clock_lock:
+            self.soft_clock_timers[clock_id] = None
 
-    # set callbacks
-    def set_callbacks(self, sensors_changed_cb, clock_expired_cb, btns_pressed_cb):
-        self.sensors_changed_cb = sensors_changed_cb
-        self.clock_expired_cb = clock_expired_cb
-        self.btns_pressed_cb = btns_pressed_cb
+            if ctrl.online or not soft_clock.running():
+                return
 
-    # LEDs API
-    def leds_on(self, squares_list):
-        led_map = self._squares_to_map(squares_list)
+            # set again meanwhile
+            if soft_clock.remaining():
+                self._soft_clock_watch(clock_id)
+                return
 
-        self._leds_on(led_map)
+            soft_clock.expired()
 
-    def leds_off(self, squares_list):
-        led_map = self._squares_to_map(squares_list)
+        print("clock %d expired, on the software clock" % clock_id)
 
-        self._leds_off(led_map)
+        if self.clock_expired_cb is not None:
+            self.clock_expired_cb(clock_id)
 
-    def leds_blink(self, onoff_squares=None, offon_squares=None, timeout=0.5):
-        def switch_off_leftovers(old_map, new_map):
-            leftover_map = [0]*8
+    def _cmd_int_cb(self, btns):
+        if self.btns_pressed_cb is not None:
+            self.btns_pressed_cb(btns)
 
-            for row in range(0, 8):
-                leftover_map[row] = old_map[row] ^ new_map[row]
+    def _squares_to_map(self, squares_list):
+        rows_map = [0, 0, 0, 0, 0, 0, 0, 0]
 
-            self._leds_off(leftover_map)
+        for sq in squares_list:
+            c = self.LED_COLUMNS.index(sq[0])
+            r = int(sq[1]) - 1
 
-        if onoff_squares is None:
-            self._leds_off(self.blink_onoff_map)
-            self.blink_onoff_map = [0]*8
-        else:
-            new_map = self._squares_to_map(onoff_squares)
-            switch_off_leftovers(self.blink_onoff_map, new_map)
+            rows_map[r] |= 1 << c
 
-            self.blink_onoff_map = new_map
+        return rows_map
 
-        if offon_squares is None:
-            self._leds_off(self.blink_offon_map)
-            self.blink_offon_map = [0]*8
-        else:
-            new_map = self._squares_to_map(offon_squares)
-            switch_off_leftovers(self.blink_offon_map, new_map)
+    def _leds_write(self, first_row, rows):
+        ctrl = [self.bot, self.top][first_row == 4]
 
-            self.blink_offon_map = new_map
+        ctrl.leds_switch(rows)
 
-        if onoff_squares is None and offon_squares is None:
-            if self.blink_interval is not None:
-                self._clear_interval()
-                self.blink_interval = None
+    def _cmd_leds_write(self, first_row, rows):
+        self.cmd.leds_write(rows[0])
 
-            return
+    # set callbacks
+    def set_callbacks(self, sensors_changed_cb, clock_expired_cb, btns_pressed_cb):
+        self.sensors_changed_cb = sensors_changed_cb
+        self.clock_expired_cb = clock_expired_cb
+        self.btns_pressed_cb = btns_pressed_cb
 
-        # we're already blinking
-        if self.blink_interval is not None:
-            return
+    # LEDs API
+    def leds_on(self, squares_list):
+        self.led_static.add(self._squares_to_map(squares_list))
 
-        self.blink_state = 1
-        self.blink_interval = self._set_interval(self._leds_blink, timeout)
+    def leds_off(self, squares_list):
+        self.led_static.remove(self._squares_to_map(squares_list))
+
+    # a new LED layer, the higher priority layers cover the lower ones
+    def leds_layer(self, priority):
+        return self.leds.layer(priority)
+
+    # the squares in 'onoff_squares' blink in phase, the ones in
+    # 'offon_squares' in opposition, 'timeout' is the half period
+    def leds_blink(self, onoff_squares=None, offon_squares=None,
+                   timeout=None):
+        if timeout is None:
+            timeout = self.LED_BLINK_TIMEOUT
+        blinks = [(self.led_blink, onoff_squares, LedLayer.BLINK),
+                  (self.led_blink_inverse, offon_squares,
+                   LedLayer.BLINK_INVERSE)]
+
+        for layer, squares, mode in blinks:
+            if squares is None:
+                layer.clear()
+            else:
+                layer.set(self._squares_to_map(squares), mode, timeout * 2)
 
     # Sensors API
     def sensors_start(self):
@@ -396,33 +736,88 @@ class EcbDriver(object):
 
         self.sensors_started = False
 
+    # an offline half board reports its last known state
     def sensors_get(self):
-        self.sensor_map = self.bot.sensors_read() + self.top.sensors_read()
+        sensor_map = []
+        for ctrl, row_offs in [(self.bot, 0), (self.top, 4)]:
+            try:
+                sensor_map += ctrl.sensors_read()
+            except ControllerError:
+                sensor_map += self.sensor_map[row_offs:row_offs + 4]
+
+        self.sensor_map = sensor_map
         return self.sensor_map
 
     def sensors_running(self):
         return self.sensors_started
 
+    # squares in their debounce window, with their state before the window:
+    # the sensor map already has the new state, not yet reported
+    def sensors_debouncing(self):
+        with self.debounce_lock:
+            return dict([(sq, state_before) for sq, (timer, state_before)
+                         in self.debounce_pending.items()])
+
+    # per square sensor statistics
+    def sensors_health(self):
+        return self.sensor_health.report()
+
+    # whether the controllers are online
+    def controllers_health(self):
+        return {'top': self.top.online, 'bot': self.bot.online,
+                'cmd': self.cmd.online}
+
+    # the squares were involved in a board error
+    def sensors_error(self, squares):
+        self.sensor_health.error(squares)
+
     # Clock API
     def clock_set(self, clock_id, min, sec):
         ctrl = [self.top, self.bot][clock_id]
 
         ctrl.clock_set(min, sec)
+        self.soft_clocks[clock_id].set(min, sec)
+        self._soft_clock_watch(clock_id)
 
+    # reads the hardware clock, use clock_remaining() when possible; for an
+    # offline half board, returns the software clock
     def clock_get(self, clock_id):
         ctrl = [self.top, self.bot][clock_id]
 
-        return ctrl.clock_get()
+        try:
+            clock = ctrl.clock_get()
+        except ControllerError:
+            remaining_s = self.soft_clocks[clock_id].remaining() // 1000
+            return {'min': remaining_s // 60, 'sec': remaining_s % 60}
+
+        self.soft_clocks[clock_id].sync(clock)
+
+        return clock
+
+    # remaining time in milliseconds, from the software clock
+    def clock_remaining(self, clock_id):
+        return self.soft_clocks[clock_id].remaining()
+
+    def clock_running(self, clock_id):
+        return self.soft_clocks[clock_id].running()
 
     def clock_start(self, clock_id):
         ctrl = [self.top, self.bot][clock_id]
 
         ctrl.clock_switch(1)
+        self.soft_clocks[clock_id].start()
+        self._soft_clock_watch(clock_id)
 
     def clock_stop(self, clock_id):
         ctrl = [self.top, self.bot][clock_id]
 
         ctrl.clock_switch(0)
+        self.soft_clocks[clock_id].stop()
+        self._soft_clock_watch(clock_id)
+
+        # a stopped clock is a good moment to correct the software clock
+        if self.soft_clocks[clock_id].needs_sync():
+            self.clock_get(clock_id)
 
     def clock_blank(self, clock_id):
         ctrl = [self.top, self.bot][clock_id]
@@ -431,13 +826,32 @@ class EcbDriver(object):
 
     # Command panel API
     def btn_led_on(self, led_mask):
-        self.cmd.leds_switch(led_mask, 1)
+        self.cmd_led_static.add([led_mask])
 
     def btn_led_off(self, led_mask):
-        self.cmd.leds_switch(led_mask, 0)
+        self.cmd_led_static.remove([led_mask])
 
     def btn_led_toggle(self, led_mask):
-        self.cmd.leds_toggle(led_mask)
+        self.cmd_led_static.toggle([led_mask])
+
+    # sets the LEDs in 'affected_mask' to their value in 'led_mask', with a
+    # single register write
+    def btn_leds_set(self, led_mask, affected_mask=0xff):
+        with self.cmd_leds.lock:
+            old_mask = self.cmd_led_static.led_map[0]
+
+            self.cmd_led_static.set([(old_mask & ~affected_mask) |
+                                     (led_mask & affected_mask)])
+
+    # blinks the LEDs in 'led_mask' over the steady ones, 'exclusive' hides
+    # all the other LEDs while blinking; an empty mask stops blinking
+    def btn_led_blink(self, led_mask, period=1.0, exclusive=False):
+        if not led_mask:
+            self.cmd_led_blink.clear()
+            return
+
+        self.cmd_led_blink.set([led_mask], LedLayer.BLINK, period,
+                               [None, [0xff]][exclusive])
 
 
 if __name__ == "__main__":
@@ -450,7 +864,6 @@ if __name__ == "__main__":
     def btns_pressed_cb(btns):
         print("buttons pressed called: %d" % btns)
 
-    import time
     driver = EcbDriver()
     driver.set_callbacks(sensors_changed_cb, clock_expired_cb, btns_pressed_cb)
     driver.sensors_start()
@@ -19,41 +19,25 @@
 #
 
 from EcbDriver import EcbDriver
+from EcbGameStore import GameStore
+from EcbMemory import MemoryBudget
+from EcbAnalysis import AnalysisHandler, Analyzer
+from EcbTimeManager import TimeManager
+from EcbPonder import PonderController
+from EcbMoveCache import MoveCache
+from EcbWorker import ChessOps
+import EcbBitboard
+import EcbMetrics
 import chess
-import chess.uci
-import chess.polyglot
 import Queue
-from threading import Timer
-import struct
+import bisect
+import collections
+import itertools
+import random
+from threading import Lock, Timer
 import logging
 
 
-class MyHandler(chess.uci.InfoHandler):
-    def post_info(self):
-        super(MyHandler, self).post_info()
-#        print(self.info)
-
-
-class Interval(object):
-    def __init__(self, timeout, timer_function, args):
-        self.timeout = timeout
-        self.timer_function = timer_function
-        self.args = args
-        self.timer = None
-
-    def start(self):
-        def wrapper():
-            self.timer_function(self.args)
-            self.start()
-
-        self.timer = Timer(self.timeout, wrapper)
-        self.timer.start()
-
-    def cancel(self):
-        if self.timer is not None:
-            self.timer.cancel()
-
-
 def set_interval(timeout, timer_function, args):
     def interval_wrapper():
         timer_function(args)
@@ -74,15 +58,25 @@ class State(object):
 
 
 class Event(object):
+    __slots__ = ['event_id', 'event_description']
+
+    # all events, indexed by their id
+    events = []
+
     def __init__(self, event_description):
+        self.event_id = len(Event.events)
         self.event_description = event_description
 
+        Event.events.append(self)
+
     def __str__(self):
         return self.event_description
 
 Event.sensors_changed = Event("sensors changed")
 Event.clock_expired = Event("clock expired")
 
+Event.sensors_settled = Event("sensors settled after scanning started")
+
 Event.game_config_btn = Event("one of the config buttons was pressed")
 Event.game_start_btn = Event("start game button was pressed")
 Event.game_started = Event("game started")
@@ -104,21 +98,83 @@ Event.engine_move_ended = Event("engine piece was moved")
 Event.promotion_started = Event("piece promotion started")
 Event.promotion_ended = Event("piece promotion ended")
 
-Event.pondering_finished = Event("engine finished pondering")
-
 Event.on_web_connect = Event("web client connected")
 Event.on_web_disconnect = Event("web client disconnected")
 Event.on_web_square_set = Event("a piece on a square has been set in web client")
 Event.on_web_square_unset = Event("a piece on a square has been unset in web client")
 Event.on_web_board_setup_done = Event("custom board setup finished")
+Event.setup_leds_tick = Event("custom board setup LEDs may be refreshed")
+
+
+FSM_EVENT_SECONDS = EcbMetrics.histogram(
+    'ecb_fsm_event_seconds', 'Time spent handling an event.',
+    ['state', 'event'])
+FSM_QUEUE_WAIT_SECONDS = EcbMetrics.histogram(
+    'ecb_fsm_queue_wait_seconds', 'Time events spend in the event queue.')
+ENGINE_THINK_SECONDS = EcbMetrics.histogram(
+    'ecb_engine_think_seconds', 'Time from go to bestmove.',
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+ENGINE_NPS = EcbMetrics.gauge(
+    'ecb_engine_nps', 'Nodes per second of the last engine search.')
+BOARD_RESYNCS = EcbMetrics.counter(
+    'ecb_board_resyncs_total',
+    'Sensor reads done to confirm a board mismatch.')
+WEB_EVENTS_DROPPED = EcbMetrics.counter(
+    'ecb_web_events_dropped_total',
+    'Web client events dropped, the event queue being full.')
+
+
+# typed event payloads
+MoveStartedData = collections.namedtuple('MoveStartedData',
+                                         ['from_sq', 'legal_moves'])
+MoveEndedData = collections.namedtuple('MoveEndedData',
+                                       ['to_sq', 'promotion'])
+EngineMoveData = collections.namedtuple('EngineMoveData',
+                                        ['bestmove', 'pondermove'])
+
+
+# An event waiting in the event queue. Records are recycled through a free
+# list, so that the high frequency events don't allocate on every put.
+class EventRecord(object):
+    __slots__ = ['event', 'event_data', 'queued_at']
+
+    POOL_SIZE = 64
+    pool = []
+
+    @staticmethod
+    def get(event, event_data):
+        try:
+            record = EventRecord.pool.pop()
+        except IndexError:
+            record = EventRecord()
+
+        record.event = event
+        record.event_data = event_data
+
+        return record
+
+    def release(self):
+        self.event = None
+        self.event_data = None
+
+        if len(EventRecord.pool) < EventRecord.POOL_SIZE:
+            EventRecord.pool.append(self)
 
 
 class StateMachine(object):
     def __init__(self, initial_state):
-        self.current_state = initial_state
+        # states keep per game data, so every machine gets its own instances
+        self.states = {}
+        self.current_state = self._state(initial_state)
+
+    def _state(self, state_class):
+        if state_class not in self.states:
+            self.states[state_class] = state_class()
+
+        return self.states[state_class]
 
     def handle(self, ecb, event, event_data):
-        self.current_state = self.current_state.next(event)
+        self.current_state = self._state(self.current_state.next(event))
         self.current_state.run(ecb, event, event_data)
 
 
@@ -163,81 +219,114 @@ class Starting(State):
     POSITION_NEW = 0
     POSITION_CUSTOM = 1
 
-    def _bits_in_byte(self, byte):
-        half_byte_map = [0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4]
+    # while a custom position is set up, the LEDs are refreshed at most once
+    # per tick
+    LEDS_TICK = 0.1
 
-        low_byte_bits = half_byte_map[byte & 0xf]
-        high_byte_bits = half_byte_map[(byte & 0xf0) >> 4]
+    def __init__(self):
+        self.ignore_sensor_events = False
+        self.position_type = None
+
+        # custom position: the occupied squares not set in the web client
+        # yet, and the ones set
+        self.unresolved_bb = EcbBitboard.BB_EMPTY
+        self.placed_bb = EcbBitboard.BB_EMPTY
+
+        # the squares of a rejected setup, blinking until the next edit
+        self.error_bb = EcbBitboard.BB_EMPTY
+
+        # the squares blinking, None if unknown, and whether a tick is running
+        self.leds_bb = None
+        self.leds_tick = False
+
+    def _reset(self):
+        self.position_type = None
+        self.unresolved_bb = EcbBitboard.BB_EMPTY
+        self.placed_bb = EcbBitboard.BB_EMPTY
+        self.error_bb = EcbBitboard.BB_EMPTY
+        self.leds_bb = None
+        self.leds_tick = False
+
+    # blinks the unresolved squares: the first change at once, the ones
+    # following it within a tick together, when the tick ends
+    def _leds_refresh(self, ecb):
+        blink_bb = self.unresolved_bb | self.error_bb
+        if self.leds_tick or blink_bb == self.leds_bb:
+            return
 
-        return low_byte_bits + high_byte_bits
+        self.leds_bb = blink_bb
+        ecb.driver.leds_blink(None, EcbBitboard.to_squares(self.leds_bb))
 
-    def _get_chessmen_no(self, sensors_map):
-        chessmen_no = 0
-        for row in range(0, 8):
-            chessmen_no += self._bits_in_byte(sensors_map[row])
+        self.leds_tick = True
+        ecb.time_source.timer(self.LEDS_TICK, ecb.post_event,
+                              [Event.setup_leds_tick]).start()
 
-        return chessmen_no
+    def _leds_blink(self, ecb, squares=None):
+        self.leds_bb = None
+        ecb.driver.leds_blink(squares)
 
-    def _detect_position_type(self, sensors_map):
-        chessmen_no = self._get_chessmen_no(sensors_map)
+    def _detect_position_type(self, sensors_bb):
+        chessmen_no = EcbBitboard.popcount(sensors_bb)
         print("detected %d chessmen" % chessmen_no)
 
-        if chessmen_no > 25 and not sensors_map[2] and not sensors_map[3] and \
-                not sensors_map[4] and not sensors_map[5]:
+        if chessmen_no > 25 and not sensors_bb & EcbBitboard.BB_MIDDLE:
             return self.POSITION_NEW
 
         return self.POSITION_CUSTOM
 
-    def _new_game_unknown_squares(self, ecb, sensors_map):
-        initial_pos_rows = [0, 1, 6, 7]
-        unknown_squares = []
-
-        for i in range(0, 4):
-            row_pos = initial_pos_rows[i]
-            row_val = ~(sensors_map[initial_pos_rows[i]])
-
-            unknown_squares += ecb.row_to_squares(row_pos, row_val)
-
-        return unknown_squares
-
     def _attempt_start(self, ecb):
         self.ignore_sensor_events = False
-        sensors_map = ecb.driver.sensors_get()
+        sensors_bb = ecb.sensors_sync()
+        sensors_map = EcbBitboard.to_rows(sensors_bb)
         print(str(sensors_map))
-        self.position_type = self._detect_position_type(sensors_map)
+        self.position_type = self._detect_position_type(sensors_bb)
 
         if ecb.sio is not None and self.position_type != self.POSITION_NEW and\
                 ecb.custom_fen is None:
             ecb.sio.emit("sensors_map", sensors_map)
 
         if self.position_type == self.POSITION_NEW:
-            unknown_squares = self._new_game_unknown_squares(ecb, sensors_map)
+            unknown_squares = EcbBitboard.to_squares(EcbBitboard.BB_START &
+                                                     ~sensors_bb)
             if len(unknown_squares):
-                ecb.driver.leds_blink(unknown_squares)
+                self._leds_blink(ecb, unknown_squares)
                 return
 
             ecb.board = chess.Board(chess.STARTING_FEN)
         else:
             print("Custom position...")
 
-            if ecb.custom_fen is not None:
-                ecb.board = chess.Board(ecb.custom_fen)
-            else:
-                self.custom_squares = ecb.sensor_map_to_squares(sensors_map)
-                ecb.driver.leds_blink(None, self.custom_squares)
+            if ecb.custom_fen is None:
+                # a chessman taken off the board is taken off in the web
+                # client too
+                self.error_bb = EcbBitboard.BB_EMPTY
+                self.placed_bb &= sensors_bb
+                self.unresolved_bb = sensors_bb & ~self.placed_bb
+                self._leds_refresh(ecb)
+
+                return
 
+            # the board changed since the setup: blink the differences
+            self.unresolved_bb = \
+                EcbBitboard.from_fen(ecb.custom_fen) ^ sensors_bb
+            if self.unresolved_bb:
+                self._leds_refresh(ecb)
                 return
 
+            ecb.board = chess.Board(ecb.custom_fen)
+
         if ecb.sio is not None:
             ecb.sio.emit("start_game", ecb.board.fen())
 
-        ecb.driver.leds_blink()
+        self._leds_blink(ecb)
 
         if ecb.game_config.level != GameConfig.LEVEL_DISABLED:
             print("Play against engine. Starting engine...")
-            ecb.opening_book = chess.polyglot.MemoryMappedReader(ecb.path_to_opening_book)
-            ecb.engine = chess.uci.popen_engine(ecb.path_to_engine)
-            ecb.info_handler = MyHandler()
+            ecb.chess_ops.book_open(ecb.path_to_opening_book)
+            ecb.engine = ecb.engine_open()
+            ecb.info_handler = AnalysisHandler(ecb._analysis_emit,
+                                               ecb.ANALYSIS_MAX_RATE,
+                                               ecb.time_source)
             ecb.engine.info_handlers.append(ecb.info_handler)
             ecb.engine.uci()
 
@@ -249,13 +338,14 @@ class Starting(State):
             print("setting engine skill to %d." % skill_level)
             ecb.engine.setoption({
                 'skill level': skill_level,
-                'threads': 2
+                'threads': ecb.ENGINE_THREADS,
+                'hash': ecb.memory_budget.engine_hash_mb()
             })
             ecb.engine.ucinewgame()
         else:
             print("Play against human.")
 
-        ecb.event_queue.put((Event.game_started, None))
+        ecb.post_event(Event.game_started, None)
 
     def run(self, ecb, event, event_data):
         print("starting: " + str(event))
@@ -263,35 +353,104 @@ class Starting(State):
             ecb.game_config.update(ecb.driver)
             ecb.driver.sensors_start()
 
+            self._reset()
+
             # we need a small delay for the sensors to settle
             self.ignore_sensor_events = True
-            Timer(1, self._attempt_start, [ecb]).start()
+            ecb.time_source.timer(ecb.driver.SENSORS_SETTLE, ecb.post_event,
+                                  [Event.sensors_settled]).start()
 
             if ecb.sio is not None:
                 ecb.sio.emit("setup_game")
 
-        if event == Event.sensors_changed and not self.ignore_sensor_events:
+        if event == Event.sensors_settled or\
+                (event == Event.sensors_changed and
+                 not self.ignore_sensor_events):
             self._attempt_start(ecb)
 
         if event == Event.on_web_connect:
             if ecb.sio is not None:
                 ecb.sio.emit("setup_game")
 
-                if self.position_type != self.POSITION_NEW and\
+                if self.position_type == self.POSITION_CUSTOM and\
                         ecb.custom_fen is None:
-                    ecb.sio.emit("sensors_map", ecb.driver.sensors_get())
+                    ecb.sio.emit("sensors_map",
+                                 EcbBitboard.to_rows(ecb.sensors_bb))
 
         if event == Event.on_web_square_set:
-            self.custom_squares.pop(self.custom_squares.index(event_data))
-            ecb.driver.leds_blink(None, self.custom_squares)
+            squares_bb = self._web_squares(event_data)
+            self.error_bb = EcbBitboard.BB_EMPTY
+            self.placed_bb |= squares_bb
+            self.unresolved_bb &= ~squares_bb
+            self._leds_refresh(ecb)
 
         if event == Event.on_web_square_unset:
-            self.custom_squares.append(event_data)
-            ecb.driver.leds_blink(None, self.custom_squares)
+            squares_bb = self._web_squares(event_data)
+            self.error_bb = EcbBitboard.BB_EMPTY
+            self.placed_bb &= ~squares_bb
+            self.unresolved_bb |= squares_bb & ecb.sensors_bb
+            self._leds_refresh(ecb)
+
+        if event == Event.setup_leds_tick:
+            self.leds_tick = False
+            if self.position_type == self.POSITION_CUSTOM:
+                self._leds_refresh(ecb)
 
         if event == Event.on_web_board_setup_done:
-            ecb.custom_fen = event_data
-            self._attempt_start(ecb)
+            self._web_setup_done(ecb, event_data)
+
+    # the web client sends one square, or a list of them; anything else is
+    # ignored
+    def _web_squares(self, squares):
+        if not isinstance(squares, list):
+            squares = [squares]
+
+        return EcbBitboard.from_squares(
+            [square for square in squares
+             if isinstance(square, EcbBitboard.string_types) and
+             square in EcbBitboard.SQUARE_NAMES])
+
+    # the FEN's placement is checked against the sensors, the position
+    # itself only if they match
+    def _web_setup_done(self, ecb, fen):
+        if self.position_type != self.POSITION_CUSTOM:
+            return
+
+        try:
+            fen_bb = EcbBitboard.from_fen(fen)
+        except ValueError as e:
+            self._setup_error(ecb, str(e))
+            return
+
+        if fen_bb != ecb.sensors_bb:
+            self._setup_error(ecb, "the position doesn't match the board",
+                              fen_bb ^ ecb.sensors_bb)
+            return
+
+        try:
+            valid = chess.Board(fen).is_valid()
+        except ValueError:
+            valid = False
+
+        if not valid:
+            self._setup_error(ecb, "invalid position: " + fen)
+            return
+
+        ecb.custom_fen = fen
+        self._attempt_start(ecb)
+
+    # tells the web client why the setup was rejected, and blinks the
+    # squares at fault
+    def _setup_error(self, ecb, message, squares_bb=EcbBitboard.BB_EMPTY):
+        squares = EcbBitboard.to_squares(squares_bb)
+        print("setup: %s %s" % (message, squares))
+
+        if ecb.sio is not None:
+            ecb.sio.emit("setup_error", {'message': message,
+                                         'squares': squares})
+
+        self.error_bb = squares_bb
+        self._leds_refresh(ecb)
 
     def next(self, event):
         if event == Event.game_started:
@@ -320,15 +479,19 @@ class Stopping(State):
                                  ecb.game_config.time['min'], 0)
 
             if ecb.game_config.level != GameConfig.LEVEL_DISABLED:
+                ecb.analyzer.stop()
+                ecb.ponder.cancel()
                 if ecb.engine is not None:
                     ecb.engine.quit()
-                if ecb.opening_book is not None:
-                    ecb.opening_book.close()
+                ecb.chess_ops.book_close()
+                if ecb.move_cache is not None:
+                    ecb.move_cache.save()
 
             ecb.board = None
             ecb.custom_fen = None
+            ecb.clock_emit()
 
-            ecb.event_queue.put((Event.game_stopped, None))
+            ecb.post_event(Event.game_stopped, None)
 
     def next(self, event):
         if event == Event.game_stopped:
@@ -338,32 +501,29 @@ class Stopping(State):
 
 
 class Game(State):
-    def _get_legal_moves(self, board, square):
-        legal_moves = []
-
-        for move in board.legal_moves:
-            if square == chess.SQUARE_NAMES[move.from_square]:
-                legal_moves.append(chess.SQUARE_NAMES[move.to_square])
+    def _handle_game_started(self, ecb, event_data):
+        ecb.game_ended = False
 
-        return legal_moves
+        ecb.time_manager.reset(ecb.game_config.time['min'],
+                               ecb.game_config.TIME_INCREMENT,
+                               ecb.game_config.TIME_MOVES_TO_GO or None)
 
-    def _handle_game_started(self, ecb, event_data):
-        if ecb.game_config.use_time_control():
-            ecb.driver.clock_start(ecb.board.turn)
-        else:
+        if not ecb.game_config.use_time_control():
             ecb.driver.clock_blank(not ecb.board.turn)
-            ecb.driver.clock_set(ecb.board.turn, 0, 0)
 
-        self.pondermove = None
+        ecb.clock_start(ecb.board.turn)
+
         if ecb.board.turn == ecb.game_config.opp_color and\
                 ecb.game_config.level != GameConfig.LEVEL_DISABLED:
             ecb.engine_go()
+        else:
+            ecb.analysis_start()
 
         ecb.driver.btn_led_on(EcbDriver.CMD_LED_START)
 
     def _handle_sensors_changed(self, ecb, event_data):
         if len(event_data) != 1:
-            ecb.event_queue.put((Event.invalid_squares, event_data))
+            ecb.post_event(Event.invalid_squares, event_data)
             return
 
         # ignore events from engine pieces
@@ -377,72 +537,57 @@ class Game(State):
         if ecb.chessman_detected(event_data[0]):
             return
 
-        legal_moves = self._get_legal_moves(ecb.board, event_data[0])
+        legal_moves = ecb.chess_ops.legal_moves(ecb.board, event_data[0])
 
         # of piece cannot be moved, just return
         if len(legal_moves) == 0:
             return
 
-        move_started_ev_data = {
-            'from': event_data,
-            'legal_moves': legal_moves
-        }
-        ecb.event_queue.put((Event.move_started, move_started_ev_data))
+        ecb.post_event(Event.move_started,
+                       MoveStartedData(event_data[0], legal_moves))
 
     def _handle_move_ended(self, ecb, event_data):
-        to_sq = chess.SQUARE_NAMES.index(event_data[0])
-        promotion = event_data[1]
+        to_sq = chess.SQUARE_NAMES.index(event_data.to_sq)
+        promotion = event_data.promotion
 
         move = chess.Move(from_square=self.from_sq,
                           to_square=to_sq,
                           promotion=promotion)
 
-        if ecb.game_config.use_time_control():
-            ecb.driver.clock_stop(ecb.board.turn)
-            ecb.time[ecb.board.turn] = ecb.driver.clock_get(ecb.board.turn)
-        else:
-            ecb.driver.clock_blank(ecb.board.turn)
+        ecb.clock_stop(ecb.board.turn, moved=True)
 
         ecb.board.push(move)
 
         if ecb.sio is not None:
             ecb.sio.emit('board_update', ecb.board.fen())
 
-        if ecb.board.is_game_over():
-            ecb.event_queue.put((Event.game_over, None))
+        if ecb.chess_ops.game_over(ecb.board):
+            ecb.post_event(Event.game_over, None)
             return
 
         if ecb.board.turn == ecb.game_config.opp_color and \
                 ecb.game_config.level != GameConfig.LEVEL_DISABLED:
-            if ecb.pondering_result is not None:
-                ecb.pondering_result = None
-                if move == ecb.pondermove:
-                    ecb.event_queue.put((Event.engine_move_started,
-                                        (ecb.pondering_result[0],
-                                         ecb.pondering_result[1])))
-                else:
-                    ecb.engine_go()
+            outcome, result = ecb.ponder.opponent_moved(move)
 
-            elif ecb.pondering_on and move == ecb.pondermove:
+            if outcome == PonderController.PONDER_HIT_DONE:
+                print("we've got a ponderhit, reusing the ponder result")
+                ecb.inject_event(Event.engine_move_started,
+                                 EngineMoveData(*result))
+            elif outcome == PonderController.PONDER_HIT:
                 print("we've got a ponderhit")
                 ecb.engine.ponderhit()
             else:
-                if ecb.pondering_on:
+                if outcome == PonderController.PONDER_MISS:
                     print("we've got a ponder miss")
-                    ecb.pondering_on = False
-                    ecb.engine_ignore_callback = True
                     ecb.engine.stop()
 
                 ecb.engine_go()
 
-        if ecb.game_config.use_time_control():
-            ecb.driver.clock_start(ecb.board.turn)
-        else:
-            ecb.driver.clock_set(ecb.board.turn, 0, 0)
+        ecb.clock_start(ecb.board.turn)
 
         invalid_squares_list = ecb.validate_board()
         if (len(invalid_squares_list)):
-            ecb.event_queue.put((Event.invalid_squares, invalid_squares_list))
+            ecb.post_event(Event.invalid_squares, invalid_squares_list)
 
     def _handle_game_config_btn(self, ecb, event_data):
         if not event_data & EcbDriver.CMD_BTN_MODE:
@@ -452,30 +597,25 @@ class Game(State):
         ecb.game_config.update_leds(ecb.driver)
 
     def _handle_engine_move_ended(self, ecb):
-        if ecb.board.is_game_over():
-            ecb.event_queue.put((Event.game_over, None))
+        if ecb.chess_ops.game_over(ecb.board):
+            ecb.post_event(Event.game_over, None)
         else:
+            ecb.analysis_start()
+
             invalid_squares = ecb.validate_board()
             if (len(invalid_squares)):
-                ecb.event_queue.put((Event.invalid_squares, invalid_squares))
-
-    def _handle_pondering_finished(self, ecb, event_data):
-        if ecb.game_config.level != GameConfig.LEVEL_DISABLED:
-            if ecb.board.turn == ecb.game_config.opp_color:
-                ecb.event_queue.put((Event.engine_move_started,
-                                     (event_data[0], event_data[1])))
-            else:
-                ecb.pondering_result = event_data
+                ecb.post_event(Event.invalid_squares, invalid_squares)
 
     def _handle_error_end(self, ecb, event_data):
         # In case the engine finished while we were in an error condition,
         # re-send the event.
         if event_data is not None:
-            ecb.event_queue.put((Event.engine_move_started, event_data))
+            ecb.post_event(Event.engine_move_started, event_data)
 
     def _handle_on_web_connect(self, ecb):
         if ecb.sio is not None:
             ecb.sio.emit('start_game', ecb.board.fen())
+            ecb.clock_emit()
 
     def run(self, ecb, event, event_data):
         print("game: " + str(event))
@@ -495,9 +635,6 @@ class Game(State):
         if event == Event.engine_move_ended:
             self._handle_engine_move_ended(ecb)
 
-        if event == Event.pondering_finished:
-            self._handle_pondering_finished(ecb, event_data)
-
         if event == Event.error_end:
             self._handle_error_end(ecb, event_data)
 
@@ -534,8 +671,8 @@ class Move(State):
         return False
 
     def _handle_move_started(self, ecb, event_data):
-        self.sq_from = event_data['from'][0]
-        self.legal_moves = event_data['legal_moves']
+        self.sq_from = event_data.from_sq
+        self.legal_moves = event_data.legal_moves
 
         ecb.driver.leds_blink([self.sq_from])
 
@@ -545,7 +682,7 @@ class Move(State):
     def _handle_sensors_changed(self, ecb, event_data):
         def debounce_move():
             if self.sq_from == self.sq_to:
-                ecb.event_queue.put((Event.move_aborted, None))
+                ecb.post_event(Event.move_aborted, None)
                 ecb.driver.leds_off(self.legal_moves)
                 ecb.driver.leds_blink()
                 return
@@ -554,9 +691,10 @@ class Move(State):
             ecb.driver.leds_blink()
 
             if self._is_promotion(ecb, self.sq_from, self.sq_to):
-                ecb.event_queue.put((Event.promotion_started, self.sq_to))
+                ecb.post_event(Event.promotion_started, self.sq_to)
             else:
-                ecb.event_queue.put((Event.move_ended, (self.sq_to, None)))
+                ecb.post_event(Event.move_ended,
+                               MoveEndedData(self.sq_to, None))
 
         try:
             self.timer.cancel()
@@ -564,7 +702,7 @@ class Move(State):
             pass
 
         if len(event_data) != 1:
-            ecb.event_queue.put((Event.invalid_squares, event_data))
+            ecb.post_event(Event.invalid_squares, event_data)
             return
 
         if event_data[0] != self.sq_from and\
@@ -583,7 +721,7 @@ class Move(State):
 
         ecb.driver.leds_on([self.sq_to])
 
-        self.timer = Timer(1, debounce_move)
+        self.timer = ecb.time_source.timer(ecb.MOVE_DEBOUNCE, debounce_move)
         self.timer.start()
 
     def run(self, ecb, event, event_data):
@@ -595,9 +733,6 @@ class Move(State):
         if event == Event.sensors_changed:
             self._handle_sensors_changed(ecb, event_data)
 
-        if event == Event.pondering_finished:
-            ecb.pondering_result = event_data
-
     def next(self, event):
         if event == Event.move_ended:
             return Ecb.game
@@ -620,14 +755,12 @@ class EngineMove(State):
             chess.KNIGHT: EcbDriver.CMD_LED_START,
         }
 
-        self.promotion_interval = Interval(0.5,
-                                           ecb.driver.btn_led_toggle,
-                                           promotion_led_map[chess_piece_type])
-        self.promotion_interval.start()
+        ecb.driver.btn_led_blink(promotion_led_map[chess_piece_type],
+                                 exclusive=True)
 
     def _handle_engine_move_started(self, ecb, event_data):
-        bestmove = event_data[0]
-        pondermove = event_data[1]
+        bestmove = event_data.bestmove
+        pondermove = event_data.pondermove
 
         self.from_sq = chess.SQUARE_NAMES[bestmove.from_square]
         self.to_sq = chess.SQUARE_NAMES[bestmove.to_square]
@@ -635,11 +768,7 @@ class EngineMove(State):
 
         ecb.driver.leds_blink([self.from_sq], [self.to_sq])
 
-        if ecb.game_config.use_time_control():
-            ecb.driver.clock_stop(ecb.board.turn)
-            ecb.time[ecb.board.turn] = ecb.driver.clock_get(ecb.board.turn)
-        else:
-            ecb.driver.clock_blank(ecb.board.turn)
+        ecb.clock_stop(ecb.board.turn, moved=True)
 
         ecb.board.push(bestmove)
 
@@ -647,22 +776,19 @@ class EngineMove(State):
             ecb.sio.emit('board_update', ecb.board.fen())
 
         if self.promotion is not None:
-            ecb.driver.btn_led_off(0xff)
             self._signal_promotion(ecb, self.promotion)
 
-        if pondermove is not None and\
+        # pondering would keep a shared engine busy until the human moves
+        if pondermove is not None and ecb.engine_pool is None and\
                 ecb.game_config.level == GameConfig.LEVEL_7:
             print("activate pondering for: " + str(pondermove.uci()))
             ecb.engine_go(pondermove)
 
-        if ecb.game_config.use_time_control():
-            ecb.driver.clock_start(ecb.board.turn)
-        else:
-            ecb.driver.clock_set(ecb.board.turn, 0, 0)
+        ecb.clock_start(ecb.board.turn)
 
     def _handle_sensors_changed(self, ecb, event_data):
         if len(event_data) != 1:
-            ecb.event_queue.put((Event.invalid_squares, event_data))
+            ecb.post_event(Event.invalid_squares, event_data)
             return
 
         if event_data[0] == self.from_sq:
@@ -672,10 +798,9 @@ class EngineMove(State):
             ecb.driver.leds_blink()
 
             if self.promotion is not None:
-                self.promotion_interval.cancel()
-                ecb.game_config.update_leds(ecb.driver)
+                ecb.driver.btn_led_blink(0)
 
-            ecb.event_queue.put((Event.engine_move_ended, None))
+            ecb.post_event(Event.engine_move_ended, None)
 
     def run(self, ecb, event, event_data):
         print("EngineMove: " + str(event))
@@ -685,9 +810,6 @@ class EngineMove(State):
         if event == Event.sensors_changed:
             self._handle_sensors_changed(ecb, event_data)
 
-        if event == Event.pondering_finished:
-            ecb.pondering_result = event_data
-
     def next(self, event):
         if event == Event.engine_move_ended:
             return Ecb.game
@@ -703,11 +825,45 @@ class GameEnd(State):
         ['a1', 'b1', 'c1', 'd1', 'e1', 'f1', 'g1', 'h1']
     ]
 
+    def _save_game(self, ecb, result):
+        if ecb.game_store is None:
+            return
+
+        players = ['Player', 'Player']
+        if ecb.game_config.level != GameConfig.LEVEL_DISABLED:
+            players[ecb.game_config.opp_color] = \
+                "Stockfish (level %d)" % ecb.game_config.level
+
+        ecb.game_store.save(ecb.board, result, {
+            'White': players[chess.WHITE],
+            'Black': players[chess.BLACK]
+        })
+
     def run(self, ecb, event, event_data):
         print("GameEnd: " + str(event))
+
+        if event == Event.on_web_connect:
+            ecb.clock_emit()
+
+        # the game ends once: a clock still running may expire later
+        if event not in [Event.clock_expired, Event.game_over] or \
+                ecb.game_ended:
+            return
+
+        ecb.game_ended = True
+        ecb.analyzer.stop()
+
+        if ecb.game_config.use_time_control():
+            for color in [chess.WHITE, chess.BLACK]:
+                ecb.driver.clock_stop(color)
+
+        # the clocks changed for the last time
+        ecb.clock_emit()
+
         if event == Event.clock_expired:
 
             ecb.driver.leds_blink(self.winner_blinking_leds[not ecb.board.turn])
+            self._save_game(ecb, ['1-0', '0-1'][ecb.board.turn])
 
         if event == Event.game_over:
             if ecb.board.is_checkmate():
@@ -716,6 +872,8 @@ class GameEnd(State):
                 ecb.driver.leds_blink(self.winner_blinking_leds[0] +
                                       self.winner_blinking_leds[1])
 
+            self._save_game(ecb, ecb.board.result())
+
     def next(self, event):
         if event == Event.game_start_btn:
             return Ecb.stopping
@@ -726,27 +884,28 @@ class GameEnd(State):
 class GameError(State):
     def __init__(self):
         self.engine_move = None
+        self.invalid_bb = EcbBitboard.BB_EMPTY
 
+    # the invalid squares are a bitboard, every sensor change toggles its
+    # squares in or out
     def _handle_invalid_squares(self, ecb, event_data):
-        self.sq_list = event_data
+        self.invalid_bb = EcbBitboard.from_squares(event_data)
+        ecb.driver.sensors_error(event_data)
         ecb.driver.leds_blink(event_data, timeout=1)
 
     def _handle_sensors_changed(self, ecb, event_data):
-        for sq in event_data:
-            if sq in self.sq_list:
-                self.sq_list.pop(self.sq_list.index(sq))
-            else:
-                self.sq_list.append(sq)
+        self.invalid_bb ^= EcbBitboard.from_squares(event_data)
 
-        ecb.driver.leds_blink(self.sq_list, timeout=1)
+        ecb.driver.leds_blink(EcbBitboard.to_squares(self.invalid_bb),
+                              timeout=1)
 
-        if not len(self.sq_list):
+        if not self.invalid_bb:
             invalid_squares = ecb.validate_board()
             if len(invalid_squares):
-                self.sq_list = invalid_squares
+                self.invalid_bb = EcbBitboard.from_squares(invalid_squares)
                 return
 
-            ecb.event_queue.put((Event.error_end, self.engine_move))
+            ecb.post_event(Event.error_end, self.engine_move)
             self.engine_move = None
 
     def _handle_engine_move_started(self, ecb, event_data):
@@ -785,44 +944,42 @@ class GamePause(State):
             if not self.paused:
                 print("pausing....")
                 if ecb.game_config.use_time_control():
-                    ecb.driver.clock_stop(ecb.board.turn)
-                    ecb.time[ecb.board.turn] = ecb.driver.clock_get(ecb.board.turn)
+                    ecb.clock_stop(ecb.board.turn)
 
                 if ecb.board.turn == ecb.game_config.opp_color and \
                         ecb.game_config.level != GameConfig.LEVEL_DISABLED:
-                    ecb.engine.stop()
+                    ecb.engine_stop()
+                else:
+                    ecb.analyzer.stop()
 
-                self.led_blink = Interval(1,
-                                          ecb.driver.btn_led_toggle,
-                                          EcbDriver.CMD_LED_START)
-                self.led_blink.start()
+                ecb.driver.btn_led_blink(EcbDriver.CMD_LED_START, 2)
 
-                self.timer = Timer(3, self._can_stop_timeout)
+                self.timer = ecb.time_source.timer(ecb.PAUSE_STOP_WINDOW,
+                                                  self._can_stop_timeout)
                 self.timer.start()
             else:
                 print("resuming...")
                 if ecb.board.turn == ecb.game_config.opp_color and \
                         ecb.game_config.level != GameConfig.LEVEL_DISABLED:
                     ecb.engine_go()
+                else:
+                    ecb.analysis_start()
 
                 if ecb.game_config.use_time_control():
-                    ecb.driver.clock_start(ecb.board.turn)
-
-                ecb.event_queue.put((Event.game_resume, None))
+                    ecb.clock_start(ecb.board.turn)
 
-                if self.led_blink is not None:
-                    self.led_blink.cancel()
+                ecb.post_event(Event.game_resume, None)
 
+                ecb.driver.btn_led_blink(0)
                 ecb.driver.btn_led_on(EcbDriver.CMD_LED_START)
 
                 self.paused = False
 
         else:  # button was pressed the second time before the timer expire
             print("stopping...")
-            ecb.event_queue.put((Event.game_force_stop, None))
+            ecb.post_event(Event.game_force_stop, None)
 
-            if self.led_blink is not None:
-                self.led_blink.cancel()
+            ecb.driver.btn_led_blink(0)
 
             if self.timer is not None:
                 self.timer.cancel()
@@ -854,11 +1011,7 @@ class PiecePromotion(State):
             EcbDriver.CMD_LED_OPP_LEVEL0 |\
             EcbDriver.CMD_LED_OPP_COLOR
 
-        ecb.driver.btn_led_off(0xff)
-        self.blink_interval = Interval(0.5,
-                                       ecb.driver.btn_led_toggle,
-                                       led_mask)
-        self.blink_interval.start()
+        ecb.driver.btn_led_blink(led_mask, exclusive=True)
 
     def _handle_buttons(self, ecb, event_data):
         if event_data is None:
@@ -872,10 +1025,9 @@ class PiecePromotion(State):
         else:
             promotion = chess.BISHOP
 
-        self.blink_interval.cancel()
-        ecb.game_config.update_leds(ecb.driver)
+        ecb.driver.btn_led_blink(0)
 
-        ecb.event_queue.put((Event.move_ended, (self.to_sq, promotion)))
+        ecb.post_event(Event.move_ended, MoveEndedData(self.to_sq, promotion))
 
     def run(self, ecb, event, event_data):
         print("PiecePromotion: " + str(event))
@@ -916,6 +1068,13 @@ class GameConfig(object):
         [1, 1, 1],  # LEVEL_7
     ]
 
+    # seconds added to a clock for every move
+    TIME_INCREMENT = 0
+
+    # the time of a game is for this many moves, and then it starts over; 0
+    # for the whole game
+    TIME_MOVES_TO_GO = 0
+
     def __init__(self):
         self.mode = GameConfig.MODE_LEARN
         self.level = GameConfig.LEVEL_DISABLED
@@ -959,16 +1118,24 @@ class GameConfig(object):
         self.time_controlled = True
 
     def update_leds(self, driver):
-        mode_cmd = [driver.btn_led_off, driver.btn_led_on][self.mode]
         level_led_map = GameConfig.LEVEL_LED_MAP[self.level]
-        color_cmd = [driver.btn_led_off, driver.btn_led_on][self.opp_color]
 
-        mode_cmd(driver.CMD_LED_MODE)
-        color_cmd(driver.CMD_LED_OPP_COLOR)
+        led_mask = 0
+        if self.mode:
+            led_mask |= driver.CMD_LED_MODE
+        if self.opp_color:
+            led_mask |= driver.CMD_LED_OPP_COLOR
 
         for i in range(0, 3):
-            level_cmd = [driver.btn_led_off, driver.btn_led_on][level_led_map[i]]
-            level_cmd(1 << (i + 2))
+            if level_led_map[i]:
+                led_mask |= 1 << (i + 2)
+
+        driver.btn_leds_set(led_mask,
+                            driver.CMD_LED_MODE |
+                            driver.CMD_LED_OPP_COLOR |
+                            driver.CMD_LED_OPP_LEVEL0 |
+                            driver.CMD_LED_OPP_LEVEL1 |
+                            driver.CMD_LED_OPP_LEVEL2)
 
     def update(self, driver):
         self.update_clocks(driver)
@@ -989,8 +1156,44 @@ class Ecb(StateMachine):
         {'skill': 17, 'depth': 8, 'movetime': 300},  # LEVEL 6
     ]
 
-    def __init__(self, driver, path_to_engine, path_to_opening_book, sio=None):
+    # threads of the board's own engine
+    ENGINE_THREADS = 2
+
+    # maximum number of analysis updates per second sent to web clients
+    ANALYSIS_MAX_RATE = 2
+
+    # a piece must stay on its destination square this long, in seconds,
+    # for the move to be made
+    MOVE_DEBOUNCE = 1
+
+    # once paused, a second press of the start button within this time, in
+    # seconds, stops the game; a later one resumes it
+    PAUSE_STOP_WINDOW = 3
+
+    # while a clock runs, web clients get a fresh clock anchor this often, in
+    # seconds, to correct their drift
+    CLOCK_ANCHOR_PERIOD = 10
+
+    def __init__(self, driver, path_to_engine, path_to_opening_book, sio=None,
+                 path_to_game_store=None, path_to_move_cache=None,
+                 engine_pool=None, chess_ops=None, time_source=None,
+                 memory_budget=None):
         self.event_queue = Queue.Queue()
+
+        # sizes the engine hash, the move cache and the web events queued
+        if memory_budget is None:
+            memory_budget = MemoryBudget()
+        self.memory_budget = memory_budget
+
+        # the timers and time measurements go through the time source, which
+        # is the driver's by default
+        if time_source is None:
+            time_source = driver.time_source
+        self.time_source = time_source
+
+        # records the events entering the queue, see EcbReplay
+        self.recorder = None
+
         self.driver = driver
         self.sio = sio
         self.driver.set_callbacks(self._sensors_callback,
@@ -1002,62 +1205,180 @@ class Ecb(StateMachine):
         self.board = None
 
         self.path_to_engine = path_to_engine
+        self.engine_pool = engine_pool
         self.path_to_opening_book = path_to_opening_book
         self.engine = None
-        self.opening_book = None
         self.info_handler = None
 
-        self.time = [self.game_config.time, self.game_config.time]
+        # chess computations, in this thread or in a worker process
+        self.chess_ops = chess_ops
+        if chess_ops is None:
+            self.chess_ops = ChessOps()
+
+        self.time_manager = TimeManager(time_source)
 
         self.bestmove = None
         self.pondermove = None
-        self.pondering_on = False
-        self.pondering_result = None
-        self.engine_ignore_callback = False
+        self.ponder = PonderController()
+
+        self.analyzer = Analyzer(time_source=time_source)
+
+        self.clock_anchor_lock = Lock()
+        self.clock_anchor_timer = None
 
         self.web_client_connected = False
         self.custom_fen = None
 
+        # set by GameEnd, so that a game ends, and is saved, only once
+        self.game_ended = False
+
+        # the sensors as seen by the states, see handle(), and the changes
+        # of the sensor events queued, oldest first
+        self.sensors_bb = EcbBitboard.BB_EMPTY
+        self.sensors_lock = Lock()
+        self.sensors_queued = collections.deque()
+
+        # opened by storage_open(), the board works without them
+        self.path_to_game_store = path_to_game_store
+        self.path_to_move_cache = path_to_move_cache
+        self.game_store = None
+        self.move_cache = None
+
         super(Ecb, self).__init__(Ecb.idle)
 
         print("EcbFSM ready")
 
     def _opening_book_find(self):
-        #     LEVELS             1-3          4-6          7
-        weight_proportions = [(0, 0.33), (0.33, 0.66), (0.66, 1)]
-        level_to_weight_index = [0, 0, 0, 0, 1, 1, 1, 2]
-        moves = list(self.opening_book.find_all(self.board))
+        #     LEVELS     1-3          4-6          7
+        # weight band     0            1           2
+        level_to_band = [0, 0, 0, 0, 1, 1, 1, 2]
+        candidates = self.chess_ops.book_candidates(
+            self.board, level_to_band[self.game_config.level])
 
-        if not len(moves):
+        if not candidates:
             return False
 
-        max_available_weight = moves[0].weight
-        weight_index = level_to_weight_index[self.game_config.level]
-        min_prop, max_prop = weight_proportions[weight_index]
-        min_weight = min_prop * max_available_weight
-        max_weight = max_prop * max_available_weight
+        # weighted random choice, the weights are cumulative
+        choice = random.randint(0, candidates[-1][1] - 1)
+        move = candidates[bisect.bisect_right(
+            [weight for move, weight in candidates], choice)][0]
 
-        exclude_moves = []
-        for entry in moves:
-            if entry.weight < min_weight and entry.weight > max_weight:
-                exclude_moves.append(entry.move())
+        print("opening database move: " + move.uci())
+        self.inject_event(Event.engine_move_started, EngineMoveData(move, None))
 
-        try:
-            entry = self.opening_book.choice(self.board,
-                                             exclude_moves=exclude_moves)
-            print("opening database move: " + entry.move().uci())
-            self.event_queue.put((Event.engine_move_started,
-                                 (entry.move(), None)))
-            return True
-        except IndexError:
-            return False
+        return True
+
+    def storage_open(self):
+        if self.path_to_game_store is not None:
+            self.game_store = GameStore(self.path_to_game_store)
+
+        if self.path_to_move_cache is not None:
+            self.move_cache = MoveCache(
+                self.path_to_move_cache,
+                self.memory_budget.move_cache_entries())
+
+    def _analysis_emit(self, analysis):
+        if self.sio is not None:
+            self.sio.emit('analysis', analysis)
+
+    def analysis_start(self):
+        if self.engine is None or self.engine_pool is not None or\
+                self.ponder.pondering() or\
+                self.game_config.level == GameConfig.LEVEL_DISABLED or\
+                self.board.turn == self.game_config.opp_color:
+            return
+
+        self.analyzer.start(self.engine, self.board, self.info_handler,
+                            self.ENGINE_THREADS)
+
+    def _clock_anchor_timeout(self):
+        self.clock_emit()
+
+    # Sends the clocks to the web clients, which count down the running one
+    # on their own, from the time they got the anchor. 'ts' is the host's
+    # time of the anchor, newer anchors have higher values.
+    def clock_emit(self):
+        if self.sio is None:
+            return
+
+        anchor = None
+        if self.board is not None and self.game_config.use_time_control():
+            running = None
+            for color in [chess.WHITE, chess.BLACK]:
+                if self.driver.clock_running(color):
+                    running = ['black', 'white'][color]
+
+            anchor = {
+                'white': self.driver.clock_remaining(chess.WHITE),
+                'black': self.driver.clock_remaining(chess.BLACK),
+                'running': running,
+                'ts': self.time_source.now(),
+            }
+
+        with self.clock_anchor_lock:
+            if self.clock_anchor_timer is not None:
+                self.clock_anchor_timer.cancel()
+                self.clock_anchor_timer = None
+
+            if anchor is not None and anchor['running'] is not None:
+                self.clock_anchor_timer = self.time_source.timer(
+                    self.CLOCK_ANCHOR_PERIOD, self._clock_anchor_timeout)
+                self.clock_anchor_timer.start()
+
+        self.sio.emit('clock', anchor)
+
+    def clock_start(self, color):
+        if self.game_config.use_time_control():
+            self.driver.clock_start(color)
+            self.time_manager.clock_started(color)
+            self.clock_emit()
+        else:
+            self.driver.clock_set(color, 0, 0)
+
+    # 'moved' tells whether 'color' just moved, see
+    # TimeManager.clock_stopped()
+    def clock_stop(self, color, moved=False):
+        if not self.game_config.use_time_control():
+            self.driver.clock_blank(color)
+            return
+
+        self.driver.clock_stop(color)
+        earned_ms = self.time_manager.clock_stopped(
+            color, self.driver.clock_remaining(color), moved)
+
+        # the hardware clock knows nothing about the time earned
+        if earned_ms:
+            remaining_sec = self.time_manager.remaining(color) // 1000
+            self.driver.clock_set(color, remaining_sec // 60, remaining_sec % 60)
+
+        self.clock_emit()
+
+    def engine_open(self):
+        if self.engine_pool is not None:
+            return self.engine_pool.engine()
+
+        return self.chess_ops.engine(self.path_to_engine)
+
+    # stop the current search and drop its result
+    def engine_stop(self):
+        self.ponder.cancel()
+        self.engine.stop()
 
     def engine_go(self, pondermove=None):
         def engine_on_go_finished(command):
-            if self.engine_ignore_callback:
-                self.engine_ignore_callback = False
+            if not self.ponder.search_finished(generation, command.result()):
                 return
 
+            think_time = self.time_source.now() - go_started
+            nps = self.info_handler.info.get('nps')
+
+            ENGINE_THINK_SECONDS.observe(think_time)
+            if nps:
+                ENGINE_NPS.set(nps)
+
+            self.time_manager.search_finished(movetime,
+                                              int(think_time * 1000), nps)
+
             self.bestmove, self.pondermove = command.result()
             if self.pondermove is not None:
                 print("bestmove move: %s, ponder: %s" %
@@ -1065,138 +1386,213 @@ class Ecb(StateMachine):
             else:
                 print("bestmove move: %s" % self.bestmove.uci())
 
-            if self.pondering_on:
-                self.event_queue.put((Event.pondering_finished,
-                                     (self.bestmove, self.pondermove)))
-            else:
-                self.event_queue.put((Event.engine_move_started,
-                                     (self.bestmove, self.pondermove)))
+            # ponder searches have no known time bucket, don't cache them
+            if cache_key is not None:
+                self.move_cache.put(cache_key, self.bestmove, self.pondermove)
+
+            self.inject_event(Event.engine_move_started,
+                              EngineMoveData(self.bestmove, self.pondermove))
 
         if self.game_config.use_time_control():
-            wtime = self.time[chess.WHITE]
-            btime = self.time[chess.BLACK]
-            wtime_msec = (wtime['min'] * 60 + wtime['sec']) * 1000
-            btime_msec = (btime['min'] * 60 + btime['sec']) * 1000
+            # the software clocks are free to read, use both sides' times
+            for color in [chess.WHITE, chess.BLACK]:
+                self.time_manager.sync(color,
+                                       self.driver.clock_remaining(color))
+
+            go_params = self.time_manager.go_params(self.board)
         else:
             # always use 90 minutes
-            wtime_msec = 90 * 60 * 1000
-            btime_msec = 90 * 60 * 1000
-
-        if not self._opening_book_find():
-            if pondermove is not None:
-                board = self.board.copy()
-                board.push(pondermove)
-                self.pondering_on = True
-            else:
-                board = self.board
-                self.pondering_on = False
+            go_params = {
+                'wtime': 90 * 60 * 1000,
+                'btime': 90 * 60 * 1000
+            }
 
-            self.engine.position(board)
+        self.analyzer.stop()
 
-            if self.game_config.level < GameConfig.LEVEL_7:
-                depth = self.ENGINE_SETTINGS[self.game_config.level - 1]['depth']
-                movetime = self.ENGINE_SETTINGS[self.game_config.level - 1]['movetime']
+        # the book is only useful for the side to move, don't ponder on it
+        pondering_on = pondermove is not None
+        if not pondering_on and self._opening_book_find():
+            return
 
-                self.engine.go(wtime=wtime_msec, btime=btime_msec,
-                               ponder=self.pondering_on,
-                               depth=depth, movetime=movetime,
-                               async_callback=engine_on_go_finished)
-            elif self.game_config.level == GameConfig.LEVEL_7:
-                self.engine.go(wtime=wtime_msec, btime=btime_msec,
-                               ponder=self.pondering_on,
-                               async_callback=engine_on_go_finished)
+        if pondering_on:
+            board = self.board.copy()
+            board.push(pondermove)
+        else:
+            board = self.board
+
+        movetime = None
+        if self.game_config.level < GameConfig.LEVEL_7:
+            go_params['depth'] = self.ENGINE_SETTINGS[self.game_config.level - 1]['depth']
+            movetime = self.ENGINE_SETTINGS[self.game_config.level - 1]['movetime']
+
+        # a ponder search lasts until ponderhit, the engine manages the
+        # time from there on using the clocks
+        if self.game_config.use_time_control() and not pondering_on:
+            movetime = self.time_manager.movetime(self.board, movetime)
+
+        if movetime is not None:
+            go_params['movetime'] = movetime
+
+        cache_key = None
+        if self.move_cache is not None and not pondering_on:
+            cache_key = self.move_cache.key(board, self.game_config.level,
+                                            movetime)
+            cached = self.move_cache.get(board, cache_key)
+            if cached is not None:
+                print("move cache move: " + cached[0].uci())
+                self.inject_event(Event.engine_move_started,
+                                  EngineMoveData(*cached))
+                return
 
-    def row_to_squares(self, row, val):
-        columns = "abcdefgh"
-        squares = []
+        generation = self.ponder.search_started(pondermove)
 
-        for i in range(0, 8):
-            if (val & (1 << i)):
-                squares.append("%s%d" % (columns[i], row + 1))
+        self.engine.position(board)
+        self.info_handler.turn = board.turn
 
-        return squares
+        go_started = self.time_source.now()
+        self.engine.go(ponder=pondering_on,
+                       async_callback=engine_on_go_finished,
+                       **go_params)
 
-    def sensor_map_to_squares(self, sensor_map):
-        squares = []
-        for row in range(0, 8):
-            squares += self.row_to_squares(row, sensor_map[row])
+    # Keeps the sensors as seen by the states: the hardware state when last
+    # synced, updated with the sensor events as they're handled.
+    def handle(self, ecb, event, event_data):
+        if event == Event.sensors_changed:
+            with self.sensors_lock:
+                if self.sensors_queued:
+                    self.sensors_queued.popleft()
 
-        return squares
+            self.sensors_bb ^= EcbBitboard.from_squares(event_data)
 
-    # returns True if sensor detects a chessman
-    def chessman_detected(self, square):
-        on_squares = self.sensor_map_to_squares(self.driver.sensors_get())
+        super(Ecb, self).handle(ecb, event, event_data)
 
-        if square in on_squares:
-            return True
+    # reads the sensors and returns their bitboard. The state machine's view
+    # leaves out the changes not handled yet: the ones of the sensor events
+    # queued before the read, which get applied when they're handled, and
+    # the ones still in their debounce window, which get reported later.
+    # Runs in the state machine's thread, the only one dequeuing events.
+    def sensors_sync(self):
+        with self.sensors_lock:
+            queued = len(self.sensors_queued)
 
-        return False
+        hw_bb = EcbBitboard.from_rows(self.driver.sensors_get())
+
+        sensors_bb = hw_bb
+        for square, state in self.driver.sensors_debouncing().items():
+            bit = 1 << EcbBitboard.square(square)
+            sensors_bb = (sensors_bb & ~bit) | (bit if state else 0)
 
+        # the events queued since are not in the read
+        with self.sensors_lock:
+            for squares_bb in itertools.islice(self.sensors_queued, queued):
+                sensors_bb ^= squares_bb
+
+        self.sensors_bb = sensors_bb
+
+        return hw_bb
+
+    # returns True if sensor detects a chessman
+    def chessman_detected(self, square):
+        return bool(self.sensors_bb & (1 << EcbBitboard.square(square)))
+
+    # the squares where the sensors don't match the board; no sensor reads
+    # while they match
     def validate_board(self):
         if self.board is None:
             return
 
-        piece_types = [chess.PAWN, chess.ROOK, chess.KNIGHT, chess.BISHOP, chess.QUEEN, chess.KING]
-        piece_colors = [chess.WHITE, chess.BLACK]
+        board_bb = int(self.board.occupied)
+        if board_bb == self.sensors_bb:
+            return []
+
+        # confirm with the hardware, in case the events got out of step
+        BOARD_RESYNCS.inc()
+
+        return EcbBitboard.to_squares(board_bb ^ self.sensors_sync())
 
-        board_map = 0
+    def _queue_event(self, event, event_data):
+        record = EventRecord.get(event, event_data)
+        record.queued_at = self.time_source.now()
+
+        if event != Event.sensors_changed:
+            self.event_queue.put(record)
+            return
 
-        for pc in piece_colors:
-            for pt in piece_types:
-                board_map |= int(self.board.pieces(pt, pc))
+        # queued in the same order as the changes, see sensors_sync()
+        with self.sensors_lock:
+            self.sensors_queued.append(EcbBitboard.from_squares(event_data))
+            self.event_queue.put(record)
 
-        # convert to list
-        board_map = struct.unpack('8B', struct.pack('Q', board_map))
+    def post_event(self, event, event_data=None):
+        if self.recorder is not None:
+            self.recorder.record(event, event_data, False)
 
-        # get the sensor map
-        sensors_map = self.driver.sensors_get()
+        self._queue_event(event, event_data)
 
-        # compare the two lists and extract a list of squares that don't match
+    # events coming from outside the state machine: hardware, web clients and
+    # engine answers
+    def inject_event(self, event, event_data=None):
+        if self.recorder is not None:
+            self.recorder.record(event, event_data, True)
 
-        unmatching_squares = []
-        for row in range(0, 8):
-            row_changes = sensors_map[row] ^ board_map[row]
+        self._queue_event(event, event_data)
 
-            unmatching_squares += self.row_to_squares(row, row_changes)
+    # events from web clients, dropped when too many are waiting, so that
+    # the spectators can't flood the board
+    def inject_web_event(self, event, event_data=None):
+        if self.event_queue.qsize() >= self.memory_budget.web_events_queued():
+            WEB_EVENTS_DROPPED.inc()
+            return
 
-        return unmatching_squares
+        self.inject_event(event, event_data)
 
     def _sensors_callback(self, changed_squares):
         print("sensors callback: " + str(changed_squares))
-        self.event_queue.put((Event.sensors_changed, changed_squares))
+        self.inject_event(Event.sensors_changed, changed_squares)
 
     def _clock_expired_callback(self, clock_id):
         print("clock expired: " + str(clock_id))
-        self.event_queue.put((Event.clock_expired, clock_id))
+        self.inject_event(Event.clock_expired, clock_id)
 
     def _cmd_callback(self, buttons_mask):
         print("buttons pressed: " + str(buttons_mask))
         if buttons_mask & EcbDriver.CMD_BTN_GAME_START:
-            self.event_queue.put((Event.game_start_btn, None))
+            self.inject_event(Event.game_start_btn, None)
         else:
-            self.event_queue.put((Event.game_config_btn, buttons_mask))
+            self.inject_event(Event.game_config_btn, buttons_mask)
 
     def handle_events(self):
         while True:
             try:
-                event, event_data = self.event_queue.get(True, 1)
-                self.handle(self, event, event_data)
+                record = self.event_queue.get(True, 1)
+
+                started = self.time_source.now()
+                FSM_QUEUE_WAIT_SECONDS.observe(started - record.queued_at)
+
+                self.handle(self, record.event, record.event_data)
+
+                FSM_EVENT_SECONDS.observe(
+                    self.time_source.now() - started,
+                    (self.current_state.__class__.__name__,
+                     str(record.event)))
+
+                record.release()
                 self.event_queue.task_done()
             except Queue.Empty:
                 pass
 
 
-Ecb.idle = Idle()
-Ecb.setup = Setup()
-Ecb.starting = Starting()
-Ecb.stopping = Stopping()
-Ecb.game = Game()
-Ecb.game_end = GameEnd()
-Ecb.game_error = GameError()
-Ecb.game_pause = GamePause()
-Ecb.move = Move()
-Ecb.engine_move = EngineMove()
-Ecb.piece_promotion = PiecePromotion()
+Ecb.idle = Idle
+Ecb.setup = Setup
+Ecb.starting = Starting
+Ecb.stopping = Stopping
+Ecb.game = Game
+Ecb.game_end = GameEnd
+Ecb.game_error = GameError
+Ecb.game_pause = GamePause
+Ecb.move = Move
+Ecb.engine_move = EngineMove
+Ecb.piece_promotion = PiecePromotion
 
 if __name__ == "__main__":
     logging.basicConfig()
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+
+#
+#  Foldable Electronic Chess Board Project
+#
+#  This is the game store. Finished games are appended to a PGN archive and
+#  indexed in fixed size binary files:
+#    * games.idx        - one record per game (PGN offset/length, date,
+#                         result, opening key);
+#    * positions.sorted - one record per position (Zobrist hash, game
+#                         number), sorted, searched by bisection;
+#    * positions.idx    - the position records of the latest games, in the
+#                         order they were saved; merged into
+#                         positions.sorted when it grows too big.
+#
+#  The index files are memory mapped when searching, so the archive is never
+#  loaded in RAM.
+#
+#  Copyright 2016 - Laurentiu Palcu <lpalcu@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+
+import chess
+import chess.pgn
+import chess.polyglot
+import datetime
+import heapq
+import mmap
+import os
+import struct
+from threading import Lock
+
+
+class GameStore(object):
+    # pgn offset, pgn length, date (yyyymmdd), plies, result, opening key
+    GAME_RECORD = struct.Struct('<QIIHBxQ')
+    # zobrist hash, game number
+    POSITION_RECORD = struct.Struct('<QI')
+
+    RESULT_UNKNOWN = 0
+    RESULT_WHITE_WINS = 1
+    RESULT_BLACK_WINS = 2
+    RESULT_DRAW = 3
+
+    RESULTS = ['*', '1-0', '0-1', '1/2-1/2']
+
+    # the opening key is the position hash after this many plies
+    OPENING_PLIES = 12
+
+    EXPORT_CHUNK_SIZE = 16 * 1024
+
+    # position records in positions.idx triggering a merge
+    MERGE_RECORDS = 8192
+
+    def __init__(self, path):
+        self.path = path
+        self.pgn_path = os.path.join(path, 'games.pgn')
+        self.games_idx_path = os.path.join(path, 'games.idx')
+        self.positions_idx_path = os.path.join(path, 'positions.idx')
+        self.positions_sorted_path = os.path.join(path, 'positions.sorted')
+
+        self.lock = Lock()
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # make sure all files exist, so that readers never fail
+        for file_path in [self.pgn_path, self.games_idx_path,
+                          self.positions_idx_path,
+                          self.positions_sorted_path]:
+            open(file_path, 'ab').close()
+
+        # the positions of an older store are all in positions.idx
+        with self.lock:
+            self._positions_merge(self.MERGE_RECORDS)
+
+    def _position_hashes(self, board):
+        board = board.copy()
+        hashes = [chess.polyglot.zobrist_hash(board)]
+
+        while board.move_stack:
+            board.pop()
+            hashes.append(chess.polyglot.zobrist_hash(board))
+
+        hashes.reverse()
+
+        return hashes
+
+    def _records(self, file_path, record):
+        with open(file_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            size -= size % record.size
+
+            if not size:
+                return
+
+            idx_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offs in range(0, size, record.size):
+                    yield record.unpack_from(idx_map, offs)
+            finally:
+                idx_map.close()
+
+    # files are replaced by renaming, so that readers keep the version they
+    # opened
+    def _replace(self, file_path, chunks):
+        tmp_path = file_path + '.tmp'
+
+        with open(tmp_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+        os.rename(tmp_path, file_path)
+
+    # merges positions.idx into positions.sorted, if it has at least
+    # 'min_records' records
+    def _positions_merge(self, min_records):
+        size = os.path.getsize(self.positions_idx_path)
+        if size // self.POSITION_RECORD.size < min_records:
+            return
+
+        latest = sorted(self._records(self.positions_idx_path,
+                                      self.POSITION_RECORD))
+        merged = heapq.merge(self._records(self.positions_sorted_path,
+                                           self.POSITION_RECORD), latest)
+
+        self._replace(self.positions_sorted_path,
+                      (self.POSITION_RECORD.pack(*rec) for rec in merged))
+        self._replace(self.positions_idx_path, [])
+
+        print("game store: %d positions merged" % len(latest))
+
+    # the game numbers of the records of 'zobrist' in positions.sorted
+    def _sorted_find(self, f, zobrist):
+        record = self.POSITION_RECORD
+        count = os.fstat(f.fileno()).st_size // record.size
+        if not count:
+            return []
+
+        idx_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # the first record not below 'zobrist'
+            lo, hi = 0, count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if record.unpack_from(idx_map, mid * record.size)[0] < \
+                        zobrist:
+                    lo = mid + 1
+                else:
+                    hi = mid
+
+            found = []
+            for i in range(lo, count):
+                h, game_no = record.unpack_from(idx_map, i * record.size)
+                if h != zobrist:
+                    break
+                found.append(game_no)
+
+            return found
+        finally:
+            idx_map.close()
+
+    def result_code(self, result):
+        try:
+            return self.RESULTS.index(result)
+        except ValueError:
+            return self.RESULT_UNKNOWN
+
+    def _opening_key(self, hashes):
+        return hashes[min(self.OPENING_PLIES, len(hashes) - 1)]
+
+    def opening_key(self, board):
+        return self._opening_key(self._position_hashes(board))
+
+    def save(self, board, result, headers=None):
+        game = chess.pgn.Game.from_board(board)
+        today = datetime.date.today()
+
+        game.headers['Event'] = 'ECB game'
+        game.headers['Site'] = 'Edison Chess Board'
+        game.headers['Date'] = today.strftime('%Y.%m.%d')
+        game.headers['Result'] = result
+        if headers is not None:
+            for name, value in headers.items():
+                game.headers[name] = value
+
+        pgn = (str(game) + '\n\n').encode('utf-8')
+        hashes = self._position_hashes(board)
+        opening_key = self._opening_key(hashes)
+
+        with self.lock:
+            game_no = self.games_count()
+            offset = os.path.getsize(self.pgn_path)
+
+            with open(self.pgn_path, 'ab') as f:
+                f.write(pgn)
+
+            with open(self.positions_idx_path, 'ab') as f:
+                f.write(b''.join([self.POSITION_RECORD.pack(h, game_no)
+                                  for h in set(hashes)]))
+
+            self._positions_merge(self.MERGE_RECORDS)
+
+            # the game record is written last, it makes the game visible
+            with open(self.games_idx_path, 'ab') as f:
+                f.write(self.GAME_RECORD.pack(offset, len(pgn),
+                                              int(today.strftime('%Y%m%d')),
+                                              min(len(board.move_stack), 0xffff),
+                                              self.result_code(result),
+                                              opening_key))
+
+        print("game %d saved to the game store" % game_no)
+
+        return game_no
+
+    def games_count(self):
+        return os.path.getsize(self.games_idx_path) // self.GAME_RECORD.size
+
+    def games(self, date_from=None, date_to=None, result=None, opening=None):
+        for game_no, rec in enumerate(self._records(self.games_idx_path,
+                                                    self.GAME_RECORD)):
+            offset, length, date, plies, result_code, opening_key = rec
+
+            if date_from is not None and date < date_from:
+                continue
+            if date_to is not None and date > date_to:
+                continue
+            if result is not None and result_code != self.result_code(result):
+                continue
+            if opening is not None and opening_key != opening:
+                continue
+
+            yield {
+                'game': game_no,
+                'date': date,
+                'plies': plies,
+                'result': self.RESULTS[result_code],
+                'opening': '%016x' % opening_key,
+            }
+
+    def find_position(self, board):
+        zobrist = chess.polyglot.zobrist_hash(board)
+
+        # both files opened together, a merge can't move records in between
+        with self.lock:
+            games_no = self.games_count()
+            sorted_file = open(self.positions_sorted_path, 'rb')
+            latest = list(self._records(self.positions_idx_path,
+                                        self.POSITION_RECORD))
+
+        with sorted_file:
+            found = set(self._sorted_find(sorted_file, zobrist))
+
+        found.update([game_no for h, game_no in latest if h == zobrist])
+
+        # skip records of a game that is still being written
+        return sorted([game_no for game_no in found if game_no < games_no])
+
+    def read_game(self, game_no):
+        if game_no < 0 or game_no >= self.games_count():
+            return None
+
+        with open(self.games_idx_path, 'rb') as f:
+            f.seek(game_no * self.GAME_RECORD.size)
+            offset, length = self.GAME_RECORD.unpack(
+                f.read(self.GAME_RECORD.size))[0:2]
+
+        with open(self.pgn_path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length).decode('utf-8')
+
+    def export(self):
+        # only export games that are completely written
+        with open(self.games_idx_path, 'rb') as f:
+            games_no = os.fstat(f.fileno()).st_size // self.GAME_RECORD.size
+            if not games_no:
+                return
+
+            f.seek((games_no - 1) * self.GAME_RECORD.size)
+            offset, length = self.GAME_RECORD.unpack(
+                f.read(self.GAME_RECORD.size))[0:2]
+
+        remaining = offset + length
+        with open(self.pgn_path, 'rb') as f:
+            while remaining > 0:
+                chunk = f.read(min(self.EXPORT_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+
+                remaining -= len(chunk)
+                yield chunk
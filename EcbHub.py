@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+
+#
+#  Foldable Electronic Chess Board Project
+#
+#  This is the multi-board hub. One host process drives several boards:
+#    * every board has its own driver and state machine, running in its own
+#      thread;
+#    * the engines are shared: an engine pool runs the boards' searches on a
+#      few engine processes, scheduling the boards round-robin;
+#    * the web frontend is shared: web clients join a board by its game id;
+#
+#  Copyright 2016 - Laurentiu Palcu <lpalcu@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+
+from EcbDriver import EcbDriver
+from EcbFSM import Ecb
+from EcbMemory import MemoryBudget
+from EcbWorker import WorkerClient
+import EcbBitboard
+import EcbMetrics
+import chess.uci
+import collections
+from threading import Condition, Event, Thread
+
+
+class PoolResult(object):
+    def __init__(self, bestmove, pondermove):
+        self.bestmove = bestmove
+        self.pondermove = pondermove
+
+    # same interface as the chess.uci commands
+    def result(self):
+        return self.bestmove, self.pondermove
+
+
+class PoolRequest(object):
+    def __init__(self, engine, board, go_params, callback):
+        self.engine = engine
+        self.board = board
+        self.go_params = go_params
+        self.callback = callback
+        self.worker = None
+
+
+# Board side proxy of the engine pool. It implements the subset of the
+# chess.uci engine interface used by the state machine.
+class PooledEngine(object):
+    def __init__(self, pool):
+        self.pool = pool
+        self.options = {}
+        self.info_handlers = []
+        self.board = None
+
+    def uci(self):
+        pass
+
+    def ucinewgame(self):
+        pass
+
+    def setoption(self, options):
+        self.options.update(options)
+
+    def position(self, board):
+        self.board = board.copy()
+
+    def go(self, async_callback=None, **go_params):
+        request = PoolRequest(self, self.board, go_params, async_callback)
+        self.pool.submit(request)
+
+        return request
+
+    def stop(self):
+        self.pool.stop(self)
+
+    def ponderhit(self):
+        self.pool.ponderhit(self)
+
+    def quit(self):
+        self.pool.stop(self)
+
+
+ENGINE_POOL_AVAILABLE = EcbMetrics.gauge(
+    'ecb_engine_pool_available', 'Engines of the pool able to search.')
+
+
+# The engine is started by the worker's thread, so that the engines of the
+# pool start in parallel, without holding up the boards. A worker whose
+# engine fails to start, or fails while searching, is unavailable: it's
+# ready, but it takes no more requests.
+class PoolWorker(object):
+    def __init__(self, pool, path_to_engine, threads, hash_mb):
+        self.pool = pool
+        self.path_to_engine = path_to_engine
+        self.threads = threads
+        self.hash_mb = hash_mb
+        self.engine = None
+        self.ready = Event()
+        self.available = False
+        self.options = {}
+        self.request = None
+
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _engine_open(self):
+        try:
+            self.engine = chess.uci.popen_engine(self.path_to_engine)
+            self.engine.uci()
+            self.engine.setoption({'threads': self.threads,
+                                   'hash': self.hash_mb})
+        except Exception as e:
+            print("engine pool: %s failed to start: %s" %
+                  (self.path_to_engine, e))
+        else:
+            self.available = True
+            self.pool.availability_changed()
+        finally:
+            self.ready.set()
+
+        return self.available
+
+    def _apply_options(self, options):
+        changed = {}
+        for name, value in options.items():
+            # the pool owns the threads and hash settings
+            if name in ['threads', 'hash'] or \
+                    self.options.get(name) == value:
+                continue
+
+            changed[name] = value
+
+        if changed:
+            self.engine.setoption(changed)
+            self.options.update(changed)
+
+    def _search(self, request):
+        done = Event()
+        results = []
+
+        def go_finished(command):
+            results.append(command.result())
+            done.set()
+
+        self._apply_options(request.engine.options)
+
+        for handler in request.engine.info_handlers:
+            self.engine.info_handlers.append(handler)
+
+        self.engine.position(request.board)
+        self.engine.go(async_callback=go_finished, **request.go_params)
+        done.wait()
+
+        for handler in request.engine.info_handlers:
+            self.engine.info_handlers.remove(handler)
+
+        return results[0]
+
+    def _run(self):
+        if not self._engine_open():
+            return
+
+        while True:
+            request = self.pool.next_request(self)
+
+            try:
+                bestmove, pondermove = self._search(request)
+            except Exception as e:
+                print("engine pool: engine failed: %s" % e)
+
+                # another engine takes over the request
+                self.available = False
+                self.pool.availability_changed()
+                if self.pool.request_done(self, request):
+                    request.worker = None
+                    self.pool.submit(request)
+
+                return
+
+            if self.pool.request_done(self, request) and \
+                    request.callback is not None:
+                request.callback(PoolResult(bestmove, pondermove))
+
+
+class EnginePool(object):
+    def __init__(self, path_to_engine, engines=2, threads=1, hash_mb=16):
+        self.lock = Condition()
+
+        # pending requests of every board, served round-robin
+        self.pending = collections.OrderedDict()
+
+        self.workers = [PoolWorker(self, path_to_engine, threads, hash_mb)
+                        for i in range(engines)]
+
+    def engine(self):
+        return PooledEngine(self)
+
+    # returns the number of engines available
+    def wait_ready(self):
+        for worker in self.workers:
+            worker.ready.wait()
+
+        available = self.available()
+        if not available:
+            print("engine pool: no engine available, the boards can't play")
+
+        return available
+
+    def available(self):
+        return len([worker for worker in self.workers if worker.available])
+
+    def availability_changed(self):
+        ENGINE_POOL_AVAILABLE.set(self.available())
+
+    def submit(self, request):
+        with self.lock:
+            self.pending.setdefault(request.engine, collections.deque())
+            self.pending[request.engine].append(request)
+            self.lock.notify()
+
+    def next_request(self, worker):
+        with self.lock:
+            while not any(self.pending.values()):
+                self.lock.wait()
+
+            # take the first board with work, then move it to the end of the
+            # line, so that the other boards are served first next time
+            for engine, requests in self.pending.items():
+                if requests:
+                    request = requests.popleft()
+                    del self.pending[engine]
+                    self.pending[engine] = requests
+                    break
+
+            request.worker = worker
+            worker.request = request
+
+            return request
+
+    def request_done(self, worker, request):
+        with self.lock:
+            worker.request = None
+
+            # the request was stopped, its result is not wanted
+            return request.worker is not None
+
+    def stop(self, engine):
+        with self.lock:
+            self.pending.pop(engine, None)
+
+            for worker in self.workers:
+                if worker.request is not None and \
+                        worker.request.engine == engine:
+                    worker.request.worker = None
+                    worker.engine.stop()
+
+    def ponderhit(self, engine):
+        with self.lock:
+            for request in self.pending.get(engine, []):
+                request.go_params['ponder'] = False
+
+            for worker in self.workers:
+                if worker.request is not None and \
+                        worker.request.engine == engine:
+                    worker.engine.ponderhit()
+
+
+SIO_EMITS = EcbMetrics.counter(
+    'ecb_sio_emits_total', 'Socket.io messages sent.', ['event'])
+
+
+# sends the socket.io messages of a board only to its web clients
+class BoardSio(object):
+    def __init__(self, sio, room):
+        self.sio = sio
+        self.room = room
+
+    def emit(self, event, data=None):
+        # the web server is not up yet
+        if self.sio is None:
+            return
+
+        SIO_EMITS.inc((event,))
+
+        self.sio.emit(event, data, room=self.room)
+
+
+class Hub(object):
+    # A hub with a single board and no engine pool is the classic, single
+    # board setup: the board gets its own engine and talks to all web clients.
+    # 'sio' may be attached later, with web_attach().
+    def __init__(self, boards, path_to_engine, path_to_opening_book, sio,
+                 path_to_data, engines=0, use_workers=False,
+                 memory_mb=MemoryBudget.DEFAULT_TOTAL_MB):
+        self.sio = sio
+        self.engine_pool = None
+        self.boards = collections.OrderedDict()
+        self.board_sios = []
+        self.clients = {}
+        self.connections = set()
+
+        # without a pool, every board has its own engine
+        self.memory_budget = MemoryBudget(memory_mb,
+                                          engines or len(boards))
+
+        if engines:
+            self.engine_pool = EnginePool(
+                path_to_engine, engines,
+                hash_mb=self.memory_budget.engine_hash_mb())
+
+        # fork the workers before the drivers start their interrupt threads
+        workers = [None] * len(boards)
+        if use_workers:
+            workers = [WorkerClient() for board in boards]
+
+        for (game_id, addresses), worker in zip(boards, workers):
+            suffix = ['', '-' + game_id][game_id != '']
+
+            driver = EcbDriver(addresses)
+            board_sio = BoardSio(sio, game_id or None)
+            self.board_sios.append(board_sio)
+            self.boards[game_id] = Ecb(driver, path_to_engine,
+                                       path_to_opening_book, board_sio,
+                                       path_to_data + '/games' + suffix,
+                                       path_to_data + '/move-cache%s.bin' %
+                                       suffix,
+                                       engine_pool=self.engine_pool,
+                                       chess_ops=worker,
+                                       memory_budget=self.memory_budget)
+
+        EcbMetrics.gauge('ecb_event_queue_depth',
+                         'Events waiting in the event queue.', ['board'],
+                         self._queue_depths)
+        EcbMetrics.gauge('ecb_sio_clients', 'Connected web clients.',
+                         fn=lambda: {(): len(self.clients)})
+
+    def _queue_depths(self):
+        return dict([((game_id,), ecb.event_queue.qsize())
+                     for game_id, ecb in self.boards.items()])
+
+    # whether a new web client is let in
+    def connect(self, sid):
+        if not self.memory_budget.web_client_allowed(len(self.connections)):
+            print("hub: web client refused, out of memory budget")
+            return False
+
+        self.connections.add(sid)
+
+        return True
+
+    # the board of 'game_id', the first one if the client gave none, or None
+    # for an unknown game
+    def join(self, sid, game_id):
+        if not game_id:
+            game_id = next(iter(self.boards))
+
+        if not isinstance(game_id, EcbBitboard.string_types) or \
+                game_id not in self.boards:
+            print("hub: web client refused, unknown game %r" % (game_id,))
+            return None
+
+        self.clients[sid] = game_id
+        if game_id:
+            self.sio.enter_room(sid, game_id)
+
+        return self.boards[game_id]
+
+    def leave(self, sid):
+        self.connections.discard(sid)
+
+        game_id = self.clients.pop(sid, None)
+        if game_id:
+            self.sio.leave_room(sid, game_id)
+
+    def board(self, sid):
+        return self.boards.get(self.clients.get(sid))
+
+    def web_attach(self, sio):
+        self.sio = sio
+        for board_sio in self.board_sios:
+            board_sio.sio = sio
+
+    def storage_open(self):
+        for ecb in self.boards.values():
+            ecb.storage_open()
+
+    def start(self):
+        threads = []
+        for ecb in self.boards.values():
+            thread = Thread(target=ecb.handle_events)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        return threads
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+#
+#  Foldable Electronic Chess Board Project
+#
+#  This is the I2C bus owner. The controllers share one bus, used from the
+#  interrupt threads, the timer threads and the state machine thread: all
+#  their transactions are queued here and run, one at a time, by the bus
+#  thread. Transactions have a priority: interrupt acknowledges and sensor
+#  reads go first, the LEDs last.
+#
+#  Reads wait for their result. Writes are queued and return right away; a
+#  write to the registers right before, after, or over the ones of the last
+#  queued transaction of the same controller is merged into it, so that only
+#  one transaction goes on the bus.
+#
+#  Any given register must always be accessed with the same priority, as
+#  transactions of different priorities may run out of order.
+#
+#  Copyright 2016 - Laurentiu Palcu <lpalcu@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+
+import EcbMetrics
+import collections
+import traceback
+from threading import Condition, Event, Thread, current_thread
+
+I2C_BUS_MERGED_WRITES = EcbMetrics.counter(
+    'ecb_i2c_bus_merged_writes_total',
+    'Writes merged into an already queued transaction.')
+I2C_BUS_WAIT_SECONDS = EcbMetrics.histogram(
+    'ecb_i2c_bus_wait_seconds', 'Time transactions wait for the bus.',
+    ['priority'])
+
+
+class BusJob(object):
+    def __init__(self, priority, fn, args, ctrl=None):
+        self.priority = priority
+        self.fn = fn
+        self.args = args
+        self.ctrl = ctrl
+        self.queued_at = None
+        self.done = None
+        self.result = None
+        self.error = None
+
+    def run(self):
+        return self.fn(*self.args)
+
+
+class BusWrite(BusJob):
+    def __init__(self, priority, ctrl, write_fn, reg, data):
+        super(BusWrite, self).__init__(priority, None, (), ctrl)
+        self.write_fn = write_fn
+        self.reg = reg
+        self.data = bytearray(data)
+
+    # merges a write of 'data' at 'reg', if it touches the queued registers
+    def merge(self, reg, data):
+        end = self.reg + len(self.data)
+        if reg > end or reg + len(data) < self.reg:
+            return False
+
+        start = min(self.reg, reg)
+        merged = bytearray(max(end, reg + len(data)) - start)
+        merged[self.reg - start:end - start] = self.data
+        merged[reg - start:reg - start + len(data)] = data
+
+        self.reg = start
+        self.data = merged
+
+        return True
+
+    def run(self):
+        return self.write_fn(bytearray([self.reg]) + self.data)
+
+
+class I2cBus(object):
+    PRIO_IRQ = 0
+    PRIO_NORMAL = 1
+    PRIO_LEDS = 2
+
+    PRIO_NAMES = ['irq', 'normal', 'leds']
+
+    def __init__(self, time_source):
+        self.time_source = time_source
+        self.lock = Condition()
+        self.queues = [collections.deque() for name in self.PRIO_NAMES]
+
+        # last queued, not yet started, job of every controller
+        self.last_job = {}
+
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _queue(self, job):
+        job.queued_at = self.time_source.now()
+        self.queues[job.priority].append(job)
+
+        if job.ctrl is not None:
+            self.last_job[job.ctrl] = job
+
+        self.lock.notify()
+
+    def _next_job(self):
+        with self.lock:
+            while not any(self.queues):
+                self.lock.wait()
+
+            for queue in self.queues:
+                if queue:
+                    job = queue.popleft()
+                    break
+
+            if job.ctrl is not None and self.last_job.get(job.ctrl) is job:
+                del self.last_job[job.ctrl]
+
+            return job
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+
+            I2C_BUS_WAIT_SECONDS.observe(
+                self.time_source.now() - job.queued_at,
+                (self.PRIO_NAMES[job.priority],))
+
+            try:
+                job.result = job.run()
+            except Exception as e:
+                job.error = e
+                if job.done is None:
+                    print("i2c: queued transaction failed")
+                    traceback.print_exc()
+
+            if job.done is not None:
+                job.done.set()
+
+    # runs fn(*args) on the bus thread and returns its result
+    def call(self, priority, ctrl, fn, *args):
+        # a bus job calling back into the bus runs its transactions inline
+        if current_thread() is self.thread:
+            return fn(*args)
+
+        job = BusJob(priority, fn, args, ctrl)
+        job.done = Event()
+
+        with self.lock:
+            self._queue(job)
+
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+
+        return job.result
+
+    # queues fn(*args), without waiting for it
+    def submit(self, priority, ctrl, fn, *args):
+        if current_thread() is self.thread:
+            fn(*args)
+            return
+
+        with self.lock:
+            self._queue(BusJob(priority, fn, args, ctrl))
+
+    # queues write_fn(bytearray([reg]) + data), merging it with the last
+    # queued write of the controller when possible
+    def write(self, priority, ctrl, write_fn, reg, data):
+        if current_thread() is self.thread:
+            write_fn(bytearray([reg]) + bytearray(data))
+            return
+
+        with self.lock:
+            last = self.last_job.get(ctrl)
+            if isinstance(last, BusWrite) and last.priority == priority and \
+                    last.merge(reg, bytearray(data)):
+                I2C_BUS_MERGED_WRITES.inc()
+                return
+
+            self._queue(BusWrite(priority, ctrl, write_fn, reg, data))
+
+    def queued(self):
+        with self.lock:
+            return sum([len(queue) for queue in self.queues])
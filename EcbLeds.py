@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+#
+#  Foldable Electronic Chess Board Project
+#
+#  This is the LEDs compositor, for the board and the command panel LEDs.
+#  Every user of the LEDs owns a layer, holding a static, blinking or pulsing
+#  pattern, with a priority. The compositor renders the layers into one frame
+#  of 8 bit rows, a LED being shown by the highest priority layer that covers
+#  it, and writes only the groups of rows that changed (the board halves, or
+#  the command panel register).
+#
+#  The animations are driven by the time source: the compositor wakes up only
+#  at the next on/off edge of an animated layer, and all layers with the same
+#  period blink in phase.
+#
+#  Copyright 2016 - Laurentiu Palcu <lpalcu@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+
+from threading import RLock
+
+
+class LedLayer(object):
+    # layer modes
+    STATIC = 0
+    BLINK = 1           # on for the first half of the period, then off
+    BLINK_INVERSE = 2   # off for the first half of the period, then on
+    PULSE = 3           # short flash at the start of the period
+
+    # share of the period a pulse is on
+    PULSE_DUTY = 0.2
+
+    def __init__(self, compositor, priority):
+        self.compositor = compositor
+        self.priority = priority
+        self.led_map = [0] * compositor.rows
+        self.cover_map = None
+        self.mode = self.STATIC
+        self.period = 1.0
+
+    # 'cover_map' are the LEDs hidden from the lower layers, the LEDs of the
+    # pattern by default
+    def set(self, led_map, mode=STATIC, period=1.0, cover_map=None):
+        with self.compositor.lock:
+            self.led_map = list(led_map)
+            self.cover_map = cover_map
+            self.mode = mode
+            self.period = period
+
+        self.compositor.render()
+
+    def add(self, led_map):
+        with self.compositor.lock:
+            new_map = [self.led_map[row] | led_map[row]
+                       for row in range(len(led_map))]
+
+            self.set(new_map, self.mode, self.period, self.cover_map)
+
+    def remove(self, led_map):
+        with self.compositor.lock:
+            new_map = [self.led_map[row] & ~led_map[row]
+                       for row in range(len(led_map))]
+
+            self.set(new_map, self.mode, self.period, self.cover_map)
+
+    def toggle(self, led_map):
+        with self.compositor.lock:
+            new_map = [self.led_map[row] ^ led_map[row]
+                       for row in range(len(led_map))]
+
+            self.set(new_map, self.mode, self.period, self.cover_map)
+
+    def clear(self):
+        self.set([0] * self.compositor.rows)
+
+    def covered(self):
+        if self.cover_map is None:
+            return self.led_map
+
+        return self.cover_map
+
+    def empty(self):
+        return not any(self.covered())
+
+    def animated(self):
+        return self.mode != self.STATIC and not self.empty()
+
+    # returns whether the layer's LEDs are lit at 'now'
+    def lit(self, now):
+        phase = (now % self.period) / self.period
+
+        if self.mode == self.BLINK:
+            return phase < 0.5
+        elif self.mode == self.BLINK_INVERSE:
+            return phase >= 0.5
+        elif self.mode == self.PULSE:
+            return phase < self.PULSE_DUTY
+
+        return True
+
+    # seconds until the layer's next on/off edge
+    def next_edge(self, now):
+        offs = now % self.period
+        edges = [0.5, 1.0]
+        if self.mode == self.PULSE:
+            edges = [self.PULSE_DUTY, 1.0]
+
+        for edge in edges:
+            if offs < edge * self.period:
+                return edge * self.period - offs
+
+        return self.period - offs
+
+
+class LedCompositor(object):
+    # write_rows(first_row, rows) writes 'rows_per_write' rows at once
+    def __init__(self, time_source, write_rows, rows=8, rows_per_write=4):
+        self.time_source = time_source
+        self.write_rows = write_rows
+        self.rows = rows
+        self.rows_per_write = rows_per_write
+
+        self.lock = RLock()
+        self.layers = []
+        self.frame = [0] * rows
+        self.timer = None
+
+        self.writes = 0
+
+    def layer(self, priority=0):
+        with self.lock:
+            layer = LedLayer(self, priority)
+            self.layers.append(layer)
+
+            # highest priority first, the oldest layer wins the ties
+            self.layers.sort(key=lambda l: -l.priority)
+
+        return layer
+
+    def _compose(self, now):
+        frame = [0] * self.rows
+        covered = [0] * self.rows
+
+        for layer in self.layers:
+            if layer.empty():
+                continue
+
+            lit = layer.lit(now)
+            layer_covered = layer.covered()
+            for row in range(0, self.rows):
+                if lit:
+                    frame[row] |= layer.led_map[row] & ~covered[row]
+
+                covered[row] |= layer_covered[row]
+
+        return frame
+
+    def _schedule(self, now):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        edges = [layer.next_edge(now) for layer in self.layers
+                 if layer.animated()]
+        if not edges:
+            return
+
+        # wake up just after the edge
+        self.timer = self.time_source.timer(min(edges) + 0.001, self.render)
+        self.timer.start()
+
+    # rewrites all the rows, for when the hardware lost them
+    def refresh(self):
+        with self.lock:
+            self.frame = [None] * self.rows
+            self.render()
+
+    def render(self):
+        with self.lock:
+            now = self.time_source.now()
+            frame = self._compose(now)
+
+            for first_row in range(0, self.rows, self.rows_per_write):
+                last_row = first_row + self.rows_per_write
+                rows = frame[first_row:last_row]
+                if rows != self.frame[first_row:last_row]:
+                    self.write_rows(first_row, rows)
+                    self.writes += 1
+
+            self.frame = frame
+
+            self._schedule(now)
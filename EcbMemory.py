@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+#
+#  Foldable Electronic Chess Board Project
+#
+#  This is the memory budget. The Edison's RAM is shared by the engines, the
+#  state machines and the web server, so every subsystem's size is derived
+#  from one budget: the engines' hash tables, the move cache, the web clients
+#  and the web events waiting in the event queues.
+#
+#  The budget also watches the resident memory of the board process and its
+#  children (engines, workers). Above budget, no new web clients are let in.
+#  When out of memory, the kernel kills the engines first, never the board
+#  or its workers.
+#
+#  Copyright 2016 - Laurentiu Palcu <lpalcu@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+
+import EcbMetrics
+import os
+from threading import Lock, Thread
+import time
+
+MEMORY_RSS_BYTES = EcbMetrics.gauge(
+    'ecb_memory_rss_bytes', 'Resident memory, per process kind.',
+    ['process'])
+MEMORY_BUDGET_BYTES = EcbMetrics.gauge(
+    'ecb_memory_budget_bytes', 'Memory budget of the board.')
+WEB_CLIENTS_REFUSED = EcbMetrics.counter(
+    'ecb_web_clients_refused_total',
+    'Web clients refused, for lack of memory.')
+
+
+# pids of the children of 'pid', and of their children
+def _descendants(pid):
+    children = {}
+
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                stat = f.read()
+        except IOError:
+            continue
+
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+
+    pids = []
+    pending = list(children.get(pid, []))
+    while pending:
+        child = pending.pop()
+        pids.append(child)
+        pending += children.get(child, [])
+
+    return pids
+
+
+def _proc_read(pid, name):
+    with open('/proc/%d/%s' % (pid, name)) as f:
+        return f.read()
+
+
+def _rss_bytes(pid):
+    for line in _proc_read(pid, 'status').splitlines():
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1]) * 1024
+
+    return 0
+
+
+class MemoryBudget(object):
+    DEFAULT_TOTAL_MB = 512
+
+    # shares of the budget
+    ENGINE_SHARE = 0.25
+    WEB_SHARE = 0.25
+    MOVE_CACHE_SHARE = 0.004
+
+    # rough costs: a move cache entry, a web client (its server thread and
+    # socket.io buffers)
+    MOVE_CACHE_ENTRY_BYTES = 200
+    WEB_CLIENT_BYTES = 4 * 1024 * 1024
+
+    # the engines' hash tables, in MB, are powers of two within these limits
+    MIN_HASH_MB = 1
+    MAX_HASH_MB = 1024
+
+    # web events waiting in a board's event queue, the others are dropped
+    WEB_EVENTS_QUEUED = 64
+
+    # oom_score_adj of the board process, inherited by the workers, and of
+    # the engines
+    OOM_SCORE_BOARD = -500
+    OOM_SCORE_ENGINES = 500
+
+    CHECK_PERIOD = 10
+
+    def __init__(self, total_mb=DEFAULT_TOTAL_MB, engines=1):
+        self.total_bytes = total_mb * 1024 * 1024
+        self.engines = max(engines, 1)
+
+        self.lock = Lock()
+        self.rss = {}
+        self.thread = None
+
+        MEMORY_BUDGET_BYTES.set(self.total_bytes)
+
+    def _share(self, share):
+        return int(self.total_bytes * share)
+
+    # Stockfish 'Hash' option, in MB, of every engine
+    def engine_hash_mb(self):
+        hash_mb = self._share(self.ENGINE_SHARE) // self.engines // 2 ** 20
+        hash_mb = max(min(hash_mb, self.MAX_HASH_MB), self.MIN_HASH_MB)
+
+        return 1 << (hash_mb.bit_length() - 1)
+
+    def move_cache_entries(self):
+        return self._share(self.MOVE_CACHE_SHARE) // \
+            self.MOVE_CACHE_ENTRY_BYTES
+
+    def web_clients(self):
+        return max(self._share(self.WEB_SHARE) // self.WEB_CLIENT_BYTES, 1)
+
+    def web_events_queued(self):
+        return self.WEB_EVENTS_QUEUED
+
+    def rss_total(self):
+        with self.lock:
+            return sum(self.rss.values())
+
+    def over_budget(self):
+        return self.rss_total() > self.total_bytes
+
+    # whether one more web client fits, 'clients' being already connected
+    def web_client_allowed(self, clients):
+        if clients < self.web_clients() and not self.over_budget():
+            return True
+
+        WEB_CLIENTS_REFUSED.inc()
+        return False
+
+    def _oom_score_set(self, pid, score):
+        path = '/proc/%d/oom_score_adj' % pid
+
+        try:
+            if int(_proc_read(pid, 'oom_score_adj')) != score:
+                with open(path, 'w') as f:
+                    f.write(str(score))
+        except (IOError, ValueError):
+            pass
+
+    # samples the resident memory of the board process and of its children,
+    # per process kind
+    def check(self):
+        pid = os.getpid()
+        rss = {'board': _rss_bytes(pid)}
+
+        self._oom_score_set(pid, self.OOM_SCORE_BOARD)
+
+        for child in _descendants(pid):
+            try:
+                name = _proc_read(child, 'comm').strip()
+                kind = ['worker', 'engine']['python' not in name]
+                rss[kind] = rss.get(kind, 0) + _rss_bytes(child)
+            except IOError:
+                # already gone
+                continue
+
+            if kind == 'engine':
+                self._oom_score_set(child, self.OOM_SCORE_ENGINES)
+
+        with self.lock:
+            self.rss = rss
+
+        for kind, value in rss.items():
+            MEMORY_RSS_BYTES.set(value, (kind,))
+
+        if self.over_budget():
+            print("memory: over budget, %d of %d KB used" %
+                  (self.rss_total() // 1024, self.total_bytes // 1024))
+
+    def _run(self):
+        while True:
+            self.check()
+            time.sleep(self.CHECK_PERIOD)
+
+    def start(self):
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+#
+#  Foldable Electronic Chess Board Project
+#
+#  These are the metrics: counters, gauges and histograms, rendered in the
+#  Prometheus text format by the /metrics endpoint.
+#
+#  Updates take no locks, they're meant to be cheap enough for the interrupt
+#  and timer threads. Under the GIL an update racing with another one on the
+#  same series may, rarely, be lost, which is fine for monitoring.
+#
+#  Copyright 2016 - Laurentiu Palcu <lpalcu@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+
+import bisect
+import collections
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"') \
+        .replace('\n', r'\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (name, _escape(value))
+             for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+
+    if not pairs:
+        return ''
+
+    return '{' + ','.join(pairs) + '}'
+
+
+class Metric(object):
+    TYPE = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+
+    def samples(self):
+        return []
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text),
+                 '# TYPE %s %s' % (self.name, self.TYPE)]
+
+        for suffix, labels, extra, value in self.samples():
+            lines.append('%s%s%s %s' %
+                         (self.name, suffix,
+                          _format_labels(self.label_names, labels, extra),
+                          repr(float(value))))
+
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def __init__(self, name, help_text, label_names=()):
+        super(Counter, self).__init__(name, help_text, label_names)
+        self.values = collections.defaultdict(int)
+
+    def inc(self, labels=(), value=1):
+        self.values[labels] += value
+
+    def samples(self):
+        return [('', labels, None, value)
+                for labels, value in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    # 'fn', when given, returns the current {labels: value} at render time
+    def __init__(self, name, help_text, label_names=(), fn=None):
+        super(Gauge, self).__init__(name, help_text, label_names)
+        self.values = {}
+        self.fn = fn
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+    def samples(self):
+        values = self.values
+        if self.fn is not None:
+            values = self.fn()
+
+        return [('', labels, None, value)
+                for labels, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    # upper bounds, in seconds
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+    def __init__(self, name, help_text, label_names=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets)
+
+        # per labels: [bucket counts..., +Inf count, sum]
+        self.values = {}
+
+    def observe(self, value, labels=()):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values.setdefault(
+                labels, [0] * (len(self.buckets) + 2))
+
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        samples = []
+
+        for labels, series in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series[:-1]):
+                cumulative += count
+                samples.append(('_bucket', labels, ('le', bound), cumulative))
+
+            samples.append(('_sum', labels, None, series[-1]))
+            samples.append(('_count', labels, None, cumulative))
+
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = collections.OrderedDict()
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+
+        return metric
+
+    def render(self):
+        return '\n'.join([metric.render()
+                          for metric in self.metrics.values()]) + '\n'
+
+
+registry = Registry()
+
+
+def counter(name, help_text, label_names=()):
+    return registry.register(Counter(name, help_text, label_names))
+
+
+def gauge(name, help_text, label_names=(), fn=None):
+    return registry.register(Gauge(name, help_text, label_names, fn))
+
+
+def histogram(name, help_text, label_names=(),
+              buckets=Histogram.DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, help_text, label_names, buckets))
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+#
+#  Foldable Electronic Chess Board Project
+#
+#  This is the engine move cache. It remembers the engine's answers for a
+#  (position, level, time bucket) key, so that known positions are answered
+#  without asking the engine again. The cache is LRU ordered and is kept on
+#  disk as a file of fixed size records, capped to MAX_ENTRIES.
+#
+#  Copyright 2016 - Laurentiu Palcu <lpalcu@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+
+import chess
+import chess.polyglot
+import collections
+import os
+import struct
+from threading import Lock
+
+
+class MoveCache(object):
+    # zobrist hash, level, time bucket, bestmove, pondermove
+    RECORD = struct.Struct('<QBBHH')
+
+    MAX_ENTRIES = 8192
+
+    def __init__(self, path, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = Lock()
+        self.entries = collections.OrderedDict()
+        self.dirty = False
+
+        self.hits = 0
+        self.misses = 0
+
+        self._load()
+
+    @staticmethod
+    def _encode_move(move):
+        if move is None:
+            return 0
+
+        return move.from_square | (move.to_square << 6) | \
+            ((move.promotion or 0) << 12)
+
+    @staticmethod
+    def _decode_move(code):
+        if not code:
+            return None
+
+        return chess.Move(code & 0x3f, (code >> 6) & 0x3f,
+                          (code >> 12) or None)
+
+    # searches are bucketed by the power of two of their move time, so that
+    # slightly different times share the same answers
+    @staticmethod
+    def time_bucket(movetime):
+        if movetime is None:
+            return 0
+
+        return min(int(movetime).bit_length(), 0xff)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+
+        # oldest entries come first in the file, keep the newest ones
+        size = os.path.getsize(self.path)
+        size -= size % self.RECORD.size
+
+        with open(self.path, 'rb') as f:
+            f.seek(max(0, size - self.max_entries * self.RECORD.size))
+            data = f.read(self.max_entries * self.RECORD.size)
+
+        for offs in range(0, len(data) - self.RECORD.size + 1,
+                          self.RECORD.size):
+            zobrist, level, bucket, bestmove, pondermove = \
+                self.RECORD.unpack_from(data, offs)
+
+            key = (zobrist, level, bucket)
+            self.entries.pop(key, None)
+            self.entries[key] = (bestmove, pondermove)
+
+        print("move cache: loaded %d entries" % len(self.entries))
+
+    def key(self, board, level, movetime):
+        return (chess.polyglot.zobrist_hash(board), level,
+                self.time_bucket(movetime))
+
+    def get(self, board, key):
+        with self.lock:
+            codes = self.entries.pop(key, None)
+
+            if codes is None:
+                self.misses += 1
+                return None
+
+            # refresh the entry
+            self.entries[key] = codes
+
+        bestmove = self._decode_move(codes[0])
+        pondermove = self._decode_move(codes[1])
+
+        # protect against hash collisions
+        if bestmove not in board.legal_moves:
+            return None
+
+        if pondermove is not None:
+            board = board.copy()
+            board.push(bestmove)
+            if pondermove not in board.legal_moves:
+                pondermove = None
+
+        self.hits += 1
+
+        return bestmove, pondermove
+
+    def put(self, key, bestmove, pondermove):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (self._encode_move(bestmove),
+                                 self._encode_move(pondermove))
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+
+            records = [self.RECORD.pack(k[0], k[1], k[2], v[0], v[1])
+                       for k, v in self.entries.items()]
+            self.dirty = False
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(records))
+
+        os.rename(tmp_path, self.path)
+
+        print("move cache: saved %d entries (%d hits, %d misses)" %
+              (len(records), self.hits, self.misses))
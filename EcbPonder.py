@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+#
+#  Foldable Electronic Chess Board Project
+#
+#  This is the ponder controller. It numbers engine searches, so that results
+#  of cancelled searches can be dropped, and keeps the pondering state and
+#  statistics.
+#
+#  Copyright 2016 - Laurentiu Palcu <lpalcu@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+
+from threading import Lock
+
+
+class PonderController(object):
+    # pondering states
+    IDLE = 0
+    PONDERING = 1
+    PONDER_DONE = 2
+
+    # outcomes of the opponent's move
+    NO_PONDER = 0
+    PONDER_HIT = 1
+    PONDER_HIT_DONE = 2
+    PONDER_MISS = 3
+
+    def __init__(self):
+        self.lock = Lock()
+        self.generation = 0
+        self.state = self.IDLE
+        self.pondermove = None
+        self.result = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def _log_hit_rate(self):
+        total = self.hits + self.misses
+        print("ponder hit rate: %d/%d (%d%%)" %
+              (self.hits, total, self.hits * 100 / total))
+
+    def search_started(self, pondermove=None):
+        with self.lock:
+            self.generation += 1
+
+            self.pondermove = pondermove
+            self.result = None
+            self.state = [self.PONDERING, self.IDLE][pondermove is None]
+
+            return self.generation
+
+    # returns True if the result has to be played right away, False if it's
+    # stale or has to be kept until the opponent moves
+    def search_finished(self, generation, result):
+        with self.lock:
+            if generation != self.generation:
+                return False
+
+            if self.state == self.PONDERING:
+                self.result = result
+                self.state = self.PONDER_DONE
+                return False
+
+            return True
+
+    def cancel(self):
+        with self.lock:
+            self.generation += 1
+
+            self.state = self.IDLE
+            self.pondermove = None
+            self.result = None
+
+    def pondering(self):
+        return self.state != self.IDLE
+
+    # returns the outcome and, for PONDER_HIT_DONE, the ponder result
+    def opponent_moved(self, move):
+        with self.lock:
+            if self.state == self.IDLE:
+                return self.NO_PONDER, None
+
+            if move != self.pondermove:
+                self.misses += 1
+                self._log_hit_rate()
+
+                self.generation += 1
+                self.state = self.IDLE
+                return self.PONDER_MISS, None
+
+            self.hits += 1
+            self._log_hit_rate()
+
+            result = self.result
+            outcome = [self.PONDER_HIT, self.PONDER_HIT_DONE][
+                self.state == self.PONDER_DONE]
+
+            # after a ponderhit the search goes on as a normal one
+            self.state = self.IDLE
+            self.pondermove = None
+            self.result = None
+
+            return outcome, result
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+
+#
+#  Foldable Electronic Chess Board Project
+#
+#  This is the event recorder and the replay/fuzzing harness.
+#
+#  The recorder saves every event entering the event queue, with its time,
+#  and marks the ones coming from outside the state machine (hardware, web
+#  clients, engine answers). It also saves the sensor maps read by the state
+#  machine.
+#
+#  The replayer feeds the external events of a recording to a state machine
+#  running on a fake driver, a silent engine and a virtual time source, at
+#  full speed. The events the state machine posts itself are regenerated, and
+#  compared with the recorded ones. When fuzzing, the order and timing of the
+#  external events are randomly perturbed.
+#
+#  Usage: EcbReplay.py <recording> [fuzz runs] [seed]
+#
+#  Copyright 2016 - Laurentiu Palcu <lpalcu@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+
+from EcbDriver import EcbDriver, SoftClock
+from EcbLeds import LedCompositor
+from EcbSensorHealth import SensorHealth
+from EcbFSM import Ecb, Event
+from EcbTimeSource import VirtualTime
+from EcbWorker import ChessOps
+import pickle
+import Queue
+import random
+import sys
+import time
+import traceback
+from threading import Lock
+
+# pseudo event id of the sensor map snapshots
+SENSORS_SNAPSHOT = -1
+
+
+class EventRecorder(object):
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.lock = Lock()
+        self.time_source = None
+        self.start = None
+
+    def _write(self, external, event_id, event_data):
+        t = self.time_source.now() - self.start
+
+        with self.lock:
+            pickle.dump((t, external, event_id, event_data), self.file, 2)
+            self.file.flush()
+
+    def attach(self, ecb):
+        self.time_source = ecb.time_source
+        self.start = self.time_source.now()
+
+        sensors_get = ecb.driver.sensors_get
+
+        def recorded_sensors_get():
+            sensor_map = sensors_get()
+            self._write(True, SENSORS_SNAPSHOT, list(sensor_map))
+
+            return sensor_map
+
+        ecb.driver.sensors_get = recorded_sensors_get
+        ecb.recorder = self
+
+    def record(self, event, event_data, external):
+        self._write(external, event.event_id, event_data)
+
+
+def load_recording(path):
+    records = []
+
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                records.append(pickle.load(f))
+            except EOFError:
+                break
+
+    return records
+
+
+# The fake driver keeps the constants of the real one, but never touches the
+# hardware: the sensor map follows the replayed sensor events and the clocks
+# are only software clocks.
+class FakeDriver(EcbDriver):
+    def __init__(self, sensor_map, time_source=None):
+        self.time_source = time_source
+        self.sensor_map = list(sensor_map)
+        self.sensors_started = False
+        self.sensor_health = SensorHealth(time_source)
+        self.soft_clocks = [SoftClock(time_source), SoftClock(time_source)]
+
+        self.leds = LedCompositor(time_source, self._leds_write)
+        self.led_static = self.leds.layer(self.LED_PRIORITY_STATIC)
+        self.led_blink = self.leds.layer(self.LED_PRIORITY_BLINK)
+        self.led_blink_inverse = self.leds.layer(self.LED_PRIORITY_BLINK)
+
+        self.cmd_leds = LedCompositor(time_source, self._leds_write, 1, 1)
+        self.cmd_led_static = self.cmd_leds.layer(self.LED_PRIORITY_STATIC)
+        self.cmd_led_blink = self.cmd_leds.layer(self.LED_PRIORITY_BLINK)
+
+    def set_callbacks(self, sensors_changed_cb, clock_expired_cb,
+                      btns_pressed_cb):
+        pass
+
+    def toggle_squares(self, squares_list):
+        for sq in squares_list:
+            col = self.SENSOR_COLUMNS.index(sq[0])
+            self.sensor_map[int(sq[1]) - 1] ^= 1 << col
+
+    def _leds_write(self, first_row, rows):
+        pass
+
+    def sensors_start(self):
+        self.sensors_started = True
+
+    def sensors_stop(self):
+        self.sensors_started = False
+
+    def sensors_get(self):
+        return list(self.sensor_map)
+
+    def sensors_running(self):
+        return self.sensors_started
+
+    def sensors_debouncing(self):
+        return {}
+
+    def controllers_health(self):
+        return {'top': True, 'bot': True, 'cmd': True}
+
+    def clock_set(self, clock_id, min, sec):
+        self.soft_clocks[clock_id].set(min, sec)
+
+    def clock_get(self, clock_id):
+        remaining_sec = self.clock_remaining(clock_id) // 1000
+
+        return {'min': remaining_sec // 60, 'sec': remaining_sec % 60}
+
+    def clock_start(self, clock_id):
+        self.soft_clocks[clock_id].start()
+
+    def clock_stop(self, clock_id):
+        self.soft_clocks[clock_id].stop()
+
+    def clock_blank(self, clock_id):
+        pass
+
+
+# an engine that never answers, the answers come from the recording
+class SilentEngine(object):
+    def __init__(self):
+        self.info_handlers = []
+
+    def uci(self):
+        pass
+
+    def setoption(self, options):
+        pass
+
+    def ucinewgame(self):
+        pass
+
+    def position(self, board):
+        pass
+
+    def go(self, async_callback=None, **go_params):
+        return None
+
+    def stop(self):
+        pass
+
+    def ponderhit(self):
+        pass
+
+    def quit(self):
+        pass
+
+
+class ReplayChessOps(ChessOps):
+    # book moves are engine answers, they come from the recording
+    def book_open(self, path):
+        pass
+
+    def book_close(self):
+        pass
+
+    def book_candidates(self, board, band):
+        return []
+
+    def engine(self, path_to_engine):
+        return SilentEngine()
+
+
+class Replayer(object):
+    def __init__(self, records):
+        self.records = records
+        self.sensor_map = self._initial_sensor_map()
+
+    # the board as it was when recording started: the first sensor map read,
+    # without the sensor changes recorded before it
+    def _initial_sensor_map(self):
+        driver = FakeDriver([0] * 8)
+
+        for t, external, event_id, event_data in self.records:
+            if event_id == SENSORS_SNAPSHOT:
+                driver.sensor_map = event_data
+                break
+        else:
+            return driver.sensor_map
+
+        for t, external, event_id, event_data in self.records:
+            if event_id == SENSORS_SNAPSHOT:
+                break
+
+            if event_id == Event.sensors_changed.event_id:
+                driver.toggle_squares(event_data)
+
+        return driver.sensor_map
+
+    def _drain(self):
+        while True:
+            try:
+                record = self.ecb.event_queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            self.handled.append(record.event.event_id)
+            self.ecb.handle(self.ecb, record.event, record.event_data)
+            record.release()
+            self.ecb.event_queue.task_done()
+
+    def _external(self, records):
+        return [rec for rec in records
+                if rec[1] and rec[2] != SENSORS_SNAPSHOT]
+
+    def fuzz(self, rng, swap_probability=0.1, jitter=0.2):
+        records = self._external(self.records)
+
+        # swap neighbour events, keeping the timeline
+        for i in range(len(records) - 1):
+            if rng.random() < swap_probability:
+                t0, t1 = records[i][0], records[i + 1][0]
+                records[i], records[i + 1] = \
+                    (t0,) + records[i + 1][1:], (t1,) + records[i][1:]
+
+        # move events in time, relative to the timers
+        records = [(max(rec[0] + rng.uniform(-jitter, jitter), 0),) + rec[1:]
+                   for rec in records]
+        records.sort(key=lambda rec: rec[0])
+
+        return records
+
+    # returns (events handled, seconds, error or None)
+    def replay(self, records=None):
+        if records is None:
+            records = self._external(self.records)
+
+        self.time_source = VirtualTime()
+        self.driver = FakeDriver(self.sensor_map, self.time_source)
+        self.ecb = Ecb(self.driver, None, None, chess_ops=ReplayChessOps())
+        self.handled = []
+
+        started = time.time()
+        try:
+            for t, external, event_id, event_data in records:
+                self.time_source.advance_to(t, self._drain)
+
+                event = Event.events[event_id]
+                if event == Event.sensors_changed:
+                    self.driver.toggle_squares(event_data)
+
+                self.ecb.inject_event(event, event_data)
+                self._drain()
+
+            # let the pending timers fire
+            self.time_source.advance(10, self._drain)
+            error = None
+        except Exception:
+            error = "%s in state %s:\n%s" % (
+                Event.events[self.handled[-1]] if self.handled else None,
+                self.ecb.current_state.__class__.__name__,
+                traceback.format_exc())
+
+        return len(self.handled), time.time() - started, error
+
+    # all the events of the recording, in the order they were queued
+    def recorded_events(self):
+        return [rec[2] for rec in self.records if rec[2] != SENSORS_SNAPSHOT]
+
+
+if __name__ == "__main__":
+    replayer = Replayer(load_recording(sys.argv[1]))
+    fuzz_runs = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+    events, seconds, error = replayer.replay()
+    print("replay: %d events in %.3f s (%.0f events/s)" %
+          (events, seconds, events / max(seconds, 1e-6)))
+
+    if replayer.handled != replayer.recorded_events():
+        print("replay: the event sequence differs from the recording")
+
+    if error is not None:
+        print("replay failed: " + error)
+
+    failures = 0
+    for run in range(fuzz_runs):
+        rng = random.Random(seed + run)
+        events, seconds, error = replayer.replay(replayer.fuzz(rng))
+
+        if error is not None:
+            failures += 1
+            print("fuzz run %d (seed %d) failed: %s" %
+                  (run, seed + run, error))
+
+    if fuzz_runs:
+        print("fuzz: %d/%d runs failed" % (failures, fuzz_runs))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+#
+#  Foldable Electronic Chess Board Project
+#
+#  This is the sensors health tracker. It keeps, per square, how often the
+#  reed switch toggles, how often and how long it bounces (toggles back
+#  shortly after a change) and how often it's involved in a board error. The
+#  bounce durations tune a per square debounce window: healthy squares are
+#  reported right away, worn ones only once they're stable.
+#
+#  Copyright 2016 - Laurentiu Palcu <lpalcu@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+
+from array import array
+from threading import Lock
+
+
+class SensorHealth(object):
+    SENSOR_COLUMNS = "abcdefgh"
+
+    # a toggle back within this time, in milliseconds, is a bounce; a hand
+    # can't lift a piece and put another one on its square that fast, so a
+    # capture is never taken for a bounce
+    BOUNCE_WINDOW_MS = 50
+
+    # squares start debouncing after this many bounces
+    MIN_BOUNCES = 3
+
+    # debounce window: this many times the average bounce, within limits;
+    # the window must stay shorter than a capture too, as the toggles within
+    # it are dropped
+    DEBOUNCE_FACTOR = 2
+    MAX_DEBOUNCE_MS = 100
+
+    # smoothing factor of the bounce duration average
+    EMA_ALPHA = 0.2
+
+    def __init__(self, time_source):
+        self.time_source = time_source
+        self.lock = Lock()
+        self.started_at = time_source.now()
+
+        # one entry per square, a1 = 0 ... h8 = 63
+        self.toggles = array('L', [0] * 64)
+        self.bounces = array('L', [0] * 64)
+        self.errors = array('L', [0] * 64)
+        self.bounce_ms_avg = array('f', [0] * 64)
+        self.bounce_ms_max = array('H', [0] * 64)
+        self.debounce_ms = array('H', [0] * 64)
+        self.last_toggle = array('d', [-1] * 64)
+
+    def _index(self, square):
+        return (int(square[1]) - 1) * 8 + self.SENSOR_COLUMNS.index(square[0])
+
+    def _square(self, index):
+        return "%s%d" % (self.SENSOR_COLUMNS[index % 8], index // 8 + 1)
+
+    def _tune(self, idx):
+        if self.bounces[idx] < self.MIN_BOUNCES:
+            return
+
+        window = int(self.bounce_ms_avg[idx] * self.DEBOUNCE_FACTOR)
+        self.debounce_ms[idx] = min(window, self.MAX_DEBOUNCE_MS)
+
+    def toggled(self, squares):
+        now = self.time_source.now()
+
+        with self.lock:
+            for sq in squares:
+                idx = self._index(sq)
+
+                self.toggles[idx] += 1
+
+                if self.last_toggle[idx] >= 0:
+                    elapsed_ms = int(round((now - self.last_toggle[idx]) *
+                                           1000))
+
+                    if elapsed_ms < self.BOUNCE_WINDOW_MS:
+                        self.bounces[idx] += 1
+                        self.bounce_ms_max[idx] = max(self.bounce_ms_max[idx],
+                                                      elapsed_ms)
+                        if self.bounces[idx] == 1:
+                            self.bounce_ms_avg[idx] = elapsed_ms
+                        else:
+                            self.bounce_ms_avg[idx] += self.EMA_ALPHA * \
+                                (elapsed_ms - self.bounce_ms_avg[idx])
+
+                        self._tune(idx)
+
+                self.last_toggle[idx] = now
+
+    def error(self, squares):
+        with self.lock:
+            for sq in squares:
+                self.errors[self._index(sq)] += 1
+
+    # debounce window of a square, in seconds
+    def debounce(self, square):
+        return self.debounce_ms[self._index(square)] / 1000.0
+
+    def report(self):
+        minutes = max((self.time_source.now() - self.started_at) / 60, 1e-6)
+        squares = []
+
+        with self.lock:
+            for idx in range(0, 64):
+                if not self.toggles[idx] and not self.errors[idx]:
+                    continue
+
+                squares.append({
+                    'square': self._square(idx),
+                    'toggles': self.toggles[idx],
+                    'toggles_per_min': round(self.toggles[idx] / minutes, 2),
+                    'bounces': self.bounces[idx],
+                    'bounce_ms_avg': int(self.bounce_ms_avg[idx]),
+                    'bounce_ms_max': self.bounce_ms_max[idx],
+                    'errors': self.errors[idx],
+                    'debounce_ms': self.debounce_ms[idx],
+                })
+
+        return squares
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+#
+#  Foldable Electronic Chess Board Project
+#
+#  This is the startup bookkeeping. ecb.py brings the board up in stages:
+#  the controllers and the state machines first, so that the command panel
+#  and the sensors work as soon as possible, then the storage, the web
+#  server and, in the background, the engines. Every stage is timed, as well
+#  as the time from the process start until the board is ready.
+#
+#  Copyright 2016 - Laurentiu Palcu <lpalcu@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+
+import EcbMetrics
+import collections
+import os
+from EcbTimeSource import monotonic
+from threading import Lock, Thread
+
+STARTUP_STAGE_SECONDS = EcbMetrics.gauge(
+    'ecb_startup_stage_seconds', 'Duration of the startup stages.',
+    ['stage'])
+STARTUP_READY_SECONDS = EcbMetrics.gauge(
+    'ecb_startup_ready_seconds',
+    'Time from the process start until the board was ready.')
+
+
+# seconds since the process started, 0 if unknown
+def process_age():
+    try:
+        with open('/proc/self/stat') as f:
+            stat = f.read()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+
+        # the fields after the command name, which may contain spaces; the
+        # start time, in clock ticks after boot, is the 22nd field
+        fields = stat[stat.rindex(')') + 2:].split()
+        started = int(fields[19]) / float(os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, ValueError, IndexError):
+        return 0
+
+    return max(uptime - started, 0)
+
+
+class Startup(object):
+    def __init__(self):
+        now = monotonic()
+
+        self.lock = Lock()
+        self.started_at = now - process_age()
+        self.last_mark = now
+        self.stages = collections.OrderedDict()
+
+        self._record('interpreter', now - self.started_at)
+
+    def _record(self, stage, seconds):
+        with self.lock:
+            self.stages[stage] = seconds
+
+        STARTUP_STAGE_SECONDS.set(seconds, (stage,))
+        print("startup: %s took %.2fs" % (stage, seconds))
+
+    # ends 'stage', which started at the previous mark
+    def mark(self, stage):
+        now = monotonic()
+        self._record(stage, now - self.last_mark)
+        self.last_mark = now
+
+    # runs fn() as 'stage', in the background
+    def background(self, stage, fn, *args):
+        def run():
+            started = monotonic()
+            fn(*args)
+            self._record(stage, monotonic() - started)
+
+        thread = Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+        return thread
+
+    def ready(self):
+        seconds = monotonic() - self.started_at
+
+        STARTUP_READY_SECONDS.set(seconds)
+        print("startup: ready %.2fs after the process start" % seconds)
+
+    def report(self):
+        with self.lock:
+            return list(self.stages.items())
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+#
+#  Foldable Electronic Chess Board Project
+#
+#  This is the engine time manager. It keeps track of both clocks between
+#  hardware clock reads and computes how much time the engine may use for a
+#  move.
+#
+#  Copyright 2016 - Laurentiu Palcu <lpalcu@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+
+from EcbTimeSource import MonotonicTime
+import chess
+
+
+class TimeManager(object):
+    # moves we expect to still play, when the time control has no moves-to-go
+    MIN_MOVES_TO_GO = 20
+    MAX_MOVES_TO_GO = 50
+
+    # never plan to use more than this share of the remaining time
+    MAX_TIME_SHARE = 0.2
+
+    # time kept in reserve, in milliseconds, to never flag
+    SAFETY_MARGIN = 1000
+    MIN_MOVETIME = 30
+
+    # a search shorter than needed for this many nodes is not worth it
+    MIN_NODES = 20000
+
+    # smoothing factor for the nps and lag averages
+    EMA_ALPHA = 0.3
+
+    def __init__(self, time_source=None):
+        self.time_source = time_source or MonotonicTime()
+
+        self.remaining_ms = [0, 0]
+        self.started_at = [None, None]
+        self.period_ms = 0
+        self.increment_ms = 0
+        self.moves_to_go = None
+        self.moves = [0, 0]
+
+        self.nps = None
+        self.lag_ms = 0
+
+    def _ema(self, old, new):
+        if old is None:
+            return new
+
+        return old + self.EMA_ALPHA * (new - old)
+
+    # 'minutes' for the game, or for every 'moves_to_go' moves, and
+    # 'increment_sec' more for every move
+    def reset(self, minutes, increment_sec=0, moves_to_go=None):
+        self.period_ms = minutes * 60 * 1000
+        self.remaining_ms = [self.period_ms] * 2
+        self.started_at = [None, None]
+        self.increment_ms = int(increment_sec * 1000)
+        self.moves_to_go = moves_to_go
+        self.moves = [0, 0]
+
+    def clock_started(self, color):
+        self.started_at[color] = self.time_source.now()
+
+    # 'moved' tells whether the clock stopped because 'color' moved, rather
+    # than for a pause; only moves earn time. Returns the time earned, in
+    # milliseconds.
+    def clock_stopped(self, color, remaining_ms=None, moved=False):
+        # the board clock is authoritative, when we have its time
+        if remaining_ms is not None:
+            self.sync(color, remaining_ms)
+
+        earned_ms = 0
+        if moved:
+            self.moves[color] += 1
+            earned_ms = self.increment_ms
+
+            if self.moves_to_go and \
+                    self.moves[color] % self.moves_to_go == 0:
+                earned_ms += self.period_ms
+
+        self.remaining_ms[color] = self.remaining(color) + earned_ms
+        self.started_at[color] = None
+
+        return earned_ms
+
+    def sync(self, color, remaining_ms):
+        self.remaining_ms[color] = remaining_ms
+
+        if self.started_at[color] is not None:
+            self.started_at[color] = self.time_source.now()
+
+    def remaining(self, color):
+        remaining = self.remaining_ms[color]
+
+        if self.started_at[color] is not None:
+            remaining -= int((self.time_source.now() -
+                              self.started_at[color]) * 1000)
+
+        return max(remaining, 0)
+
+    def search_finished(self, requested_ms, elapsed_ms, nps=None):
+        # the time between 'go' and 'bestmove' exceeding the requested
+        # movetime is lost in communication, remember it
+        if requested_ms is not None:
+            self.lag_ms = self._ema(self.lag_ms,
+                                    max(elapsed_ms - requested_ms, 0))
+
+        if nps:
+            self.nps = self._ema(self.nps, nps)
+
+    def go_params(self, board):
+        params = {
+            'wtime': self.remaining(chess.WHITE),
+            'btime': self.remaining(chess.BLACK),
+        }
+
+        if self.increment_ms:
+            params['winc'] = self.increment_ms
+            params['binc'] = self.increment_ms
+
+        if self.moves_to_go is not None:
+            params['movestogo'] = self._moves_to_go(board)
+
+        return params
+
+    def _moves_to_go(self, board):
+        if self.moves_to_go is not None:
+            moves_played = board.fullmove_number - 1
+            return self.moves_to_go - moves_played % self.moves_to_go
+
+        return min(max(self.MAX_MOVES_TO_GO - board.fullmove_number,
+                       self.MIN_MOVES_TO_GO), self.MAX_MOVES_TO_GO)
+
+    def movetime(self, board, max_movetime=None):
+        remaining = self.remaining(board.turn) - self.SAFETY_MARGIN
+
+        budget = remaining / self._moves_to_go(board) + \
+            self.increment_ms * 3 / 4
+        budget = min(budget, remaining * self.MAX_TIME_SHARE) - self.lag_ms
+
+        # give the engine the time it needs for a meaningful search, if the
+        # clock allows it
+        if self.nps:
+            min_useful = self.MIN_NODES * 1000 / self.nps
+            budget = max(budget, min(min_useful,
+                                     remaining * self.MAX_TIME_SHARE))
+
+        if max_movetime is not None:
+            budget = min(budget, max_movetime)
+
+        return int(max(budget, self.MIN_MOVETIME))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+#
+#  Foldable Electronic Chess Board Project
+#
+#  These are the time sources of the state machine and of the driver. All the
+#  timeouts (sensor settling, move debouncing, blinking, pauses) and all the
+#  time measurements go through a time source:
+#    * MonotonicTime runs on the system's monotonic clock, with real timers;
+#    * VirtualTime only moves when it's advanced, firing the due timers, so
+#      that whole games can be simulated in milliseconds;
+#
+#  Copyright 2016 - Laurentiu Palcu <lpalcu@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+
+import heapq
+import time
+from threading import Lock, Timer
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    # python 2 has no monotonic clock, ask the C library for it
+    import ctypes
+    import os
+
+    class _Timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1
+
+    _clock_gettime = ctypes.CDLL('librt.so.1', use_errno=True).clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+    def monotonic():
+        ts = _Timespec()
+        if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+
+class MonotonicTime(object):
+    # seconds, from an arbitrary origin
+    def now(self):
+        return monotonic()
+
+    # timer factory, with the threading.Timer interface
+    def timer(self, timeout, function, args=None):
+        return Timer(timeout, function, args)
+
+
+class VirtualTimer(object):
+    def __init__(self, time_source, timeout, function, args=None):
+        self.time_source = time_source
+        self.timeout = timeout
+        self.function = function
+        self.args = args or []
+        self.cancelled = False
+
+    def start(self):
+        self.time_source.schedule(self)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class VirtualTime(object):
+    def __init__(self):
+        self.lock = Lock()
+        self.current = 0
+        self.timers = []
+        self.seq = 0
+
+    def now(self):
+        return self.current
+
+    def timer(self, timeout, function, args=None):
+        return VirtualTimer(self, timeout, function, args)
+
+    def schedule(self, timer):
+        with self.lock:
+            # timers due at the same time fire in the order they were started
+            self.seq += 1
+            heapq.heappush(self.timers,
+                           (self.current + timer.timeout, self.seq, timer))
+
+    def pending(self):
+        with self.lock:
+            return len([t for t in self.timers if not t[2].cancelled])
+
+    # run all timers due until 'deadline', calling 'on_fire' after each one
+    def advance_to(self, deadline, on_fire=None):
+        while True:
+            with self.lock:
+                if not self.timers or self.timers[0][0] > deadline:
+                    break
+
+                when, seq, timer = heapq.heappop(self.timers)
+                if timer.cancelled:
+                    continue
+
+                self.current = max(self.current, when)
+
+            timer.function(*timer.args)
+
+            if on_fire is not None:
+                on_fire()
+
+        with self.lock:
+            self.current = max(self.current, deadline)
+
+    def advance(self, seconds, on_fire=None):
+        self.advance_to(self.current + seconds, on_fire)
@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+
+#
+#  Foldable Electronic Chess Board Project
+#
+#  These are the chess computations used by the state machine. They either
+#  run in the state machine thread (ChessOps) or in a separate worker process
+#  (WorkerClient), together with the engine communication, so that the
+#  interrupt handling and the web server are never stuck behind chess logic.
+#
+#  The worker protocol is made of small tuples sent over a pipe:
+#    * requests:  (message id, operation code, arguments);
+#    * responses: (message type, message id, result);
+#
+#  If the worker process dies, it's restarted: the opening book, the engine,
+#  its options and position are restored, and the requests left unanswered
+#  are sent again, once. A request unanswered by two workers fails with
+#  WorkerError.
+#
+#  Copyright 2016 - Laurentiu Palcu <lpalcu@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+
+from EcbBookIndex import BookIndex, band_candidates
+import EcbMetrics
+import chess
+import chess.polyglot
+import chess.uci
+import collections
+import multiprocessing
+from threading import Condition, Lock, Thread
+import time
+
+WORKER_RESTARTS = EcbMetrics.counter(
+    'ecb_worker_restarts_total', 'Worker processes restarted.')
+
+
+class WorkerError(Exception):
+    pass
+
+
+class ChessOps(object):
+    def __init__(self):
+        self.opening_book = None
+
+    def legal_moves(self, board, square):
+        from_square = chess.SQUARE_NAMES.index(square)
+
+        return [chess.SQUARE_NAMES[move.to_square]
+                for move in board.legal_moves
+                if move.from_square == from_square]
+
+    def game_over(self, board):
+        return board.is_game_over()
+
+    def book_open(self, path):
+        self.book_close()
+
+        # the index, if built for this book; the book itself otherwise
+        if BookIndex.fresh(path):
+            self.opening_book = BookIndex(BookIndex.index_path(path))
+        else:
+            print("no index for %s, using the book" % path)
+            self.opening_book = chess.polyglot.MemoryMappedReader(path)
+
+    def book_close(self):
+        if self.opening_book is not None:
+            self.opening_book.close()
+            self.opening_book = None
+
+    # returns the moves of the weight 'band', see EcbBookIndex.BANDS, as a
+    # list of (move, cumulative weight)
+    def book_candidates(self, board, band):
+        if self.opening_book is None:
+            return []
+
+        if isinstance(self.opening_book, BookIndex):
+            return self.opening_book.candidates(board, band)
+
+        moves = [(entry.move(), entry.weight)
+                 for entry in self.opening_book.find_all(board)]
+
+        return band_candidates(moves)[band]
+
+    def engine(self, path_to_engine):
+        return chess.uci.popen_engine(path_to_engine)
+
+
+# operation codes
+OP_LEGAL_MOVES = 0
+OP_GAME_OVER = 1
+OP_BOOK_OPEN = 2
+OP_BOOK_CLOSE = 3
+OP_BOOK_CANDIDATES = 4
+OP_ENGINE_OPEN = 5
+OP_SETOPTION = 6
+OP_UCINEWGAME = 7
+OP_POSITION = 8
+OP_GO = 9
+OP_STOP = 10
+OP_PONDERHIT = 11
+OP_QUIT = 12
+
+# response types
+MSG_RESULT = 0
+MSG_INFO = 1
+
+
+def board_to_msg(board):
+    board = board.copy()
+    moves = []
+
+    while board.move_stack:
+        moves.append(board.pop().uci())
+
+    moves.reverse()
+
+    return board.fen(), moves
+
+
+def board_from_msg(msg):
+    fen, moves = msg
+    board = chess.Board(fen)
+
+    for move in moves:
+        board.push(chess.Move.from_uci(move))
+
+    return board
+
+
+def move_to_msg(move):
+    if move is None:
+        return None
+
+    return move.uci()
+
+
+def move_from_msg(msg):
+    if msg is None:
+        return None
+
+    return chess.Move.from_uci(msg)
+
+
+def _worker_main(conn):
+    ops = ChessOps()
+    engine = None
+    send_lock = Lock()
+
+    def send(msg):
+        with send_lock:
+            conn.send(msg)
+
+    class ForwardHandler(chess.uci.InfoHandler):
+        def post_info(self):
+            super(ForwardHandler, self).post_info()
+            send((MSG_INFO, None, dict(self.info)))
+
+    def go_finished(msg_id):
+        def callback(command):
+            bestmove, pondermove = command.result()
+            send((MSG_RESULT, msg_id,
+                  (move_to_msg(bestmove), move_to_msg(pondermove))))
+
+        return callback
+
+    while True:
+        try:
+            msg_id, op, args = conn.recv()
+        except EOFError:
+            break
+
+        result = None
+
+        if op == OP_LEGAL_MOVES:
+            result = ops.legal_moves(chess.Board(args[0]), args[1])
+        elif op == OP_GAME_OVER:
+            result = ops.game_over(board_from_msg(args[0]))
+        elif op == OP_BOOK_OPEN:
+            ops.book_open(args[0])
+        elif op == OP_BOOK_CLOSE:
+            ops.book_close()
+        elif op == OP_BOOK_CANDIDATES:
+            result = [(move.uci(), weight) for move, weight in
+                      ops.book_candidates(chess.Board(args[0]), args[1])]
+        elif op == OP_ENGINE_OPEN:
+            engine = chess.uci.popen_engine(args[0])
+            engine.info_handlers.append(ForwardHandler())
+            engine.uci()
+        elif op == OP_SETOPTION:
+            engine.setoption(args[0])
+        elif op == OP_UCINEWGAME:
+            engine.ucinewgame()
+        elif op == OP_POSITION:
+            engine.position(board_from_msg(args[0]))
+        elif op == OP_GO:
+            # answered when the search finishes
+            engine.go(async_callback=go_finished(msg_id), **args[0])
+            continue
+        elif op == OP_STOP:
+            engine.stop()
+        elif op == OP_PONDERHIT:
+            engine.ponderhit()
+        elif op == OP_QUIT:
+            engine.quit()
+            engine = None
+
+        send((MSG_RESULT, msg_id, result))
+
+
+class WorkerResult(object):
+    def __init__(self, result):
+        self.bestmove = move_from_msg(result[0])
+        self.pondermove = move_from_msg(result[1])
+
+    # same interface as the chess.uci commands
+    def result(self):
+        return self.bestmove, self.pondermove
+
+
+# Host side proxy of the worker's engine. It implements the subset of the
+# chess.uci engine interface used by the state machine.
+class WorkerEngine(object):
+    def __init__(self, client):
+        self.client = client
+        self.info_handlers = []
+
+    def uci(self):
+        pass
+
+    def setoption(self, options):
+        self.client.engine_options.update(options)
+        self.client.call(OP_SETOPTION, options)
+
+    def ucinewgame(self):
+        self.client.call(OP_UCINEWGAME)
+
+    def position(self, board):
+        self.client.engine_position = board_to_msg(board)
+        self.client.call(OP_POSITION, self.client.engine_position)
+
+    def go(self, async_callback=None, **go_params):
+        def go_finished(result):
+            if async_callback is not None:
+                async_callback(WorkerResult(result))
+
+        return self.client.call_async(go_finished, OP_GO, go_params)
+
+    def stop(self):
+        self.client.call(OP_STOP)
+
+    def ponderhit(self):
+        self.client.call(OP_PONDERHIT)
+
+    def quit(self):
+        self.client.engine_path = None
+        self.client.call(OP_QUIT)
+
+
+class WorkerClient(object):
+    # delay before restarting a dead worker, in seconds
+    RESTART_DELAY = 1
+
+    def __init__(self):
+        self.lock = Condition()
+        self.send_lock = Lock()
+        self.next_id = 0
+        self.results = {}
+        self.callbacks = {}
+        self.engine_proxy = None
+
+        # the requests not answered yet: msg_id: (op, args), and the ones
+        # already sent to a previous worker
+        self.pending = collections.OrderedDict()
+        self.resent = set()
+
+        # what a restarted worker needs to continue
+        self.book_path = None
+        self.engine_path = None
+        self.engine_options = {}
+        self.engine_position = None
+
+        self._start()
+
+        self.thread = Thread(target=self._receive)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _start(self):
+        self.conn, worker_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_worker_main,
+                                               args=(worker_conn,))
+        self.process.daemon = True
+        self.process.start()
+
+        # only the worker holds its end, so its death is an EOF here
+        worker_conn.close()
+
+    def _restart(self):
+        print("worker: process %d died, restarting it" % self.process.pid)
+        WORKER_RESTARTS.inc()
+
+        self.process.join()
+        time.sleep(self.RESTART_DELAY)
+
+        with self.send_lock:
+            self._start()
+
+            # its session first, the answers are of no interest
+            session = []
+            if self.book_path is not None:
+                session.append((OP_BOOK_OPEN, (self.book_path,)))
+            if self.engine_path is not None:
+                session.append((OP_ENGINE_OPEN, (self.engine_path,)))
+                session.append((OP_SETOPTION, (dict(self.engine_options),)))
+                if self.engine_position is not None:
+                    session.append((OP_POSITION, (self.engine_position,)))
+
+            for op, args in session:
+                with self.lock:
+                    msg_id = self.next_id
+                    self.next_id += 1
+                    self.callbacks[msg_id] = lambda result: None
+
+                self.conn.send((msg_id, op, args))
+
+            with self.lock:
+                for msg_id, (op, args) in list(self.pending.items()):
+                    if msg_id not in self.resent:
+                        self.resent.add(msg_id)
+                        self.conn.send((msg_id, op, args))
+                        continue
+
+                    # it probably killed the worker, twice
+                    del self.pending[msg_id]
+                    self.resent.discard(msg_id)
+                    if self.callbacks.pop(msg_id, None) is not None:
+                        print("worker: request %d dropped" % msg_id)
+                    else:
+                        self.results[msg_id] = WorkerError(
+                            "worker: request %d failed" % msg_id)
+
+                self.lock.notify_all()
+
+    def _receive(self):
+        while True:
+            try:
+                msg_type, msg_id, result = self.conn.recv()
+            except (EOFError, IOError):
+                self._restart()
+                continue
+
+            if msg_type == MSG_INFO:
+                if self.engine_proxy is not None:
+                    for handler in self.engine_proxy.info_handlers:
+                        with handler:
+                            handler.info.update(result)
+                            handler.post_info()
+                continue
+
+            with self.lock:
+                self.pending.pop(msg_id, None)
+                self.resent.discard(msg_id)
+
+                callback = self.callbacks.pop(msg_id, None)
+                if callback is None:
+                    self.results[msg_id] = result
+                    self.lock.notify_all()
+
+            if callback is not None:
+                callback(result)
+
+    # a request not sent to a dead worker is sent to the next one, see
+    # _restart()
+    def _send(self, op, args, callback=None):
+        with self.send_lock:
+            with self.lock:
+                msg_id = self.next_id
+                self.next_id += 1
+
+                if callback is not None:
+                    self.callbacks[msg_id] = callback
+                self.pending[msg_id] = (op, args)
+
+            try:
+                self.conn.send((msg_id, op, args))
+            except (EOFError, IOError):
+                pass
+
+        return msg_id
+
+    # raises WorkerError if the request failed
+    def call(self, op, *args):
+        msg_id = self._send(op, args)
+
+        with self.lock:
+            while msg_id not in self.results:
+                self.lock.wait()
+
+            result = self.results.pop(msg_id)
+
+        if isinstance(result, WorkerError):
+            raise result
+
+        return result
+
+    def call_async(self, callback, op, *args):
+        return self._send(op, args, callback)
+
+    # chess operations, same interface as ChessOps
+    def legal_moves(self, board, square):
+        return self.call(OP_LEGAL_MOVES, board.fen(), square)
+
+    def game_over(self, board):
+        return self.call(OP_GAME_OVER, board_to_msg(board))
+
+    def book_open(self, path):
+        self.book_path = path
+        self.call(OP_BOOK_OPEN, path)
+
+    def book_close(self):
+        self.book_path = None
+        self.call(OP_BOOK_CLOSE)
+
+    def book_candidates(self, board, band):
+        return [(chess.Move.from_uci(move), weight) for move, weight in
+                self.call(OP_BOOK_CANDIDATES, board.fen(), band)]
+
+    def engine(self, path_to_engine):
+        self.engine_path = path_to_engine
+        self.engine_options = {}
+        self.engine_position = None
+
+        self.call(OP_ENGINE_OPEN, path_to_engine)
+        self.engine_proxy = WorkerEngine(self)
+
+        return self.engine_proxy
@@ -18,74 +18,339 @@
 #  GNU General Public License for more details.
 #
 
-from EcbDriver import EcbDriver
-from EcbFSM import Ecb, Event
+# the startup is timed from here, see EcbStartup
+from EcbStartup import Startup
+startup = Startup()
+
+from EcbConfig import Config, in_range
+from EcbDriver import Controller, EcbDriver
+from EcbFSM import Ecb, Event, GameConfig
+from EcbHub import Hub
+from EcbMemory import MemoryBudget
+from EcbReplay import EventRecorder
+from EcbSensorHealth import SensorHealth
+import EcbMetrics
 import logging
+import os
+import sys
+import threading
+
+startup.mark('imports')
+
+
+# one dict of int settings per level, as Ecb.ENGINE_SETTINGS
+def engine_settings_valid(settings):
+    for level in settings:
+        if not isinstance(level, dict) or \
+                sorted(level.keys()) != ['depth', 'movetime', 'skill']:
+            return False
+
+        for name, value in level.items():
+            if not isinstance(value, int) or isinstance(value, bool) or \
+                    value < 0:
+                return False
+
+        if level['skill'] > 20 or not level['depth'] or \
+                not level['movetime']:
+            return False
+
+    return len(settings) == len(Ecb.ENGINE_SETTINGS)
+
+
+# the settings and their defaults, see EcbConfig
+CONFIG_DEFAULTS = [
+    ('paths.engine', '/home/root/stockfish'),
+    ('paths.opening_book', '/home/root/ProDeo-3200.bin'),
+    ('paths.data', '/home/root'),
+    ('paths.static', '/home/root/ecb/ecb/static'),
+
+    # controller addresses of the board, and of the boards driven in hub
+    # mode (--hub), with their game ids
+    ('board.addresses', EcbDriver.DEFAULT_ADDRESSES),
+    ('hub.boards', [
+        ['1', EcbDriver.DEFAULT_ADDRESSES],
+        ['2', {'top': [0x21, 35], 'bot': [0x22, 36], 'cmd': [0x23, 37]}],
+    ]),
+    ('hub.engines', 2),
+
+    # memory, in MB, shared by the engines, the boards and the web server
+    ('memory.budget_mb', MemoryBudget.DEFAULT_TOTAL_MB),
+
+    # hot settings, see config_bind()
+    ('engine.threads', Ecb.ENGINE_THREADS, in_range(1, 4)),
+    ('engine.settings', Ecb.ENGINE_SETTINGS, engine_settings_valid),
+    ('analysis.max_rate', Ecb.ANALYSIS_MAX_RATE, in_range(1, 10)),
+    ('game.increment', float(GameConfig.TIME_INCREMENT), in_range(0, 60)),
+    ('game.moves_to_go', GameConfig.TIME_MOVES_TO_GO, in_range(0, 100)),
+    ('game.pause_stop_window', float(Ecb.PAUSE_STOP_WINDOW),
+     in_range(0.5, 10)),
+    ('leds.blink_timeout', EcbDriver.LED_BLINK_TIMEOUT, in_range(0.05, 5)),
+    ('sensors.move_debounce', float(Ecb.MOVE_DEBOUNCE), in_range(0.1, 5)),
+    ('sensors.settle', float(EcbDriver.SENSORS_SETTLE), in_range(0.1, 10)),
+    ('sensors.bounce_window_ms', SensorHealth.BOUNCE_WINDOW_MS,
+     in_range(1, 100)),
+    ('sensors.min_bounces', SensorHealth.MIN_BOUNCES, in_range(1, 100)),
+    ('sensors.debounce_factor', float(SensorHealth.DEBOUNCE_FACTOR),
+     in_range(0, 10)),
+    ('sensors.max_debounce_ms', SensorHealth.MAX_DEBOUNCE_MS,
+     in_range(0, 200)),
+    ('i2c.retries', Controller.RETRIES, in_range(0, 10)),
+]
+
+config = Config(CONFIG_DEFAULTS,
+                os.environ.get('ECB_CONFIG', '/home/root/ecb.json'))
+
+EcbMetrics.gauge('ecb_threads', 'Running threads.',
+                 fn=lambda: {(): threading.active_count()})
+
+
+def hub_start():
+    # --worker moves the chess computations and the engine I/O to a worker
+    # process
+    use_workers = '--worker' in sys.argv
+
+    # the web server is attached later, see web_start()
+    if '--hub' in sys.argv:
+        hub = Hub(config.get('hub.boards'), config.get('paths.engine'),
+                  config.get('paths.opening_book'), None,
+                  config.get('paths.data'), config.get('hub.engines'),
+                  use_workers, config.get('memory.budget_mb'))
+    else:
+        hub = Hub([('', config.get('board.addresses'))],
+                  config.get('paths.engine'),
+                  config.get('paths.opening_book'), None,
+                  config.get('paths.data'), use_workers=use_workers,
+                  memory_mb=config.get('memory.budget_mb'))
+
+    # --record saves the events of every board, to be replayed by
+    # EcbReplay.py
+    if '--record' in sys.argv:
+        for game_id, ecb in hub.boards.items():
+            EventRecorder(config.get('paths.data') + '/events%s.rec' %
+                          ['', '-' + game_id][game_id != '']).attach(ecb)
+
+    return hub
+
+
+# the hot settings of every board
+def config_bind(hub):
+    for ecb in hub.boards.values():
+        driver = ecb.driver
+
+        config.bind('engine.threads', ecb, 'ENGINE_THREADS')
+        config.bind('engine.settings', ecb, 'ENGINE_SETTINGS')
+        config.bind('analysis.max_rate', ecb, 'ANALYSIS_MAX_RATE')
+        config.bind('game.increment', ecb.game_config, 'TIME_INCREMENT')
+        config.bind('game.moves_to_go', ecb.game_config, 'TIME_MOVES_TO_GO')
+        config.bind('game.pause_stop_window', ecb, 'PAUSE_STOP_WINDOW')
+        config.bind('leds.blink_timeout', driver, 'LED_BLINK_TIMEOUT')
+        config.bind('sensors.move_debounce', ecb, 'MOVE_DEBOUNCE')
+        config.bind('sensors.settle', driver, 'SENSORS_SETTLE')
+
+        for setting, attribute in [
+                ('sensors.bounce_window_ms', 'BOUNCE_WINDOW_MS'),
+                ('sensors.min_bounces', 'MIN_BOUNCES'),
+                ('sensors.debounce_factor', 'DEBOUNCE_FACTOR'),
+                ('sensors.max_debounce_ms', 'MAX_DEBOUNCE_MS')]:
+            config.bind(setting, driver.sensor_health, attribute)
+
+        for ctrl in [driver.top, driver.bot, driver.cmd]:
+            config.bind('i2c.retries', ctrl, 'RETRIES')
 
-import socketio
-from flask import Flask, send_from_directory
 
-from threading import Thread
+# Flask and socket.io take a while to import, they're loaded once the boards
+# are up.
+def web_start(hub):
+    import chess
+    import json
+    import socketio
+    from flask import Flask, Response, abort, jsonify, request, \
+        send_from_directory
 
-sio = socketio.Server()
-app = Flask(__name__)
-driver = EcbDriver()
-ecb = Ecb(driver, '/home/root/stockfish', '/home/root/ProDeo-3200.bin', sio)
+    sio = socketio.Server()
+    app = Flask(__name__)
 
+    def request_board(need_game_store=True):
+        ecb = hub.boards.get(request.args.get('gameid',
+                                              next(iter(hub.boards))))
+        if ecb is None or (need_game_store and ecb.game_store is None):
+            abort(404)
 
-@app.route('/')
-def hello_world():
-    return app.send_static_file('index.html')
+        return ecb
 
+    @app.route('/')
+    def hello_world():
+        return app.send_static_file('index.html')
 
-@app.route('/img/<path:path>')
-def send_img(path):
-    return send_from_directory('/home/root/ecb/ecb/static/img', path)
+    @app.route('/img/<path:path>')
+    def send_img(path):
+        return send_from_directory(config.get('paths.static') + '/img',
+                                   path)
 
+    @app.route('/js/<path:path>')
+    def send_js(path):
+        return send_from_directory(config.get('paths.static') + '/js',
+                                   path)
 
-@app.route('/js/<path:path>')
-def send_js(path):
-    return send_from_directory('/home/root/ecb/ecb/static/js', path)
+    @app.route('/css/<path:path>')
+    def send_css(path):
+        return send_from_directory(config.get('paths.static') + '/css',
+                                   path)
 
+    @app.route('/games.pgn')
+    def games_export():
+        return Response(request_board().game_store.export(),
+                        mimetype='application/x-chess-pgn')
 
-@app.route('/css/<path:path>')
-def send_css(path):
-    return send_from_directory('/home/root/ecb/ecb/static/css', path)
+    # streamed, the archive may hold more games than fit in memory; the
+    # opening is either a key, as listed, or the FEN of the position reached
+    # after GameStore.OPENING_PLIES plies
+    @app.route('/games')
+    def games_list():
+        game_store = request_board().game_store
 
+        opening = request.args.get('opening')
+        opening_fen = request.args.get('opening_fen')
+        try:
+            if opening is not None:
+                opening = int(opening, 16)
+            elif opening_fen is not None:
+                opening = game_store.opening_key(chess.Board(opening_fen))
+        except ValueError:
+            abort(400)
 
-@sio.on('join')
-def connect(sid, environ):
-    ecb.event_queue.put((Event.on_web_connect, None))
+        games = game_store.games(request.args.get('from', type=int),
+                                 request.args.get('to', type=int),
+                                 request.args.get('result'), opening)
 
+        def generate():
+            yield '{"games": ['
+            for game_no, game in enumerate(games):
+                yield [', ', ''][game_no == 0] + json.dumps(game)
+            yield ']}\n'
 
-@sio.on('square_unset')
-def square_unset(sid, square):
-    ecb.event_queue.put((Event.on_web_square_unset, square))
+        return Response(generate(), mimetype='application/json')
 
+    @app.route('/games/<int:game_no>')
+    def games_get(game_no):
+        pgn = request_board().game_store.read_game(game_no)
+        if pgn is None:
+            abort(404)
 
-@sio.on('square_set')
-def square_set(sid, square):
-    ecb.event_queue.put((Event.on_web_square_set, square))
+        return Response(pgn, mimetype='application/x-chess-pgn')
 
+    @app.route('/games/search')
+    def games_search():
+        ecb = request_board()
 
-@sio.on('setup_done')
-def setup_done(sid, fen_string):
-    ecb.event_queue.put((Event.on_web_board_setup_done, fen_string))
+        try:
+            board = chess.Board(request.args.get('fen', chess.STARTING_FEN))
+        except ValueError:
+            abort(400)
 
+        return jsonify(games=ecb.game_store.find_position(board))
 
-@sio.on('move')
-def message(sid, data):
-    print("message ", data)
-    sio.emit('move', data)
+    @app.route('/metrics')
+    def metrics():
+        return Response(EcbMetrics.registry.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    @app.route('/sensors/health')
+    def sensors_health():
+        driver = request_board(False).driver
+
+        return jsonify(squares=driver.sensors_health(),
+                       controllers=driver.controllers_health())
+
+    @app.route('/config', methods=['GET', 'POST'])
+    def config_api():
+        if request.method == 'POST':
+            settings = request.get_json(silent=True)
+            if not isinstance(settings, dict):
+                abort(400)
+
+            try:
+                for name, value in settings.items():
+                    config.set(name, value)
+            except (KeyError, ValueError):
+                abort(400)
+
+        return jsonify(config.dump())
+
+    @app.route('/startup')
+    def startup_report():
+        return jsonify(stages=startup.report())
+
+    @sio.on('connect')
+    def connect(sid, environ):
+        return hub.connect(sid)
+
+    @sio.on('join')
+    def join(sid, game_id):
+        ecb = hub.join(sid, game_id)
+        if ecb is None:
+            sio.disconnect(sid)
+            return
+
+        ecb.inject_web_event(Event.on_web_connect, None)
+
+    @sio.on('disconnect')
+    def disconnect(sid):
+        hub.leave(sid)
+
+    def board_event(sid, event, event_data):
+        ecb = hub.board(sid)
+        if ecb is not None:
+            ecb.inject_web_event(event, event_data)
+
+    # the square events carry a square, or a list of squares
+    @sio.on('square_unset')
+    def square_unset(sid, square):
+        board_event(sid, Event.on_web_square_unset, square)
+
+    @sio.on('square_set')
+    def square_set(sid, square):
+        board_event(sid, Event.on_web_square_set, square)
+
+    @sio.on('setup_done')
+    def setup_done(sid, fen_string):
+        board_event(sid, Event.on_web_board_setup_done, fen_string)
+
+    @sio.on('move')
+    def message(sid, data):
+        print("message ", data)
+        sio.emit('move', data, room=hub.clients.get(sid) or None)
+
+    hub.web_attach(sio)
+    app.wsgi_app = socketio.Middleware(sio, app.wsgi_app)
+
+    return app
 
 
 if __name__ == '__main__':
     logging.basicConfig()
 
-    thread = Thread(target=ecb.handle_events)
-    thread.start()
+    # the command panel and the sensors first
+    hub = hub_start()
+    config_bind(hub)
+    threads = hub.start()
+    startup.mark('boards')
 
-    app.wsgi_app = socketio.Middleware(sio, app.wsgi_app)
+    config.start()
+
+    hub.memory_budget.start()
+
+    if hub.engine_pool is not None:
+        startup.background('engines', hub.engine_pool.wait_ready)
+
+    hub.storage_open()
+    startup.mark('storage')
+
+    app = web_start(hub)
+    startup.mark('web')
+
+    startup.ready()
     app.run(host='0.0.0.0', port=8080, threaded=True)
 
-    thread.join()
+    for thread in threads:
+        thread.join()
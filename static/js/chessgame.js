@@ -24,6 +24,7 @@ $(document).ready(function() {
 
     socket.on('sensors_map', function(sensors_map) {
       ocuppied_squares = [];
+      var set_squares = [];
 
       for (var row = 0; row < 8; row++) {
           for (var col = 0; col < 8; col++) {
@@ -33,7 +34,7 @@ $(document).ready(function() {
                   ocuppied_squares.push(square);
 
                   if (game.get(square) != null)
-                    socket.emit("square_set", square);
+                    set_squares.push(square);
 
                   var background = '#a9a9a9';
 
@@ -44,11 +45,16 @@ $(document).ready(function() {
                   squareEl.css('background', background);
               } else {
                   game.remove(square);
-                  board.position(game.fen());
                   squareEl.css('background', '');
               }
           }
       }
+      board.position(game.fen());
+
+      // the squares still set, in one message
+      if (set_squares.length)
+        socket.emit("square_set", set_squares);
+
       updateStatus();
     });
 
@@ -65,12 +71,89 @@ $(document).ready(function() {
       }
     });
 
+    // the board rejected the setup, the squares at fault are highlighted
+    // until the next sensors map
+    socket.on('setup_error', function(error) {
+      statusEl.html('Setup rejected: ' + error.message);
+
+      for (var i = 0; i < error.squares.length; i++)
+        $('#board .square-' + error.squares[i]).css('background', '#e06060');
+    });
+
     socket.on('setup_game', function() {
       game_started = false;
       game = new Chess('8/8/8/8/8/8/8/8 w - - 0 1');
       board.position(game.fen());
     });
 
+    socket.on('analysis', function(analysis) {
+      var score;
+
+      if (analysis.mate !== undefined)
+        score = '#' + analysis.mate;
+      else if (analysis.cp !== undefined)
+        score = (analysis.cp / 100).toFixed(2);
+      else
+        score = '?';
+
+      analysisEl.html('depth ' + analysis.depth + ', ' + score + ': ' +
+                      analysis.pv.join(' '));
+    });
+
+    // the host sends clock anchors only when the clocks change, the running
+    // clock is counted down locally from the time the anchor arrived
+    var clock_anchor = null,
+      clock_anchor_received = 0,
+      clock_interval = null;
+
+    function format_clock(ms) {
+      var sec = Math.max(Math.ceil(ms / 1000), 0);
+      var min = Math.floor(sec / 60);
+
+      sec = sec % 60;
+
+      return min + ':' + (sec < 10 ? '0' : '') + sec;
+    }
+
+    function update_clocks() {
+      if (clock_anchor === null) {
+        clockWhiteEl.html('');
+        clockBlackEl.html('');
+        return;
+      }
+
+      var elapsed = performance.now() - clock_anchor_received;
+      var white = clock_anchor.white, black = clock_anchor.black;
+
+      if (clock_anchor.running === 'white')
+        white -= elapsed;
+      else if (clock_anchor.running === 'black')
+        black -= elapsed;
+
+      clockWhiteEl.html(format_clock(white));
+      clockBlackEl.html(format_clock(black));
+    }
+
+    socket.on('clock', function(anchor) {
+      // drop anchors overtaken by newer ones
+      if (anchor !== null && clock_anchor !== null &&
+          anchor.ts < clock_anchor.ts)
+        return;
+
+      clock_anchor = anchor;
+      clock_anchor_received = performance.now();
+
+      if (clock_interval !== null) {
+        clearInterval(clock_interval);
+        clock_interval = null;
+      }
+
+      update_clocks();
+
+      if (anchor !== null && anchor.running !== null)
+        clock_interval = setInterval(update_clocks, 200);
+    });
+
     socket.on('board_update', function(fen_string) {
       game.load(fen_string);
       board.position(game.fen());
@@ -82,6 +165,9 @@ $(document).ready(function() {
 	  game = new Chess('8/8/8/8/8/8/8/8 w - - 0 1'),
 	  statusEl = $('#status'),
 	  fenEl = $('#fen'),
+	  analysisEl = $('#analysis'),
+	  clockWhiteEl = $('#clock_white'),
+	  clockBlackEl = $('#clock_black'),
       black_castling_king = $('#cr_black_king'),
       black_castling_queen = $('#cr_black_queen'),
       white_castling_king = $('#cr_white_king'),